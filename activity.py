@@ -0,0 +1,125 @@
+import logging
+import threading
+from datetime import datetime, timezone
+
+from config import ACTIVITY_FLUSH_SECONDS, ACTIVITY_FLUSH_EVENTS
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer:
+    """
+    Write-behind aggregator for the per-user counters on the users row
+    (upload_count, tag_count, last_active).
+
+    Writers call `record` after their own transaction has committed; deltas
+    are summed per user in memory and written by `apply(rows)` in one batch,
+    every `interval` seconds or as soon as `max_events` records have piled
+    up, from a background thread. `apply` gets (user_id, upload delta, tag
+    delta, last_active or None) rows sorted by user_id and must raise on
+    failure, in which case the rows are merged back and retried on the next
+    flush. `close` stops the thread and flushes what is left.
+
+    Counters on the users row therefore lag by up to `interval` seconds, and
+    deltas still buffered are lost if the process is killed outright.
+    """
+
+    def __init__(self, apply, interval=ACTIVITY_FLUSH_SECONDS, max_events=ACTIVITY_FLUSH_EVENTS):
+        self.interval = interval
+        self.max_events = max_events
+        self._apply = apply
+        self._pending = {}  # user_id -> [uploads, tags, last_active]
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one batch in flight at a time
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+        # Counters for monitoring
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+
+    def record(self, user_id, uploads=0, tags=0, touch=True):
+        """Adds deltas for one user; `touch` also moves their last_active to now."""
+        at = datetime.now(timezone.utc) if touch else None
+        with self._lock:
+            entry = self._pending.get(user_id)
+            if entry is None:
+                entry = self._pending[user_id] = [0, 0, None]
+            entry[0] += uploads
+            entry[1] += tags
+            if at is not None and (entry[2] is None or at > entry[2]):
+                entry[2] = at
+            self._events += 1
+            full = self._events >= self.max_events
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """Writes everything pending in one batch. Returns the number of users written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._events = 0
+            rows = [
+                (user_id, uploads, tags, last_active)
+                for user_id, (uploads, tags, last_active) in sorted(pending.items())
+                if uploads or tags or last_active is not None
+            ]
+            if not rows:
+                return 0
+            try:
+                self._apply(rows)
+            except Exception:
+                self.failed_flushes += 1
+                logger.exception("Flushing activity counters for %s users failed; will retry", len(rows))
+                self._merge_back(rows)
+                return 0
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+            return len(rows)
+
+    def _merge_back(self, rows):
+        with self._lock:
+            for user_id, uploads, tags, last_active in rows:
+                entry = self._pending.get(user_id)
+                if entry is None:
+                    self._pending[user_id] = [uploads, tags, last_active]
+                    continue
+                entry[0] += uploads
+                entry[1] += tags
+                if last_active is not None and (entry[2] is None or last_active > entry[2]):
+                    entry[2] = last_active
+                self._events += 1
+
+    def pending_users(self):
+        """Number of users with counters waiting for the next flush."""
+        with self._lock:
+            return len(self._pending)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="activity_flush", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the background thread, then flushes whatever is still pending."""
+        thread = self._thread
+        if thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            self.flush()
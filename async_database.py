@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from config import DB_POOL_MAX
+import instrumentation
+from metrics import DB_QUERY_SECONDS
+import storage
+
+logger = logging.getLogger(__name__)
+
+# One worker per pooled connection: a query never waits on the pool, and at
+# most DB_POOL_MAX queries are in flight while the event loop keeps serving
+# other users.
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+
+def _awaitable(func):
+    """
+    Wrap a blocking database function so it runs on the DB worker pool.
+    Its run time on the worker is recorded per function in DB_QUERY_SECONDS;
+    the time the calling handler waited for it, worker queueing included, is
+    charged to the handler's call record.
+    """
+    name = func.__name__
+
+    def timed(*args, **kwargs):
+        with DB_QUERY_SECONDS.time(function=name):
+            return func(*args, **kwargs)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            return await loop.run_in_executor(_executor, functools.partial(timed, *args, **kwargs))
+        finally:
+            instrumentation.add_db_time(loop.time() - start)
+    return wrapper
+
+
+# The backend DATABASE_URL selects: database (Postgres) or sqlite_storage.
+# Its query functions raise storage.StorageUnavailable when it is down.
+backend = storage.get_backend()
+
+init_db = _awaitable(backend.init_db)
+ping = _awaitable(backend.ping)
+# Only read counters, so they are called directly on the event loop
+pool_stats = backend.pool_stats
+activity_stats = backend.activity_stats
+
+add_file = _awaitable(backend.add_file)
+save_upload = _awaitable(backend.save_upload)
+save_uploads = _awaitable(backend.save_uploads)
+find_files = _awaitable(backend.find_files)
+find_file_details = _awaitable(backend.find_file_details)
+get_all_tags = _awaitable(backend.get_all_tags)
+get_tag_counts = _awaitable(backend.get_tag_counts)
+update_file_metadata = _awaitable(backend.update_file_metadata)
+get_recent_files = _awaitable(backend.get_recent_files)
+delete_files = _awaitable(backend.delete_files)
+get_files_without_unique_id = _awaitable(backend.get_files_without_unique_id)
+assign_file_unique_ids = _awaitable(backend.assign_file_unique_ids)
+
+get_user = _awaitable(backend.get_user)
+add_user = _awaitable(backend.add_user)
+update_user_subscription = _awaitable(backend.update_user_subscription)
+record_upload = _awaitable(backend.record_upload)
+record_tag_usage = _awaitable(backend.record_tag_usage)
+
+
+# Returns the pool's connections; the workers stay up so a restarted
+# Application in the supervisor loop can reconnect on demand.
+close = _awaitable(backend.close_db)
@@ -0,0 +1,97 @@
+"""
+One-off job for files saved before uploads were deduplicated on Telegram's
+file_unique_id: looks each one's id up with the Bot API's getFile, records
+it, and collapses each user's duplicates into one file (tags merged, the
+earliest upload date kept).
+
+    python backfill_unique_ids.py
+    python backfill_unique_ids.py --batch-size 500 --concurrency 4
+
+Files are walked oldest first in batches, each written in one transaction,
+so the job can be stopped and re-run at any time. Files getFile can't
+return (deleted, or larger than the Bot API's 20 MB download limit) keep no
+file_unique_id and are skipped. The bot can keep running meanwhile, but
+restart it afterwards: the tag counts in its in-memory tag index don't see
+the collapsed files.
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+
+import async_database as db
+from config import TELEGRAM_TOKEN
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+async def _file_unique_id(bot, semaphore, file_id):
+    """The file's file_unique_id from getFile, or None if Telegram can't return the file."""
+    async with semaphore:
+        while True:
+            try:
+                return (await bot.get_file(file_id)).file_unique_id
+            except RetryAfter as exc:
+                retry_after = exc.retry_after
+                await asyncio.sleep(retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after))
+            except TelegramError as exc:
+                logger.warning("getFile failed for %s: %s", file_id, exc)
+                return None
+
+
+async def backfill(bot, batch_size, concurrency):
+    """Runs the backfill to the end. Returns (files looked up, ids recorded, files collapsed)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    looked_up = recorded = collapsed = 0
+    after = None
+    while True:
+        batch = await db.get_files_without_unique_id(batch_size, after)
+        if batch is None:
+            raise SystemExit("Reading files failed; see the log. Re-run to continue.")
+        if not batch:
+            return looked_up, recorded, collapsed
+        unique_ids = await asyncio.gather(*(_file_unique_id(bot, semaphore, file_id) for _, file_id, _ in batch))
+        assignments = [
+            (user_id, file_id, file_unique_id)
+            for (_, file_id, user_id), file_unique_id in zip(batch, unique_ids)
+            if file_unique_id
+        ]
+        batch_collapsed = await db.assign_file_unique_ids(assignments)
+        if batch_collapsed is None:
+            raise SystemExit("Writing a batch failed; see the log. Re-run to continue.")
+        looked_up += len(batch)
+        recorded += len(assignments)
+        collapsed += batch_collapsed
+        # Skipped files stay NULL, so the next batch starts after this one's last key
+        after = batch[-1][:2]
+        logger.info("%s files looked up, %s ids recorded, %s duplicates collapsed", looked_up, recorded, collapsed)
+
+
+async def main(args):
+    if not TELEGRAM_TOKEN:
+        raise SystemExit("TELEGRAM_TOKEN is missing")
+    await db.init_db()
+    try:
+        async with Bot(TELEGRAM_TOKEN) as bot:
+            start = time.perf_counter()
+            looked_up, recorded, collapsed = await backfill(bot, args.batch_size, args.concurrency)
+            logger.info(
+                "Done in %.0fs: %s files looked up, %s ids recorded (%s skipped), %s duplicates collapsed",
+                time.perf_counter() - start, looked_up, recorded, looked_up - recorded, collapsed,
+            )
+    finally:
+        # Also flushes the users' upload counters for the collapsed files
+        await db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=200, help="files per transaction (default 200)")
+    parser.add_argument("--concurrency", type=int, default=8, help="getFile calls in flight (default 8)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,367 @@
+"""
+Database benchmark: seeds a database with skewed synthetic data and measures
+latency percentiles and throughput of the storage backend's query functions
+(database.py for Postgres, sqlite_storage.py for a sqlite: URL).
+
+    DATABASE_URL=postgresql://localhost/backupthing_bench python benchmarks/db_bench.py
+    DATABASE_URL=sqlite:///tmp/backupthing_bench.db python benchmarks/db_bench.py   # no server needed
+    python benchmarks/db_bench.py --power-files 20000 --iterations 100   # quicker run
+    python benchmarks/db_bench.py --compare benchmarks/results/before.json
+
+Run it against a scratch database: the schema is migrated as at bot startup,
+and benchmark users (ids from BENCH_USER_BASE up) are deleted and re-seeded
+unless --skip-seed is given. Results are printed and saved as JSON.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import string
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402  (needs the path above)
+import tag_index  # noqa: E402
+
+db = storage.get_backend()
+
+# Benchmark users get ids far above real Telegram user ids
+BENCH_USER_BASE = 10**12
+SEED_BATCH_SIZE = 1000
+
+_WORDS = (
+    "report invoice scan photo trip budget notes draft final contract slides "
+    "meeting receipt backup archive family project design spec plan review "
+    "summary letter resume thesis chapter lecture recording demo release"
+).split()
+# (extension, mime type, telegram category), weighted towards documents and photos
+_FILE_KINDS = [
+    (("pdf", "application/pdf", "document"), 30),
+    (("jpg", "image/jpeg", "photo"), 30),
+    (("mp4", "video/mp4", "video"), 10),
+    (("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", "document"), 10),
+    (("mp3", "audio/mpeg", "audio"), 8),
+    (("zip", "application/zip", "document"), 7),
+    (("txt", "text/plain", "document"), 5),
+]
+
+
+class DataGenerator:
+    """
+    Synthetic users, files and tags with the skew real usage has: tag
+    popularity follows a Zipf-like long tail, the number of tags per file is
+    skewed towards a few, and a handful of power users own most files.
+    """
+
+    def __init__(self, seed, tag_vocabulary, max_tags_per_file):
+        self.random = random.Random(seed)
+        self.tags = [f"tag{rank}" for rank in range(tag_vocabulary)]
+        self.tag_weights = [1 / (rank + 1) ** 1.1 for rank in range(tag_vocabulary)]
+        self.tags_per_file = list(range(1, max_tags_per_file + 1))
+        self.tags_per_file_weights = [1 / n for n in self.tags_per_file]
+        self.kinds = [kind for kind, _ in _FILE_KINDS]
+        self.kind_weights = [weight for _, weight in _FILE_KINDS]
+        self._file_counter = 0
+
+    def file_tags(self):
+        count = self.random.choices(self.tags_per_file, self.tags_per_file_weights)[0]
+        return list(dict.fromkeys(self.random.choices(self.tags, self.tag_weights, k=count)))
+
+    def upload(self):
+        self._file_counter += 1
+        extension, mime_type, category = self.random.choices(self.kinds, self.kind_weights)[0]
+        name = " ".join(self.random.sample(_WORDS, 2)) + f" {self._file_counter}"
+        tags = self.file_tags()
+        file_id = "BENCH" + "".join(self.random.choices(string.ascii_letters + string.digits, k=40))
+        caption = f"{name} #" + " ".join(tags)
+        return (file_id, f"{name}.{extension}", extension, mime_type, category, caption, tags, "U" + file_id)
+
+    def user_file_counts(self, power_users, power_files, users, mean_files):
+        """Files per user: `power_users` with about `power_files` each, then a log-normal long tail."""
+        counts = [int(power_files * self.random.uniform(0.8, 1.2)) for _ in range(power_users)]
+        sigma = 1.2
+        mu = max(0.0, math.log(mean_files) - sigma ** 2 / 2)
+        counts += [max(1, int(self.random.lognormvariate(mu, sigma))) for _ in range(users)]
+        return counts
+
+
+def _bench_user_ids(count):
+    return [BENCH_USER_BASE + i for i in range(count)]
+
+
+def reset_bench_users():
+    """
+    Deletes every benchmark user's rows; file_tags go with their files. The
+    id bound is inlined so the statements run on every backend's paramstyle.
+    """
+    conn = db.get_db_connection()
+    if conn is None:
+        raise SystemExit("Database unavailable; check DATABASE_URL")
+    try:
+        cur = conn.cursor()
+        for table in ("files", "user_tags", "users"):
+            cur.execute(f"DELETE FROM {table} WHERE user_id >= {int(BENCH_USER_BASE)}")
+        conn.commit()
+        cur.close()
+    finally:
+        db.put_db_connection(conn)
+
+
+def seed(generator, file_counts):
+    """Seeds one user per entry of `file_counts` through save_uploads, in batches."""
+    total = sum(file_counts)
+    print(f"Seeding {len(file_counts)} users with {total} files...", flush=True)
+    start = time.perf_counter()
+    for user_id, count in zip(_bench_user_ids(len(file_counts)), file_counts):
+        db.add_user(user_id, f"bench{user_id - BENCH_USER_BASE}")
+        for offset in range(0, count, SEED_BATCH_SIZE):
+            batch = [generator.upload() for _ in range(min(SEED_BATCH_SIZE, count - offset))]
+            if db.save_uploads(user_id, batch) is None:
+                raise SystemExit(f"Seeding failed for user {user_id}")
+    elapsed = time.perf_counter() - start
+    print(f"Seeded in {elapsed:.1f}s ({total / elapsed:.0f} files/s)", flush=True)
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(name, operation, iterations, threads):
+    """
+    Calls `operation(i)` `iterations` times on `threads` threads and returns
+    latency percentiles (milliseconds) and throughput (operations/second).
+    """
+    def timed(i):
+        start = time.perf_counter()
+        operation(i)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            latencies = list(pool.map(timed, range(iterations)))
+    else:
+        latencies = [timed(i) for i in range(iterations)]
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = {
+        "iterations": iterations,
+        "threads": threads,
+        "throughput_ops": round(iterations / elapsed, 2),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "p50_ms": round(_percentile(latencies, 0.50), 3),
+        "p90_ms": round(_percentile(latencies, 0.90), 3),
+        "p99_ms": round(_percentile(latencies, 0.99), 3),
+        "max_ms": round(latencies[-1], 3),
+    }
+    print(f"{name:<40} p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  {result['throughput_ops']:>9.1f} ops/s", flush=True)
+    return result
+
+
+def run_benchmarks(generator, file_counts, iterations, threads):
+    power_user = BENCH_USER_BASE  # the first power user
+    power_count = file_counts[0]
+    tail_users = _bench_user_ids(len(file_counts))[1:] or [power_user]
+    rng = random.Random(7)
+    common_tag = generator.tags[0]
+    rare_tag = generator.tags[len(generator.tags) // 2]
+    results = {}
+
+    def cold(function):
+        # Measure the database, not the search cache (only the Postgres backend has one)
+        search_cache = getattr(db, "search_cache", None)
+
+        def call(*args, **kwargs):
+            if search_cache is not None:
+                search_cache.clear()
+            return function(*args, **kwargs)
+        return call
+
+    results["add_file"] = measure(
+        "add_file", lambda i: db.add_file(power_user, *generator.upload()[:7]), iterations, threads
+    )
+    results["save_upload"] = measure(
+        "save_upload", lambda i: db.save_upload(rng.choice(tail_users), *generator.upload()), iterations, threads
+    )
+    # Re-sending a file the user already has only merges its tags into the existing row
+    resent = generator.upload()
+    db.save_upload(tail_users[0], *resent)
+    results["save_upload[duplicate]"] = measure(
+        "save_upload duplicate",
+        lambda i: db.save_upload(tail_users[0], *resent[:6], generator.file_tags(), resent[7]),
+        iterations,
+        threads,
+    )
+
+    searches = {
+        "common_tag": f"#{common_tag}",
+        "rare_tag": f"#{rare_tag}",
+        "name": "invoice",
+        "extension": "pdf",
+        "ext_predicate": "ext:pdf",
+        "tag_and_term": f"#{common_tag} invoice",
+    }
+    for label, query in searches.items():
+        results[f"find_files[{label},limit=5]"] = measure(
+            f"find_files {label} limit=5", lambda i: cold(db.find_files)(power_user, query, limit=5), iterations, threads
+        )
+        results[f"find_files[{label},no_limit]"] = measure(
+            f"find_files {label} no limit", lambda i: cold(db.find_files)(power_user, query), max(1, iterations // 5), threads
+        )
+    results["find_files[common_tag,cached_next_page]"] = measure(
+        "find_files common_tag cached page",
+        lambda i: db.find_files(power_user, searches["common_tag"], limit=5, offset=5 * (i % 20)),
+        iterations,
+        threads,
+    )
+
+    for offset in (0, 1000, power_count // 2, max(0, power_count - 5)):
+        results[f"get_recent_files[offset={offset}]"] = measure(
+            f"get_recent_files offset={offset}",
+            lambda i, offset=offset: db.get_recent_files(power_user, limit=5, offset=offset),
+            iterations,
+            threads,
+        )
+    deep_page = db.get_recent_files(power_user, limit=5, offset=max(0, power_count - 10))
+    if deep_page:
+        last = deep_page[-1]
+        results["get_recent_files[keyset_deep]"] = measure(
+            "get_recent_files keyset deep",
+            lambda i: db.get_recent_files(power_user, limit=5, after=(last[4], last[0])),
+            iterations,
+            threads,
+        )
+
+    results["get_all_tags[power_user]"] = measure(
+        "get_all_tags power user", lambda i: db.get_all_tags(power_user), iterations, threads
+    )
+    results["get_all_tags[tail_user]"] = measure(
+        "get_all_tags tail user", lambda i: db.get_all_tags(rng.choice(tail_users)), iterations, threads
+    )
+    results["get_tag_counts[power_user]"] = measure(
+        "get_tag_counts power user", lambda i: db.get_tag_counts(power_user), iterations, threads
+    )
+    # What /tags <prefix> and inline tag autocomplete cost once the user's tag index is loaded
+    power_tags = tag_index.UserTags(db.get_tag_counts(power_user) or [])
+    results["tag_index_prefix[power_user]"] = measure(
+        "tag_index prefix power user",
+        lambda i: power_tags.complete(rng.choice(string.ascii_lowercase), 50),
+        iterations,
+        threads,
+    )
+
+    sample = db.get_recent_files(power_user, limit=min(iterations, 500))
+    sample_ids = [row[0] for row in sample]
+    if sample_ids:
+        results["update_file_metadata[add_tags]"] = measure(
+            "update_file_metadata add tags",
+            lambda i: db.update_file_metadata(power_user, sample_ids[i % len(sample_ids)], None, generator.file_tags(), "add"),
+            iterations,
+            threads,
+        )
+        results["update_file_metadata[rename+set_tags]"] = measure(
+            "update_file_metadata rename + set tags",
+            lambda i: db.update_file_metadata(power_user, sample_ids[i % len(sample_ids)], f"renamed {i}", generator.file_tags(), "set"),
+            iterations,
+            threads,
+        )
+
+    # Each delete removes one freshly added file, found by its unique name
+    delete_user = tail_users[0]
+    doomed = []
+    for i in range(iterations):
+        upload = list(generator.upload())
+        upload[1] = f"doomed-{i}-{upload[0][-12:]}.txt"
+        doomed.append(upload[1])
+        db.save_upload(delete_user, *upload)
+    results["delete_files[single]"] = measure(
+        "delete_files single file", lambda i: db.delete_files(delete_user, doomed[i]), iterations, threads
+    )
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(previous_path, results):
+    """Prints how each operation's p50/p99 changed against a previous results file."""
+    with open(previous_path) as f:
+        previous = json.load(f)["results"]
+    print(f"\nCompared with {previous_path} (ratio < 1 is faster):")
+    for name, result in results.items():
+        before = previous.get(name)
+        if not before:
+            continue
+        p50 = result["p50_ms"] / before["p50_ms"] if before["p50_ms"] else float("nan")
+        p99 = result["p99_ms"] / before["p99_ms"] if before["p99_ms"] else float("nan")
+        print(f"{name:<40} p50 x{p50:>6.2f}  p99 x{p99:>6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--power-users", type=int, default=3, help="users with very large histories")
+    parser.add_argument("--power-files", type=int, default=100_000, help="approximate files per power user")
+    parser.add_argument("--users", type=int, default=200, help="long-tail users")
+    parser.add_argument("--mean-files", type=int, default=50, help="mean files per long-tail user")
+    parser.add_argument("--tag-vocabulary", type=int, default=5000)
+    parser.add_argument("--max-tags-per-file", type=int, default=12)
+    parser.add_argument("--iterations", type=int, default=300, help="calls per measured operation")
+    parser.add_argument("--threads", type=int, default=1, help="concurrent callers (keep <= DB_POOL_MAX)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the generated data")
+    parser.add_argument("--skip-seed", action="store_true", help="reuse data from a previous run with the same arguments")
+    parser.add_argument("--out", help="results file (default: benchmarks/results/db_bench-<time>.json)")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    args = parser.parse_args()
+
+    db.init_db()
+    if not db.ping():
+        raise SystemExit("Database unavailable; check DATABASE_URL")
+
+    generator = DataGenerator(args.seed, args.tag_vocabulary, args.max_tags_per_file)
+    file_counts = generator.user_file_counts(args.power_users, args.power_files, args.users, args.mean_files)
+    if not args.skip_seed:
+        reset_bench_users()
+        seed(generator, file_counts)
+
+    results = run_benchmarks(generator, file_counts, args.iterations, args.threads)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": _git_commit(),
+            "args": vars(args),
+            "seeded_files": sum(file_counts),
+        },
+        "results": results,
+    }
+    out = args.out or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", f"db_bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {out}")
+
+    if args.compare:
+        compare(args.compare, results)
+    db.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+End-to-end load harness: drives the real bot.py handlers with synthetic
+Updates against a fake Bot API, and reports updates/second plus per-handler
+and per-action latency.
+
+    DATABASE_URL=postgresql://localhost/backupthing_bench python benchmarks/load_harness.py
+    DATABASE_URL=sqlite:///tmp/backupthing_load.db python benchmarks/load_harness.py
+    python benchmarks/load_harness.py --users 200 --updates-per-user 20 --api-latency 0.05 --flood-rate 0.01
+    python benchmarks/load_harness.py --no-send-limits   # measure the bot, not Telegram's rate limits
+
+Each simulated user is a closed loop: it sends an update (upload, search,
+/files, Next page, /edit, /delete + confirm), waits until the bot has
+finished handling it, optionally thinks, then sends the next one. The
+Application is the one bot.main() runs (handlers, per-user update
+processor, send scheduler); only the HTTP client is replaced, by a fake
+that answers every Bot API method after a simulated latency and answers a
+fraction of sends with 429 Too Many Requests.
+
+Run it against a scratch database: load-test users (ids from
+LOAD_USER_BASE up) are deleted before the run.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot  # noqa: E402
+import storage  # noqa: E402
+import instrumentation  # noqa: E402
+from send_scheduler import SendScheduler  # noqa: E402
+
+# Load-test users get ids far above real Telegram user ids (and the db_bench ones)
+LOAD_USER_BASE = 2 * 10**12
+FAKE_TOKEN = "123456:LOAD-HARNESS"
+_FAKE_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "BackupThing", "username": "backupthing_load_bot"}
+
+_SEARCH_TERMS = ["invoice", "report", "pdf", "#work", "#travel", "scan", "2024", "notes"]
+_TAGS = ["work", "travel", "family", "receipts", "school", "projectx", "taxes", "photos"]
+
+
+class FakeBotAPI(BaseRequest):
+    """
+    Stands in for the HTTP client: answers every Bot API method locally after
+    `latency` (+/- `jitter`) seconds, records calls per method and, with
+    probability `flood_rate`, answers a send or edit with 429 and
+    `retry_after` like Telegram's flood control.
+    """
+
+    def __init__(self, latency=0.03, jitter=0.01, flood_rate=0.0, retry_after=1, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.floods = 0
+        self.keyboards = {}  # chat_id -> {button text: callback_data} of the last keyboard sent there
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.json_parameters if request_data is not None else {}
+
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        if delay:
+            await asyncio.sleep(delay)
+
+        if (endpoint.startswith(("send", "edit"))) and self.random.random() < self.flood_rate:
+            self.floods += 1
+            return 429, json.dumps({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }).encode()
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _message(self, chat_id, **fields):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": _FAKE_BOT_USER,
+            **fields,
+        }
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return _FAKE_BOT_USER
+        chat_id = params.get("chat_id", 0)
+        if "reply_markup" in params:
+            markup = json.loads(params["reply_markup"])
+            self.keyboards[int(chat_id)] = {
+                button["text"]: button.get("callback_data")
+                for row in markup.get("inline_keyboard", [])
+                for button in row
+            }
+        if endpoint == "sendMediaGroup":
+            return [self._message(chat_id) for _ in json.loads(params["media"])]
+        if endpoint.startswith("send") or endpoint.startswith("edit"):
+            return self._message(chat_id, text=params.get("text", ""))
+        return True
+
+
+class SimulatedUser:
+    """Picks a plausible next action for one user and builds its Update."""
+
+    def __init__(self, user_id, rng):
+        self.user_id = user_id
+        self.random = rng
+        self.file_names = []
+        self.uploads = 0
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"load{self.user_id - LOAD_USER_BASE}"}
+
+    def _message(self, **fields):
+        return {
+            "message_id": self.random.randint(1, 2**31),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self._user(),
+            **fields,
+        }
+
+    def _command(self, text):
+        command = text.split()[0]
+        return {"message": self._message(text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])}
+
+    def upload(self):
+        self.uploads += 1
+        # The "-x" suffix keeps "doc-1-1-x" from matching "doc-1-10-x" in searches
+        name = f"doc-{self.user_id - LOAD_USER_BASE}-{self.uploads}-x"
+        self.file_names.append(name)
+        tags = self.random.sample(_TAGS, self.random.randint(1, 3))
+        return {"message": self._message(
+            document={
+                "file_id": f"LOAD{self.user_id}_{self.uploads}",
+                "file_unique_id": f"U{self.user_id}_{self.uploads}",
+                "file_name": f"{name}.pdf",
+                "mime_type": "application/pdf",
+            },
+            caption=f"{name} #" + " ".join(tags),
+        )}
+
+    def search(self):
+        return {"message": self._message(text=self.random.choice(_SEARCH_TERMS))}
+
+    def files(self):
+        return self._command("/files")
+
+    def edit(self):
+        name = self.random.choice(self.file_names)
+        return self._command(f"/edit {name} tags:add {self.random.choice(_TAGS)}")
+
+    def delete(self):
+        name = self.file_names.pop(self.random.randrange(len(self.file_names)))
+        return self._command(f"/delete {name}")
+
+    def press(self, callback_data):
+        return {"callback_query": {
+            "id": str(self.random.randint(1, 2**62)),
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "data": callback_data,
+            "message": self._message(text="keyboard"),
+        }}
+
+
+class UpdateTracker:
+    """Resolves a future when the bot has finished handling an update."""
+
+    def __init__(self):
+        self._pending = {}
+        self._update_ids = itertools.count(1)
+
+    def next_id(self):
+        return next(self._update_ids)
+
+    def expect(self, update_id):
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update_id] = future
+        return future
+
+    async def done(self, update, context):
+        # Registered in a group after the bot's handlers, so it runs once they are finished
+        future = self._pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+
+async def _send(application, tracker, payload):
+    update_id = tracker.next_id()
+    update = Update.de_json({"update_id": update_id, **payload}, application.bot)
+    application.bot.insert_callback_data(update)
+    finished = tracker.expect(update_id)
+    await application.update_queue.put(update)
+    await finished
+
+
+async def run_user(application, tracker, fake_api, user, updates, think_time, latencies):
+    rng = user.random
+    for _ in range(updates):
+        keyboard = fake_api.keyboards.get(user.user_id, {})
+        choices = [("upload", 30), ("search", 25), ("files", 15)]
+        if keyboard.get("Next"):
+            choices.append(("next_page", 10))
+        if user.file_names:
+            choices += [("edit", 10), ("delete", 10)]
+        action = rng.choices([name for name, _ in choices], [weight for _, weight in choices])[0]
+
+        start = time.perf_counter()
+        if action == "next_page":
+            await _send(application, tracker, user.press(keyboard["Next"]))
+        elif action == "delete":
+            await _send(application, tracker, user.delete())
+            confirm = fake_api.keyboards.get(user.user_id, {}).get("Confirm Delete")
+            if confirm:
+                await _send(application, tracker, user.press(confirm))
+        else:
+            await _send(application, tracker, getattr(user, action)())
+        latencies.setdefault(action, []).append(time.perf_counter() - start)
+
+        if think_time:
+            await asyncio.sleep(rng.expovariate(1 / think_time))
+
+
+class _RecordCollector:
+    """Instrumentation sink that keeps every top-level handler call record."""
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, record):
+        if record.parent is None:
+            self.records.append(record)
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def pick(fraction):
+        return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))] * 1000
+
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+        "p50_ms": round(pick(0.50), 3),
+        "p90_ms": round(pick(0.90), 3),
+        "p99_ms": round(pick(0.99), 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def reset_load_users():
+    backend = storage.get_backend()
+    conn = backend.get_db_connection()
+    if conn is None:
+        raise SystemExit("Database unavailable; check DATABASE_URL")
+    try:
+        cur = conn.cursor()
+        # The id bound is inlined so this runs on every backend's paramstyle
+        for table in ("files", "user_tags", "users"):
+            cur.execute(f"DELETE FROM {table} WHERE user_id >= {int(LOAD_USER_BASE)}")
+        conn.commit()
+        cur.close()
+    finally:
+        backend.put_db_connection(conn)
+
+
+async def run(args):
+    fake_api = FakeBotAPI(args.api_latency, args.api_jitter, args.flood_rate, args.retry_after, args.seed)
+    rate_limiter = None
+    if args.no_send_limits:
+        rate_limiter = SendScheduler(global_rate=1e9, private_chat_rate=1e9, group_chat_rate=1e9, chat_burst=1e9)
+    application = bot.build_application(
+        token=FAKE_TOKEN, request=fake_api, rate_limiter=rate_limiter, max_concurrent_updates=args.concurrency
+    )
+    tracker = UpdateTracker()
+    application.add_handler(TypeHandler(Update, tracker.done), group=1)
+
+    collector = _RecordCollector()
+    instrumentation.add_sink(collector)
+    await application.initialize()
+    await application.post_init(application)
+    reset_load_users()
+    await application.start()
+
+    rng = random.Random(args.seed)
+    users = [SimulatedUser(LOAD_USER_BASE + i, random.Random(rng.random())) for i in range(args.users)]
+    latencies = {}
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            run_user(application, tracker, fake_api, user, args.updates_per_user, args.think_time, latencies)
+            for user in users
+        ))
+        elapsed = time.perf_counter() - start
+        scheduler_stats = application.bot.rate_limiter.stats()
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        instrumentation.remove_sink(collector)
+
+    handlers = {}
+    for record in collector.records:
+        handlers.setdefault(record.handler, []).append(record)
+    handler_stats = {}
+    for handler, records in sorted(handlers.items()):
+        stats = _percentiles([r.wall_time for r in records])
+        stats["failures"] = sum(1 for r in records if not r.ok)
+        stats["mean_db_ms"] = round(statistics.fmean(r.db_time for r in records) * 1000, 3)
+        stats["mean_api_ms"] = round(statistics.fmean(r.api_time for r in records) * 1000, 3)
+        handler_stats[handler] = stats
+
+    total_updates = tracker.next_id() - 1
+    return {
+        "updates": total_updates,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total_updates / elapsed, 2),
+        "actions": {action: _percentiles(values) for action, values in sorted(latencies.items())},
+        "handlers": handler_stats,
+        "bot_api_calls": dict(fake_api.calls),
+        "injected_429s": fake_api.floods,
+        "send_scheduler": scheduler_stats,
+    }
+
+
+def _print_report(report):
+    print(f"\n{report['updates']} updates in {report['elapsed_s']}s: {report['updates_per_s']} updates/s")
+    print(f"Injected 429s: {report['injected_429s']}; send scheduler: {report['send_scheduler']}")
+    print("\nPer action (as seen by the user, including the send scheduler's pacing):")
+    for action, stats in report["actions"].items():
+        print(f"  {action:<12} n={stats['count']:<6} p50 {stats['p50_ms']:>9.1f} ms  p99 {stats['p99_ms']:>9.1f} ms")
+    print("\nPer handler (wall / mean DB / mean Bot API):")
+    for handler, stats in report["handlers"].items():
+        print(
+            f"  {handler:<22} n={stats['count']:<6} p50 {stats['p50_ms']:>9.1f} ms  p99 {stats['p99_ms']:>9.1f} ms"
+            f"  db {stats['mean_db_ms']:>8.1f} ms  api {stats['mean_api_ms']:>8.1f} ms  failures {stats['failures']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="simulated users, each a closed loop")
+    parser.add_argument("--updates-per-user", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=bot.MAX_CONCURRENT_UPDATES, help="updates handled in parallel")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds a user waits between updates")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="simulated Bot API latency in seconds")
+    parser.add_argument("--api-jitter", type=float, default=0.01)
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of injected 429s (seconds, at least 1)")
+    parser.add_argument("--no-send-limits", action="store_true", help="disable the send scheduler's rate limits")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="results file (default: benchmarks/results/load-<time>.json)")
+    args = parser.parse_args()
+    if args.retry_after < 1:
+        # The Bot API never sends retry_after=0, and PTB treats it as a malformed reply
+        parser.error("--retry-after must be at least 1")
+
+    report = asyncio.run(run(args))
+    report = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "args": vars(args)}, **report}
+    _print_report(report)
+
+    out = args.out or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", f"load-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {out}")
+
+
+if __name__ == "__main__":
+    main()
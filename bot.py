@@ -1,6 +1,23 @@
+import asyncio
+import functools
+import hashlib
 import logging
+import signal
 import time
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from typing import NamedTuple, Optional
+from telegram import (
+    Update,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    InlineQueryResultCachedAudio,
+    InlineQueryResultCachedDocument,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
+)
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -8,9 +25,30 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
+    InlineQueryHandler,
+    InvalidCallbackData,
+)
+from config import (
+    TELEGRAM_TOKEN,
+    ADMIN_ID,
+    MAX_CONCURRENT_UPDATES,
+    HOST,
+    PORT,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_REGISTER,
 )
-from config import TELEGRAM_TOKEN
-import database as db
+import async_database as db
+import instrumentation
+from query_log import slow_queries
+import inline_search
+import search_query
+import tag_index
+from storage import StorageUnavailable
+from metrics import LoopLagMonitor
+from send_scheduler import BULK, SendScheduler, send_priority
+from update_processor import PerUserUpdateProcessor
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -19,16 +57,39 @@ logger = logging.getLogger(__name__)
 
 
 def resilient(func):
+    """
+    Keeps a failing handler from taking the bot down, and records every call
+    (wall, DB and Bot API time, outcome) with the instrumentation sinks.
+    """
+    @functools.wraps(func)
     async def wrapper(*args, **kwargs):
-        try:
-            return await func(*args, **kwargs)
-        except Exception:
-            logger.exception("Unhandled exception in handler; continuing")
-            # Do not re-raise; keep bot running
-            return None
+        with instrumentation.record_call(func.__name__, args) as call:
+            try:
+                return await func(*args, **kwargs)
+            except StorageUnavailable as exc:
+                call.fail(exc)
+                logger.error("%s: %s", func.__name__, exc)
+                await _report_storage_unavailable(args[0] if args else None)
+                return None
+            except Exception as exc:
+                call.fail(exc)
+                logger.exception("Unhandled exception in handler; continuing")
+                # Do not re-raise; keep bot running
+                return None
     return wrapper
 
 
+async def _report_storage_unavailable(update) -> None:
+    # Tell the user instead of answering as if they had no files
+    message = getattr(update, "effective_message", None)
+    if message is None:
+        return
+    try:
+        await message.reply_text("Storage is temporarily unavailable. Please try again in a minute.")
+    except Exception:
+        logger.exception("Could not report storage outage to the user")
+
+
 @resilient
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -38,7 +99,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
-    db.add_user(user_id, username)  # Add user to the database if not already present
+    await db.add_user(user_id, username)  # Add user to the database if not already present
 
     # Define inline keyboard buttons for main actions
     keyboard = [
@@ -68,35 +129,32 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/start - Show main menu\n"
         "/upload - Instructions for uploading files with tags\n"
         "/search [query] - Initiate a search based on tags, filename, or extension\n"
+        "  Queries: `report` (anywhere), `#tag`, `ext:pdf`, `type:photo`, `name:draft`, "
+        "`\"two words\"`; terms must all match unless joined with OR; `-term` or NOT excludes; "
+        "( ) groups. E.g. `image #vacation`, `#work ext:pdf -draft`\n"
         "/files - List recently uploaded files by the current user\n"
-        "/tags - List all unique tags associated with your files\n"
+        "/tags [prefix] - List your tags (those starting with prefix) and how many files have each\n"
         "/delete [query] - Delete files by name or tag\n"
         "/edit <file_query> [name:new_name] [tags:[add|remove|set] tag1 tag2 ...] - Edit file name and/or tags\n"
         "To upload a file, send it with a caption like: `My important document #work projectX`"
     )
 
 
-@resilient
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def _describe_file(message):
     """
-    Handles incoming files (documents, photos, videos, audio).
-    Extracts file information, parses caption for file name and tags,
-    stores metadata in the database, and records user activity.
+    Extracts (file_id, file_name, file_extension, file_type, telegram_file_category,
+    file_unique_id) from a message carrying a document, photo, video or audio
+    file. Returns None for any other message. file_unique_id is the same
+    whenever the same file is sent again, which is what uploads are
+    deduplicated on.
     """
-    user_id = update.effective_user.id
-    message = update.message
-    file_id = None
-    file_name = None
-    file_type = None
     file_extension = None
 
-    # Stores the Telegram-specific category (document, photo, video, audio)
+    # telegram_file_category is the Telegram-specific category (document, photo, video, audio).
     # This is crucial for sending the file back using the correct Telegram API method.
-    telegram_file_category = None
-
-    # Determine file type and extract relevant information
     if message.document:
         file_id = message.document.file_id
+        file_unique_id = message.document.file_unique_id
         file_name = message.document.file_name
         file_type = message.document.mime_type
         telegram_file_category = "document"
@@ -105,18 +163,21 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     elif message.photo:
         # For photos, Telegram provides multiple sizes; we take the largest one
         file_id = message.photo[-1].file_id
+        file_unique_id = message.photo[-1].file_unique_id
         file_name = f"photo_{message.date.strftime('%Y%m%d_%H%M%S')}.jpg"
         file_type = "image/jpeg"
         telegram_file_category = "photo"
         file_extension = "jpg"
     elif message.video:
         file_id = message.video.file_id
+        file_unique_id = message.video.file_unique_id
         file_name = f"video_{message.date.strftime('%Y%m%d_%H%M%S')}.mp4"
         file_type = "video/mp4"
         telegram_file_category = "video"
         file_extension = "mp4"
     elif message.audio:
         file_id = message.audio.file_id
+        file_unique_id = message.audio.file_unique_id
         file_name = (
             message.audio.file_name
             or f"audio_{message.date.strftime('%Y%m%d_%H%M%S')}.mp3"
@@ -128,54 +189,316 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         else:
             file_extension = "mp3"  # Default for audio if no extension in name
     else:
+        return None
+    return file_id, file_name, file_extension, file_type, telegram_file_category, file_unique_id
+
+
+def _parse_caption(caption):
+    """
+    Splits a caption into the user-provided file name and tags.
+    The part before the first '#' is the name; the rest are space-separated
+    tags, each with or without its own '#' ("#work #projectX" and
+    "#work projectX" give the same tags).
+    """
+    caption_parts = caption.split("#", 1)
+    user_provided_name = caption_parts[0].strip()
+
+    tags = []
+    # If there's a part after '#', extract tags from it
+    if len(caption_parts) > 1:
+        tags = [tag.lstrip("#") for tag in caption_parts[1].split()]
+        tags = [tag for tag in tags if tag]
+    return user_provided_name, tags
+
+
+def _files_changed(user_id) -> None:
+    """Drops in-memory state derived from a user's files after a successful write."""
+    inline_search.invalidate(user_id)
+
+
+@resilient
+async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles incoming files (documents, photos, videos, audio).
+    Extracts file information, parses caption for file name and tags,
+    stores metadata in the database, and records user activity.
+    Files that are part of an album are buffered and saved together.
+    """
+    user_id = update.effective_user.id
+    message = update.message
+
+    file_info = _describe_file(message)
+    if file_info is None:
         # Reply if the uploaded file type is not supported
         await message.reply_text(
             "Unsupported file type. Please upload a document, photo, video, or audio."
         )
         return
 
+    if message.media_group_id:
+        _buffer_album_item(context, user_id, message, file_info)
+        return
+
+    file_id, file_name, file_extension, file_type, telegram_file_category, file_unique_id = file_info
     caption = message.caption or ""
-    
-    # Split caption into potential file name and tags.
-    # The part before the first '#' is considered the user-provided file name.
-    caption_parts = caption.split("#", 1)
-    user_provided_name = caption_parts[0].strip()
-    
+    user_provided_name, tags = _parse_caption(caption)
+
     # If a user-provided name exists, use it; otherwise, keep the default file_name
     if user_provided_name:
         file_name = user_provided_name
-    
-    tags = []
-    # If there's a part after '#', extract tags from it
-    if len(caption_parts) > 1:
-        # Tags are space-separated after the first '#'
-        tags = [tag.strip() for tag in caption_parts[1].split() if tag.strip()]
 
-    # Add file metadata to the database
-    db.add_file(user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags)
-    db.record_upload(user_id)  # Record the upload for user statistics
-    db.record_tag_usage(user_id, len(tags))  # Record tag usage
-    
+    # Store the file and its tags in one transaction (the user's counters follow, see activity.py);
+    # a file the user already has only gets the new tags
+    duplicates = await db.save_upload(user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id)
+    if duplicates is None:
+        await message.reply_text(f"Sorry, '{file_name}' could not be saved. Please try again later.")
+        return
+    _files_changed(user_id)
+
     # Confirm file saving to the user
-    await message.reply_text(f"File '{file_name}' saved with tags: {', '.join(tags)}")
+    if duplicates:
+        reply = "This file is already in your backup, so it wasn't stored again."
+        if tags:
+            reply += " Any of the caption's tags it didn't have yet were added to it."
+        await message.reply_text(reply)
+    else:
+        await message.reply_text(f"File '{file_name}' saved with tags: {', '.join(tags)}")
+
+
+# Telegram delivers an album as one update per item, all sharing a
+# media_group_id and arriving within a fraction of a second. Items are
+# buffered until no new one has arrived for ALBUM_FLUSH_DELAY seconds, then
+# saved in one batch with a single reply.
+ALBUM_FLUSH_DELAY = 1.5
+
+# (user_id, media_group_id) -> _PendingAlbum
+_pending_albums = {}
+
+
+class _PendingAlbum:
+    def __init__(self, message):
+        self.message = message  # first item; the summary replies to it
+        self.items = []  # (file_info, caption)
+        self.deadline = 0.0
+
+
+def _buffer_album_item(context, user_id, message, file_info):
+    key = (user_id, message.media_group_id)
+    album = _pending_albums.get(key)
+    if album is None:
+        album = _pending_albums[key] = _PendingAlbum(message)
+        context.application.create_task(_flush_album(context.application, key), name=f"album:{key[1]}")
+    album.items.append((file_info, message.caption or ""))
+    album.deadline = asyncio.get_running_loop().time() + ALBUM_FLUSH_DELAY
+
+
+@resilient
+async def _flush_album(application, key) -> None:
+    """
+    Waits for an album to stop growing, then saves all of its items at once.
+    Runs outside update processing, so it takes the user's lock itself to stay
+    ordered with the user's other updates.
+    """
+    loop = asyncio.get_running_loop()
+    album = _pending_albums[key]
+    try:
+        while (delay := album.deadline - loop.time()) > 0:
+            await asyncio.sleep(delay)
+    finally:
+        del _pending_albums[key]
+    user_id = key[0]
+
+    # Usually only one item carries the caption; its tags apply to the whole album,
+    # while a caption's name only renames the item it was sent with.
+    album_tags = []
+    for _, caption in album.items:
+        album_tags.extend(_parse_caption(caption)[1])
+    album_tags = list(dict.fromkeys(album_tags))
+
+    uploads = []
+    for (file_id, file_name, file_extension, file_type, telegram_file_category, file_unique_id), caption in album.items:
+        user_provided_name = _parse_caption(caption)[0]
+        uploads.append((
+            file_id,
+            user_provided_name or file_name,
+            file_extension,
+            file_type,
+            telegram_file_category,
+            caption,
+            album_tags,
+            file_unique_id,
+        ))
+
+    async with application.update_processor.user_lock(user_id):
+        try:
+            duplicates = await db.save_uploads(user_id, uploads)
+        except StorageUnavailable:
+            # No update to report it on (see resilient); the reply below does
+            duplicates = None
+        if duplicates is None:
+            await album.message.reply_text(f"Sorry, the album of {len(uploads)} files could not be saved. Please try again later.")
+            return
+        _files_changed(user_id)
+        reply = f"Album of {len(uploads)} files saved with tags: {', '.join(album_tags)}"
+        if duplicates:
+            reply += f"\n{duplicates} of them were already in your backup and only got the tags they didn't have yet."
+        await album.message.reply_text(reply)
+
+
+async def _complete_tags(user_id, prefix, limit, offset=0, by_count=False):
+    """
+    ([(tag_name, file count), ...], total) for the user's tags starting with
+    `prefix` (see tag_index.UserTags.complete). Served from the in-memory
+    tag index, which is loaded from the database the first time a user
+    needs it.
+    """
+    result = tag_index.index.complete(user_id, prefix, limit, offset, by_count)
+    if result is not None:
+        return result
+    generation = tag_index.index.generation(user_id)
+    counts = await db.get_tag_counts(user_id)
+    if counts is None:
+        return [], 0
+    tag_index.index.put(user_id, counts, generation)
+    result = tag_index.index.complete(user_id, prefix, limit, offset, by_count)
+    if result is None:
+        # A write raced with the load, or the user has too many tags to keep
+        result = tag_index.UserTags(counts).complete(prefix, limit, offset, by_count)
+    return result
+
+
+TAGS_PAGE_SIZE = 50 # Number of tags to display per /tags page
+
+
+class TagPage(NamedTuple):
+    """Callback data of the /tags Previous/Next buttons."""
+    prefix: str
+    page: int  # 1-based number of the page the button opens
+
+
+async def _tag_page(user_id, prefix, page):
+    """The text and keyboard of one /tags page, or None if it has no tags."""
+    entries, total = await _complete_tags(user_id, prefix, TAGS_PAGE_SIZE, (page - 1) * TAGS_PAGE_SIZE)
+    if not entries:
+        return None
+    pages = (total + TAGS_PAGE_SIZE - 1) // TAGS_PAGE_SIZE
+    title = f"Your tags starting with '{prefix}'" if prefix else "Your tags"
+    text = f"{title} (page {page} of {pages}, {total} tags):\n"
+    text += ", ".join(f"{name} ({count})" for name, count in entries)
+    keyboard = []
+    if page > 1:
+        keyboard.append(InlineKeyboardButton("Previous", callback_data=TagPage(prefix, page - 1)))
+    if page < pages:
+        keyboard.append(InlineKeyboardButton("Next", callback_data=TagPage(prefix, page + 1)))
+    return text[:MAX_MESSAGE_LENGTH], InlineKeyboardMarkup([keyboard])
 
 
 @resilient
 async def list_tags(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Handles the /tags command.
-    Retrieves and displays all unique tags associated with the user's files.
+    Handles the /tags [prefix] command.
+    Lists the user's tags, or those starting with `prefix`, alphabetically
+    with their file counts, one page at a time.
     """
     user_id = update.effective_user.id
-    tags = db.get_all_tags(user_id)  # Fetch all unique tags for the user
-    if tags:
-        await update.message.reply_text(f"Your tags: {', '.join(tags)}")
+    prefix = " ".join(context.args or []).strip().lstrip("#")
+    result = await _tag_page(user_id, prefix, 1)
+    if result is not None:
+        text, reply_markup = result
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    elif prefix:
+        await update.message.reply_text(f"None of your tags start with '{prefix}'.")
     else:
         await update.message.reply_text("You haven't used any tags yet.")
 
 
 PAGE_SIZE = 5 # Number of files to display per page
 
+
+class PageCursor(NamedTuple):
+    """
+    Callback data of the Previous/Next buttons. Telegram limits callback_data
+    to 64 bytes, which a file_id alone can exceed, so the bot is built with
+    arbitrary_callback_data and these objects are kept in its cache.
+    `after` / `before` are the (upload_date, file_id) keys the page starts
+    after / ends before.
+    """
+    kind: str  # "files" or "search"
+    page: int  # 1-based number of the page the button opens
+    after: Optional[tuple] = None
+    before: Optional[tuple] = None
+
+
+def _pagination_buttons(kind, page, files):
+    """Builds the Previous/Next buttons for a page of (file_id, ..., upload_date, tags) rows."""
+    keyboard = []
+    if page > 1:
+        first = files[0]
+        keyboard.append(InlineKeyboardButton("Previous", callback_data=PageCursor(kind, page - 1, before=(first[4], first[0]))))
+    if len(files) == PAGE_SIZE:
+        last = files[-1]
+        keyboard.append(InlineKeyboardButton("Next", callback_data=PageCursor(kind, page + 1, after=(last[4], last[0]))))
+    return keyboard
+
+
+# sendMediaGroup only accepts photos mixed with videos, documents with
+# documents, or audio with audio, and at most MEDIA_GROUP_LIMIT items
+MEDIA_GROUP_LIMIT = 10
+_MEDIA_GROUP_KINDS = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+_INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument, "audio": InputMediaAudio}
+
+
+def _send_category(telegram_file_category, file_type):
+    """The Bot API method family ("photo", "video", "audio" or "document") to send a stored file with."""
+    # Use the stored telegram_file_category to send the file correctly
+    if telegram_file_category in _INPUT_MEDIA:
+        return telegram_file_category
+    # Fallback for older entries or unknown types based on MIME type
+    file_type = file_type or ""
+    if file_type.startswith("image"):
+        return "photo"
+    if file_type.startswith("video"):
+        return "video"
+    if file_type.startswith("audio"):
+        return "audio"
+    return "document"
+
+
+async def _send_file_page(message, files, title, keyboard) -> None:
+    """
+    Sends a page of (file_id, file_name, file_type, telegram_file_category, upload_date, tags)
+    rows back to the user. Compatible files go out together as media groups,
+    so a page costs one Bot API call per group instead of one per file,
+    followed by one message carrying the page title and pagination keyboard.
+    The files go out at BULK priority so other users' replies overtake them.
+    """
+    groups = {}  # media group kind -> [(category, file_id, caption)], in page order
+    for file_id, file_name, file_type, telegram_file_category, _, tags_str in files:
+        caption_text = file_name
+        if tags_str:
+            # Display tags concisely within parentheses
+            caption_text += f" ({tags_str})"
+        category = _send_category(telegram_file_category, file_type)
+        groups.setdefault(_MEDIA_GROUP_KINDS[category], []).append((category, file_id, caption_text))
+
+    with send_priority(BULK):
+        for items in groups.values():
+            for i in range(0, len(items), MEDIA_GROUP_LIMIT):
+                chunk = items[i:i + MEDIA_GROUP_LIMIT]
+                if len(chunk) == 1:
+                    # A media group needs at least two items
+                    category, file_id, caption_text = chunk[0]
+                    send = getattr(message, f"reply_{category}")
+                    await send(file_id, caption=caption_text)
+                else:
+                    await message.reply_media_group(
+                        [_INPUT_MEDIA[category](file_id, caption=caption_text) for category, file_id, caption_text in chunk]
+                    )
+
+    reply_markup = InlineKeyboardMarkup([keyboard]) if keyboard else None
+    await message.reply_text(title, reply_markup=reply_markup)
+
+
 @resilient
 async def files_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -186,52 +509,26 @@ async def files_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     offset = context.args[0] if context.args and context.args[0].isdigit() else 0
     offset = int(offset)
 
-    files = db.get_recent_files(user_id, limit=PAGE_SIZE, offset=offset)  # Fetch recent files from the database with pagination
+    files = await db.get_recent_files(user_id, limit=PAGE_SIZE, offset=offset)  # Fetch recent files from the database with pagination
     
     if files:
-        await update.message.reply_text(f"Your recent files (Page {offset // PAGE_SIZE + 1}):")
-        # Iterate through files and send them back to the user
-        for file_id, file_name, file_type, telegram_file_category, _, tags_str in files:
-            caption_text = file_name
-            if tags_str:
-                # Display tags concisely within parentheses
-                caption_text += f" ({tags_str.replace(', ', ', ')})"
-
-            # Use the stored telegram_file_category to send the file correctly
-            if telegram_file_category == "photo":
-                await update.message.reply_photo(file_id, caption=caption_text)
-            elif telegram_file_category == "video":
-                await update.message.reply_video(file_id, caption=caption_text)
-            elif telegram_file_category == "audio":
-                await update.message.reply_audio(file_id, caption=caption_text)
-            elif telegram_file_category == "document":
-                await update.message.reply_document(file_id, caption=caption_text)
-            else:
-                # Fallback for older entries or unknown types based on MIME type
-                if file_type.startswith("image"):
-                    await update.message.reply_photo(file_id, caption=caption_text)
-                elif file_type.startswith("video"):
-                    await update.message.reply_video(file_id, caption=caption_text)
-                elif file_type.startswith("audio"):
-                    await update.message.reply_audio(file_id, caption=caption_text)
-                else:
-                    await update.message.reply_document(file_id, caption=caption_text)
-        
-        # Add pagination buttons
-        keyboard = []
-        if offset > 0:
-            keyboard.append(InlineKeyboardButton("Previous", callback_data=f"files_page_{offset - PAGE_SIZE}"))
-        if len(files) == PAGE_SIZE:
-            keyboard.append(InlineKeyboardButton("Next", callback_data=f"files_page_{offset + PAGE_SIZE}"))
-        
-        if keyboard:
-            reply_markup = InlineKeyboardMarkup([keyboard])
-            await update.message.reply_text("", reply_markup=reply_markup)
+        keyboard = _pagination_buttons("files", offset // PAGE_SIZE + 1, files)
+        await _send_file_page(update.message, files, f"Your recent files (Page {offset // PAGE_SIZE + 1})", keyboard)
 
     else:
         await update.message.reply_text("You haven't uploaded any files recently.")
 
 
+async def _check_query(message, query) -> bool:
+    """Replies with what is wrong with a search query; returns True if it parses."""
+    try:
+        search_query.parse(query)
+    except search_query.QueryError as exc:
+        await message.reply_text(f"Couldn't read that search: {exc}.")
+        return False
+    return True
+
+
 @resilient
 async def delete_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -245,9 +542,11 @@ async def delete_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             "Please provide a file name or tag to delete. E.g., `/delete report.pdf` or `/delete #old`"
         )
         return
+    if not await _check_query(update.message, query):
+        return
 
     # Find files matching the query
-    files_to_delete = db.find_files(user_id, query)
+    files_to_delete = await db.find_files(user_id, query)
 
     if not files_to_delete:
         await update.message.reply_text(f"No files found matching '{query}'.")
@@ -344,9 +643,11 @@ async def edit_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "Usage: `/edit <file_query> [name:new_name] [tags:[add|remove|set] tag1 tag2 ...]`"
         )
         return
+    if not await _check_query(update.message, file_query):
+        return
 
     # Find files matching the query
-    files = db.find_files(user_id, file_query)
+    files = await db.find_files(user_id, file_query)
 
     if not files:
         await update.message.reply_text(f"No files found matching '{file_query}'.")
@@ -369,9 +670,10 @@ async def edit_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         updated_tags = [tag.strip() for tag in new_tags_str.split() if tag.strip()]
 
     # Call the database function to update file metadata
-    rows_updated = db.update_file_metadata(user_id, file_id_to_update, new_name, updated_tags, tag_operation)
+    rows_updated = await db.update_file_metadata(user_id, file_id_to_update, new_name, updated_tags, tag_operation)
 
     if rows_updated > 0:
+        _files_changed(user_id)
         response_message = f"Successfully updated file '{current_file_name}'."
         if new_name:
             response_message += f" New name: '{new_name}'."
@@ -404,48 +706,14 @@ async def search_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "Please provide a search query. E.g., `report.pdf`, `#meeting`, `image #vacation`"
         )
         return
+    if not await _check_query(update.message, query):
+        return
 
-    files = db.find_files(user_id, query, limit=PAGE_SIZE, offset=offset) # Find files in the database with pagination
+    files = await db.find_files(user_id, query, limit=PAGE_SIZE, offset=offset) # Find files in the database with pagination
 
     if files:
-        await update.message.reply_text(f"Files matching '{query}' (Page {offset // PAGE_SIZE + 1}):")
-        # Iterate through files and send them back to the user
-        for file_id, file_name, file_type, telegram_file_category, _, tags_str in files:
-            caption_text = file_name
-            if tags_str:
-                # Display tags concisely within parentheses
-                caption_text += f" ({tags_str.replace(', ', ', ')})"
-
-            # Use the stored telegram_file_category to send the file correctly
-            if telegram_file_category == "photo":
-                await update.message.reply_photo(file_id, caption=caption_text)
-            elif telegram_file_category == "video":
-                await update.message.reply_video(file_id, caption=caption_text)
-            elif telegram_file_category == "audio":
-                await update.message.reply_audio(file_id, caption=caption_text)
-            elif telegram_file_category == "document":
-                await update.message.reply_document(file_id, caption=caption_text)
-            else:
-                # Fallback for older entries or unknown types based on MIME type
-                if file_type.startswith("image"):
-                    await update.message.reply_photo(file_id, caption=caption_text)
-                elif file_type.startswith("video"):
-                    await update.message.reply_video(file_id, caption=caption_text)
-                elif file_type.startswith("audio"):
-                    await update.message.reply_audio(file_id, caption=caption_text)
-                else:
-                    await update.message.reply_document(file_id, caption=caption_text)
-        
-        # Add pagination buttons
-        keyboard = []
-        if offset > 0:
-            keyboard.append(InlineKeyboardButton("Previous", callback_data=f"search_page_{offset - PAGE_SIZE}"))
-        if len(files) == PAGE_SIZE:
-            keyboard.append(InlineKeyboardButton("Next", callback_data=f"search_page_{offset + PAGE_SIZE}"))
-        
-        if keyboard:
-            reply_markup = InlineKeyboardMarkup([keyboard])
-            await update.message.reply_text("", reply_markup=reply_markup)
+        keyboard = _pagination_buttons("search", offset // PAGE_SIZE + 1, files)
+        await _send_file_page(update.message, files, f"Files matching '{query}' (Page {offset // PAGE_SIZE + 1})", keyboard)
 
     else:
         await update.message.reply_text(f"No files found matching '{query}'.")
@@ -477,88 +745,329 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if not original_query:
             await query.edit_message_text("Error: No delete query found. Please try again.")
             return
-        rows_deleted = db.delete_files(user_id, original_query) # Perform the deletion
+        rows_deleted = await db.delete_files(user_id, original_query) # Perform the deletion
         if rows_deleted > 0:
+            _files_changed(user_id)
             await query.edit_message_text(f"Deleted {rows_deleted} file(s) matching '{original_query}'.")
         else:
             await query.edit_message_text(f"No files were deleted for query '{original_query}'.")
     elif data == "cancel_delete":
         await query.edit_message_text("File deletion cancelled.")
-    elif data.startswith("files_page_"):
-        user_id = update.effective_user.id
-        offset = int(data.replace("files_page_", ""))
-        files = db.get_recent_files(user_id, limit=PAGE_SIZE, offset=offset)
-        
-        if files:
-            message_text = f"Your recent files (Page {offset // PAGE_SIZE + 1}):\n"
-            for file_id, file_name, file_type, telegram_file_category, _, tags_str in files:
-                caption_text = file_name
-                if tags_str:
-                    caption_text += f" ({tags_str.replace(', ', ', ')})"
-                message_text += f"- {caption_text}\n"
-
-            keyboard = []
-            if offset > 0:
-                keyboard.append(InlineKeyboardButton("Previous", callback_data=f"files_page_{offset - PAGE_SIZE}"))
-            if len(files) == PAGE_SIZE:
-                keyboard.append(InlineKeyboardButton("Next", callback_data=f"files_page_{offset + PAGE_SIZE}"))
-            
-            reply_markup = InlineKeyboardMarkup([keyboard])
-            await query.edit_message_text(message_text, reply_markup=reply_markup)
+    elif isinstance(data, PageCursor):
+        await _show_page(update, context, data)
+    elif isinstance(data, TagPage):
+        result = await _tag_page(update.effective_user.id, data.prefix, data.page)
+        if result is None:
+            await query.edit_message_text("No more tags.")
         else:
-            await query.edit_message_text("No more files.")
+            text, reply_markup = result
+            await query.edit_message_text(text, reply_markup=reply_markup)
 
-    elif data.startswith("search_page_"):
-        user_id = update.effective_user.id
-        offset = int(data.replace("search_page_", ""))
-        query_text = context.user_data.get('last_search_query')
 
+async def _show_page(update: Update, context: ContextTypes.DEFAULT_TYPE, cursor: PageCursor) -> None:
+    """
+    Edits a pagination message to show the page a Previous/Next button points at.
+    Pages are fetched by keyset from the cursor, so deep pages cost the same as the first.
+    """
+    query = update.callback_query
+    user_id = update.effective_user.id
+
+    if cursor.kind == "files":
+        files = await db.get_recent_files(user_id, limit=PAGE_SIZE, after=cursor.after, before=cursor.before)
+        title = "Your recent files"
+        empty_text = "No more files."
+    else:
+        query_text = context.user_data.get('last_search_query')
         if not query_text:
             await query.edit_message_text("No search query found. Please start a new search.")
             return
+        files = await db.find_files(user_id, query_text, limit=PAGE_SIZE, after=cursor.after, before=cursor.before)
+        title = f"Files matching '{query_text}'"
+        empty_text = "No more files for this search."
 
-        files = db.find_files(user_id, query_text, limit=PAGE_SIZE, offset=offset)
-
-        if files:
-            message_text = f"Files matching '{query_text}' (Page {offset // PAGE_SIZE + 1}):\n"
-            for file_id, file_name, file_type, telegram_file_category, _, tags_str in files:
-                caption_text = file_name
-                if tags_str:
-                    caption_text += f" ({tags_str.replace(', ', ', ')})"
-                message_text += f"- {caption_text}\n"
-
-            keyboard = []
-            if offset > 0:
-                keyboard.append(InlineKeyboardButton("Previous", callback_data=f"search_page_{offset - PAGE_SIZE}"))
-            if len(files) == PAGE_SIZE:
-                keyboard.append(InlineKeyboardButton("Next", callback_data=f"search_page_{offset + PAGE_SIZE}"))
-            
-            reply_markup = InlineKeyboardMarkup([keyboard])
-            await query.edit_message_text(message_text, reply_markup=reply_markup)
-        else:
-            await query.edit_message_text("No more files for this search.")
+    if not files:
+        await query.edit_message_text(empty_text)
+        return
+
+    message_text = f"{title} (Page {cursor.page}):\n"
+    for file_id, file_name, file_type, telegram_file_category, _, tags_str in files:
+        caption_text = file_name
+        if tags_str:
+            caption_text += f" ({tags_str})"
+        message_text += f"- {caption_text}\n"
+
+    reply_markup = InlineKeyboardMarkup([_pagination_buttons(cursor.kind, cursor.page, files)])
+    await query.edit_message_text(message_text, reply_markup=reply_markup)
 
 
-from web_server import start_web_server_thread
+# Results per inline answer (Telegram allows at most 50), and how long
+# Telegram itself may reuse an answer for the same user and query
+INLINE_PAGE_SIZE = 20
+INLINE_ANSWER_CACHE_TIME = 5
+# How many of the user's tags a trailing '#' prefix in an inline query expands to
+INLINE_TAG_COMPLETIONS = 8
 
-def main() -> None:
+
+async def _complete_inline_tag(user_id, text):
     """
-    Main function to set up and run the Telegram bot.
-    Initializes the database and registers all command and message handlers.
+    Tag autocomplete for inline mode: when the query's last word is a '#'
+    prefix, like "report #vac", it is widened to the user's most used tags
+    starting with it, "report (#vacation OR #vacancies)", so files show up
+    before the tag is typed out. Other queries are returned unchanged.
     """
-    db.init_db()  # Initialize the SQLite database
-    
-    # Start the web server in a separate thread
-    start_web_server_thread()
+    head, _, last = text.rpartition(" ")
+    prefix = last[1:]
+    if not last.startswith("#") or not prefix or any(c in prefix for c in '#"()'):
+        return text
+    entries, _ = await _complete_tags(user_id, prefix, INLINE_TAG_COMPLETIONS, by_count=True)
+    # Names that would need quoting inside the query are left out
+    names = [name for name, _ in entries if not any(c in name for c in '"()')]
+    if not names:
+        return text
+    return f"{head} ({' OR '.join('#' + name for name in names)})".lstrip()
+
+
+def _inline_result(row):
+    """An InlineQueryResultCached* that re-sends a stored file by its file_id."""
+    file_id, file_name, file_type, telegram_file_category, _, tags_str = row[:6]
+    # Result ids are limited to 64 bytes; file_ids can be longer
+    result_id = hashlib.blake2b(file_id.encode(), digest_size=16).hexdigest()
+    description = f"Tags: {tags_str}" if tags_str else (file_type or "")
+    category = _send_category(telegram_file_category, file_type)
+    if category == "photo":
+        return InlineQueryResultCachedPhoto(result_id, file_id, title=file_name, description=description)
+    if category == "video":
+        return InlineQueryResultCachedVideo(result_id, file_id, file_name, description=description)
+    if category == "audio":
+        # Telegram shows the audio's own title and performer
+        return InlineQueryResultCachedAudio(result_id, file_id)
+    return InlineQueryResultCachedDocument(result_id, file_name, file_id, description=description)
 
-    # Ensure a token is present; if not, log and back off so supervisor can retry later
-    if not TELEGRAM_TOKEN:
-        logger.error("TELEGRAM_TOKEN is missing; retrying in supervisor after 10s")
-        time.sleep(10)
+
+@resilient
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles inline queries (`@bot query` typed in any chat) with the user's
+    matching files, which they can then send into that chat. Uses the search
+    query language; an empty query lists the most recent files. Further
+    pages are requested by Telegram with the offset we hand out.
+    """
+    inline = update.inline_query
+    user_id = update.effective_user.id
+    text = inline.query.strip()
+    offset = int(inline.offset) if inline.offset.isdigit() else 0
+
+    try:
+        search_query.parse(text)
+    except search_query.QueryError:
+        # Usually a query still being typed, like an unclosed '('
+        await inline.answer([], cache_time=INLINE_ANSWER_CACHE_TIME, is_personal=True)
+        return
+
+    text = await _complete_inline_tag(user_id, text)
+    # Continuations and cached answers go out at once; new queries wait until the user stops typing
+    if offset == 0 and not inline_search.is_cached(user_id, text):
+        if not await inline_search.debounce(user_id):
+            return
+    rows = await inline_search.lookup(user_id, text)
+
+    page = rows[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + len(page)) if offset + len(page) < len(rows) else ""
+    await inline.answer(
+        [_inline_result(row) for row in page],
+        cache_time=INLINE_ANSWER_CACHE_TIME,
+        is_personal=True,
+        next_offset=next_offset,
+    )
+
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+
+@resilient
+async def slow_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles the /slowqueries command (admin only).
+    Without arguments lists the most recent slow queries; `/slowqueries N`
+    shows the N-th one in full, with its parameters and captured plan.
+    """
+    if ADMIN_ID is None or update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("This command is only available to the bot admin.")
+        return
+
+    entries = slow_queries.recent()
+    if not entries:
+        await update.message.reply_text("No slow queries recorded.")
+        return
+
+    if context.args and context.args[0].isdigit():
+        index = int(context.args[0])
+        if not 1 <= index <= len(entries):
+            await update.message.reply_text(f"Pick a number between 1 and {len(entries)}.")
+            return
+        entry = entries[index - 1]
+        text = (
+            f"#{index}: {entry['duration_ms']:.0f} ms in {entry['function']}\n"
+            f"at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['at']))}\n"
+            f"params: {entry['params']}\n\n{entry['sql'].strip()}"
+        )
+        if entry["plan"]:
+            text += f"\n\nPlan:\n{entry['plan']}"
+        await update.message.reply_text(text[:MAX_MESSAGE_LENGTH])
         return
 
-    # Create the Application and pass your bot's token.
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    lines = [f"Slow queries, newest first ({len(entries)} kept). Use /slowqueries N for details."]
+    for index, entry in enumerate(entries[:10], start=1):
+        age = int(time.time() - entry["at"])
+        sql_text = " ".join(entry["sql"].split())
+        lines.append(f"{index}. {entry['duration_ms']:.0f} ms, {entry['function']}, {age}s ago\n   {sql_text[:150]}")
+    await update.message.reply_text("\n".join(lines)[:MAX_MESSAGE_LENGTH])
+
+
+@resilient
+async def slow_handlers_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles the /slowhandlers command (admin only).
+    Lists each handler's calls and timings since startup, slowest on
+    average first, then the most recent calls over SLOW_HANDLER_SECONDS.
+    """
+    if ADMIN_ID is None or update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("This command is only available to the bot admin.")
+        return
+
+    ring_buffer = instrumentation.ring_buffer
+    summary = ring_buffer.summary()
+    if not summary:
+        await update.message.reply_text("No handler calls recorded.")
+        return
+
+    lines = ["Handlers, slowest first (mean/max wall time; mean DB and Bot API time):"]
+    for handler, stats in sorted(summary.items(), key=lambda item: item[1]["mean_wall_time"], reverse=True):
+        lines.append(
+            f"{handler}: {stats['calls']} calls, {stats['failures']} failed, "
+            f"{stats['mean_wall_time'] * 1000:.0f}/{stats['max_wall_time'] * 1000:.0f} ms; "
+            f"DB {stats['mean_db_time'] * 1000:.0f} ms, API {stats['mean_api_time'] * 1000:.0f} ms"
+        )
+
+    samples = ring_buffer.slow_samples()
+    if samples:
+        lines.append(f"\nCalls over {ring_buffer.slow_threshold:g}s, newest first ({len(samples)} kept):")
+        for sample in reversed(samples[-10:]):
+            age = int(time.time() - sample["started_at"])
+            outcome = "ok" if sample["ok"] else f"failed ({sample['error']})"
+            lines.append(
+                f"{sample['handler']}: {sample['wall_time'] * 1000:.0f} ms, "
+                f"DB {sample['db_time'] * 1000:.0f} ms in {sample['db_calls']}, "
+                f"API {sample['api_time'] * 1000:.0f} ms in {sample['api_calls']}, "
+                f"user {sample['user_id']}, {age}s ago, {outcome}"
+            )
+    await update.message.reply_text("\n".join(lines)[:MAX_MESSAGE_LENGTH])
+
+
+@resilient
+async def expired_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handles presses on buttons whose callback data is no longer cached
+    (sent before a restart, or evicted from the callback data cache).
+    """
+    await update.callback_query.answer("This button has expired. Please run the command again.", show_alert=True)
+
+
+from web_server import start_web_server
+
+# Number of inline keyboards whose callback data is kept in memory (LRU)
+CALLBACK_DATA_CACHE_SIZE = 4096
+
+
+async def _post_init(application: Application) -> None:
+    await db.init_db()  # Open the storage backend's connection pool
+    if db.pool_stats() is None:
+        logger.error("Storage backend unavailable; handlers will report it until it comes back")
+
+
+async def _post_shutdown(application: Application) -> None:
+    await db.close()
+
+
+async def _serve(application: Application) -> None:
+    """
+    Runs the bot and the HTTP server on one event loop until SIGINT/SIGTERM.
+    In webhook mode Telegram pushes updates to the HTTP server; otherwise
+    the updater long-polls for them.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    webhook_mode = bool(WEBHOOK_URL)
+    lag_monitor = LoopLagMonitor()
+    # /metrics exports handler timings alongside the in-memory ring buffer
+    metrics_sink = instrumentation.MetricsSink()
+    instrumentation.add_sink(metrics_sink)
+    await application.initialize()
+    runner = None
+    try:
+        await application.post_init(application)
+        lag_monitor.start()
+        runner = await start_web_server(
+            application,
+            HOST,
+            PORT,
+            webhook_path=WEBHOOK_PATH if webhook_mode else None,
+            secret_token=WEBHOOK_SECRET if webhook_mode else None,
+            lag_monitor=lag_monitor,
+        )
+        if not webhook_mode:
+            await application.updater.start_polling()
+        elif WEBHOOK_REGISTER:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info("Receiving updates by webhook at %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+        else:
+            logger.info("Serving the webhook at %s without registering it with Telegram", WEBHOOK_PATH)
+        await application.start()
+        await stop.wait()
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        if runner is not None:
+            await runner.cleanup()
+        await lag_monitor.stop()
+        instrumentation.remove_sink(metrics_sink)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+
+def build_application(token=TELEGRAM_TOKEN, request=None, rate_limiter=None, max_concurrent_updates=MAX_CONCURRENT_UPDATES) -> Application:
+    """
+    Creates the Application with all command and message handlers registered.
+    `request` replaces the HTTP client used for Bot API calls and
+    `rate_limiter` the send scheduler (the load harness passes fakes).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .arbitrary_callback_data(CALLBACK_DATA_CACHE_SIZE)
+        # Every outbound request is paced by the send scheduler, which keeps
+        # the bot under Telegram's flood limits and retries after a 429
+        .rate_limiter(rate_limiter or SendScheduler())
+        # Different users are served in parallel; one user's updates stay in order
+        .concurrent_updates(PerUserUpdateProcessor(max_concurrent_updates))
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
 
     # Global error handler
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -573,6 +1082,8 @@ def main() -> None:
     application.add_handler(CommandHandler("files", files_command)) # Renamed from my_files
     application.add_handler(CommandHandler("delete", delete_file))
     application.add_handler(CommandHandler("edit", edit_file))
+    application.add_handler(CommandHandler("slowqueries", slow_queries_command))
+    application.add_handler(CommandHandler("slowhandlers", slow_handlers_command))
     
 
     # Register message handlers
@@ -589,18 +1100,46 @@ def main() -> None:
     )
 
     
+    # Inline mode: `@bot query` in any chat (enable it with BotFather's /setinline)
+    application.add_handler(InlineQueryHandler(inline_query))
+
     # Register callback query handler for inline buttons
+    application.add_handler(CallbackQueryHandler(expired_button, pattern=InvalidCallbackData))
     application.add_handler(CallbackQueryHandler(button_callback))
+    return application
+
+
+def main() -> bool:
+    """
+    Main function to set up and run the Telegram bot.
+    Initializes the database and registers all command and message handlers.
+    Returns True once the bot was stopped on purpose (SIGINT/SIGTERM).
+    """
+    # Ensure a token is present; if not, log and back off so supervisor can retry later
+    if not TELEGRAM_TOKEN:
+        logger.error("TELEGRAM_TOKEN is missing; retrying in supervisor after 10s")
+        time.sleep(10)
+        return False
+    # The webhook endpoint is open to anyone who can reach the HTTP server;
+    # the secret token is what tells Telegram's requests apart
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_SECRET is required when WEBHOOK_URL is set; retrying in supervisor after 10s")
+        time.sleep(10)
+        return False
+
+    application = build_application()
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # Run the bot until the user presses Ctrl-C or the process is terminated
+    asyncio.run(_serve(application))
+    return True
 
 
 if __name__ == "__main__":
     # Entry point with supervisor loop for auto-restart
     while True:
         try:
-            main()
+            if main():
+                break
         except Exception:
             logger.exception("Bot crashed; restarting in 5s")
             time.sleep(5)
\ No newline at end of file
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    Thread-safe LRU cache with a time-to-live, keyed by (user_id, key).
+
+    Holds at most `max_entries` entries; the least recently used one is
+    evicted first, and entries older than `ttl` seconds are treated as
+    missing. `invalidate_user` drops everything cached for one user, which is
+    how writes keep cached reads honest.
+
+    A read that raced with a write must not re-populate the cache with what
+    it saw before the write: take `generation(user_id)` before reading and
+    pass it to `put`, which ignores the value if the user was invalidated in
+    the meantime. Only users with cached entries keep a generation of their
+    own; everyone else shares `_floor`, which each invalidation moves past
+    every generation handed out so far. That keeps memory bounded by the
+    cache, at the price of occasionally skipping a `put` that raced with
+    another user's write.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (user_id, key) -> (expires_at, value)
+        self._keys_by_user = {}  # user_id -> set of keys, for invalidate_user
+        self._generations = {}  # user_id -> generation, for users with entries
+        self._floor = 0  # generation of every other user
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key):
+        with self._lock:
+            entry = self._entries.get((user_id, key))
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove((user_id, key))
+                return None
+            self._entries.move_to_end((user_id, key))
+            return value
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, self._floor)
+
+    def put(self, user_id, key, value, generation=None):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generations.get(user_id, self._floor):
+                return
+            self._generations.setdefault(user_id, self._floor)
+            self._entries[(user_id, key)] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end((user_id, key))
+            self._keys_by_user.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._floor += 1
+            self._generations.pop(user_id, None)
+            for key in self._keys_by_user.pop(user_id, ()):
+                self._entries.pop((user_id, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+            self._generations.clear()
+            self._floor += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, entry_key):
+        self._entries.pop(entry_key, None)
+        user_id, key = entry_key
+        keys = self._keys_by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[user_id]
+                self._generations.pop(user_id, None)
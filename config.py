@@ -5,6 +5,8 @@ load_dotenv()
 
 # Make configuration resilient to missing or malformed environment variables
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
+# postgresql://... for Postgres, sqlite:///path/to/bot.db for the embedded
+# SQLite backend (see storage.py)
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
 _admin_id_raw = os.getenv("ADMIN_ID", "")
@@ -13,4 +15,88 @@ try:
 except (TypeError, ValueError):
     ADMIN_ID = None
 
-TELEGRAM_PAYMENTS_PROVIDER_TOKEN = os.getenv("TELEGRAM_PAYMENTS_PROVIDER_TOKEN", "")
\ No newline at end of file
+TELEGRAM_PAYMENTS_PROVIDER_TOKEN = os.getenv("TELEGRAM_PAYMENTS_PROVIDER_TOKEN", "")
+
+
+def _get_int(name, default):
+    raw = os.getenv(name, "")
+    try:
+        return int(raw) if raw else default
+    except (TypeError, ValueError):
+        return default
+
+
+def _get_float(name, default):
+    raw = os.getenv(name, "")
+    try:
+        return float(raw) if raw else default
+    except (TypeError, ValueError):
+        return default
+
+
+# Connection pool bounds. Handlers run queries on a worker pool of
+# DB_POOL_MAX threads, so this is also the number of concurrent queries.
+DB_POOL_MIN = max(1, _get_int("DB_POOL_MIN", 1))
+DB_POOL_MAX = max(DB_POOL_MIN, _get_int("DB_POOL_MAX", 10))
+
+# Write-behind buffer for users' upload/tag counters and last_active (see
+# activity.py): deltas are written in one batch every ACTIVITY_FLUSH_SECONDS
+# or after ACTIVITY_FLUSH_EVENTS recorded events, whichever comes first.
+ACTIVITY_FLUSH_SECONDS = max(0.1, _get_float("ACTIVITY_FLUSH_SECONDS", 5.0))
+ACTIVITY_FLUSH_EVENTS = max(1, _get_int("ACTIVITY_FLUSH_EVENTS", 1000))
+
+# Per-user search result cache (see database.find_files): number of cached
+# queries, their lifetime in seconds, and the largest result set worth caching
+# (larger ones are paged with keyset SQL instead).
+SEARCH_CACHE_SIZE = _get_int("SEARCH_CACHE_SIZE", 1024)
+SEARCH_CACHE_TTL = _get_int("SEARCH_CACHE_TTL", 300)
+SEARCH_CACHE_MAX_RESULTS = _get_int("SEARCH_CACHE_MAX_RESULTS", 10000)
+
+# Inline mode (see inline_search.py): answers are cached per user for
+# INLINE_CACHE_TTL seconds (at most INLINE_CACHE_SIZE queries), a query
+# returns at most INLINE_MAX_RESULTS files, and a user's inline query that
+# isn't cached is answered only if they stop typing for
+# INLINE_DEBOUNCE_SECONDS.
+INLINE_CACHE_SIZE = _get_int("INLINE_CACHE_SIZE", 2048)
+INLINE_CACHE_TTL = _get_int("INLINE_CACHE_TTL", 30)
+INLINE_MAX_RESULTS = max(1, _get_int("INLINE_MAX_RESULTS", 200))
+INLINE_DEBOUNCE_SECONDS = max(0.0, _get_float("INLINE_DEBOUNCE_SECONDS", 0.25))
+
+# In-memory tag index for autocomplete and /tags (see tag_index.py): the
+# most tag names kept across all users before the least recently used
+# users' tags are dropped.
+TAG_INDEX_MAX_TAGS = _get_int("TAG_INDEX_MAX_TAGS", 200000)
+
+# Number of updates handled at the same time. Updates from one user are
+# always handled one at a time, in order (see update_processor.py).
+MAX_CONCURRENT_UPDATES = max(1, _get_int("MAX_CONCURRENT_UPDATES", 64))
+
+# HTTP server (health check, and webhook ingestion in webhook mode):
+# address and port it listens on
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = _get_int("PORT", 5000)
+
+# Webhook mode: when WEBHOOK_URL (the bot's public https base URL) is set,
+# Telegram pushes updates to WEBHOOK_URL + WEBHOOK_PATH instead of the bot
+# long-polling for them. WEBHOOK_SECRET is then required (the bot won't
+# start without it) and checked against the X-Telegram-Bot-Api-Secret-Token
+# header of every request to the webhook. Set WEBHOOK_REGISTER=0 to serve
+# the webhook without calling setWebhook, e.g. to test locally by POSTing
+# recorded updates.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1").lower() not in ("0", "false", "no")
+
+# Handler calls slower than this many seconds are kept as slow-call samples
+# (see instrumentation.py).
+SLOW_HANDLER_SECONDS = _get_float("SLOW_HANDLER_SECONDS", 2.0)
+
+# Slow-query log (see query_log.py): statements slower than SLOW_QUERY_MS
+# milliseconds are logged and the last SLOW_QUERY_LOG_SIZE of them kept for
+# the admin's /slowqueries command; SLOW_QUERY_MS=0 turns it off.
+# SLOW_QUERY_EXPLAIN=1 also captures EXPLAIN (ANALYZE, BUFFERS) for slow
+# statements that only read, which runs them twice.
+SLOW_QUERY_MS = _get_int("SLOW_QUERY_MS", 500)
+SLOW_QUERY_LOG_SIZE = max(1, _get_int("SLOW_QUERY_LOG_SIZE", 100))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0").lower() in ("1", "true", "yes")
@@ -1,24 +1,77 @@
+import bisect
 import logging
+from collections import Counter
 import psycopg2
 from psycopg2 import pool, extras
-from config import DATABASE_URL
+from config import (
+    DATABASE_URL,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    SEARCH_CACHE_SIZE,
+    SEARCH_CACHE_TTL,
+    SEARCH_CACHE_MAX_RESULTS,
+)
+from activity import ActivityBuffer
+from cache import UserCache
+from query_log import TimedCursor
+import schema
+import search_query
+import tag_index
+from storage import StorageUnavailable
 
 db_pool = None
 logger = logging.getLogger(__name__)
 
+# (user_id, query) -> the matching files' (upload_date, file_id) keys in
+# ascending order. Lets Next/Previous fetch only the rows of the new page.
+# Every write to a user's files invalidates that user's entries.
+search_cache = UserCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
 def init_db():
     global db_pool
     if db_pool is None:
         try:
-            db_pool = pool.SimpleConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=DATABASE_URL
+            # Queries run on worker threads (see async_database), so the pool
+            # must be the thread-safe variant. Every cursor times its
+            # statements for the slow-query log.
+            db_pool = pool.ThreadedConnectionPool(
+                minconn=DB_POOL_MIN,
+                # One connection more than the DB workers, for the activity flusher
+                maxconn=DB_POOL_MAX + 1,
+                dsn=DATABASE_URL,
+                cursor_factory=TimedCursor,
             )
             logger.info("Database connection pool initialized.")
         except Exception as e:
             logger.exception("Error initializing connection pool")
             db_pool = None
+            return
+        _migrate()
+        activity.start()
+
+def _migrate():
+    conn = get_db_connection()
+    if conn is None:
+        logger.error("Schema migration skipped: DB unavailable")
+        return
+    try:
+        schema.migrate(conn)
+    except Exception:
+        logger.exception("Error applying schema migrations")
+    finally:
+        put_db_connection(conn)
+
+def close_db():
+    global db_pool
+    if db_pool is not None:
+        # Last chance to write the buffered counters
+        activity.close()
+        try:
+            db_pool.closeall()
+            logger.info("Database connection pool closed.")
+        except Exception:
+            logger.exception("Error closing connection pool")
+        db_pool = None
 
 def get_db_connection():
     global db_pool
@@ -33,69 +86,334 @@ def get_db_connection():
         logger.exception("Failed to get DB connection from pool")
         return None
 
-def put_db_connection(conn):
+def put_db_connection(conn, close=False):
     if db_pool is not None and conn is not None:
         try:
-            db_pool.putconn(conn)
+            db_pool.putconn(conn, close=close)
         except Exception:
             logger.exception("Failed to return DB connection to pool")
     # No raise; be resilient
 
-def add_file(user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags):
+def _require_connection():
+    """A pooled connection, or StorageUnavailable instead of a silent empty result."""
+    conn = get_db_connection()
+    if conn is None:
+        raise StorageUnavailable("Postgres database unavailable")
+    return conn
+
+def ping():
+    """
+    Runs a trivial query on a pooled connection, for readiness checks.
+    Returns True if the database answered. A connection that fails is
+    discarded instead of being returned to the pool.
+    """
     conn = None
     cur = None
+    ok = False
     try:
         conn = get_db_connection()
         if conn is None:
-            logger.error("add_file skipped: DB unavailable")
-            return
+            return False
         cur = conn.cursor()
-        cur.execute(
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        conn.rollback()
+        ok = True
+    except Exception:
+        logger.exception("Database ping failed")
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            put_db_connection(conn, close=not ok)
+    return ok
+
+def pool_stats():
+    """(in_use, idle, max) connection counts of the pool, or None if it isn't initialized."""
+    current = db_pool
+    if current is None:
+        return None
+    # psycopg2 keeps no public counters; read them under the pool's own lock
+    with current._lock:
+        return len(current._used), len(current._pool), current.maxconn
+
+def activity_stats():
+    """(users with counters pending, flushes, failed flushes) of the activity buffer."""
+    return activity.pending_users(), activity.flushes, activity.failed_flushes
+
+def _upsert_tags(cur, tag_names):
+    """
+    Resolves tag names to ids in one statement, creating the missing ones.
+    Returns a {tag_name: tag_id} dict.
+    """
+    names = list(dict.fromkeys(tag_names))
+    if not names:
+        return {}
+    # The insert only returns rows it created; the SELECT arm picks up the
+    # tags that already existed (it reads the statement's snapshot, so it
+    # never sees the rows inserted by the CTE and nothing is returned twice).
+    cur.execute(
+        """
+        WITH wanted AS (
+            SELECT DISTINCT unnest(%s::text[]) AS tag_name
+        ), inserted AS (
+            INSERT INTO tags (tag_name)
+            SELECT tag_name FROM wanted
+            ON CONFLICT (tag_name) DO NOTHING
+            RETURNING tag_id, tag_name
+        )
+        SELECT tag_id, tag_name FROM inserted
+        UNION ALL
+        SELECT t.tag_id, t.tag_name FROM tags t JOIN wanted w ON t.tag_name = w.tag_name
+        """,
+        (names,)
+    )
+    tag_ids = {tag_name: tag_id for tag_id, tag_name in cur.fetchall()}
+    missing = [name for name in names if name not in tag_ids]
+    if missing:
+        # A concurrent transaction committed these after our snapshot was
+        # taken; a fresh statement sees them.
+        cur.execute("SELECT tag_id, tag_name FROM tags WHERE tag_name = ANY(%s)", (missing,))
+        tag_ids.update({tag_name: tag_id for tag_id, tag_name in cur.fetchall()})
+    return tag_ids
+
+
+def _predicate_sql(user_id, predicate):
+    """
+    SQL for one search predicate of `user_id`'s query (see search_query.py).
+    Tags and extensions are case-insensitive equality lookups: the GIN index
+    over the lowercased tag array (lower_tags) and the (user_id,
+    lower(file_extension)) index. Bare terms keep the substring/word match
+    over name, extension, tags and caption (search_vector, maintained by a
+    trigger). For tags, the user's own tag names containing the term are
+    looked up once, from user_tags, and the files carrying any of them come
+    from the tag array's index; the subquery must stay uncorrelated so every
+    arm of the OR is index-served and the planner can BitmapOr them.
+    """
+    field, value = predicate
+    if field == "tag":
+        # Tags saved before captions had their '#' stripped may still carry one
+        return "lower_tags(f.tags) && ARRAY[lower(%s), lower(%s)]", [value, "#" + value]
+    if field == "ext":
+        return "lower(f.file_extension) = %s", [value]
+    if field == "type":
+        return "f.telegram_file_category = %s", [value]
+    pattern = search_query.like_pattern(value)
+    if field == "name":
+        return "f.file_name ILIKE %s", [pattern]
+    return (
+        "f.file_name ILIKE %s OR f.file_extension ILIKE %s OR "
+        "f.search_vector @@ plainto_tsquery('simple', %s) OR "
+        "lower_tags(f.tags) && ARRAY("
+        "SELECT lower(t.tag_name) FROM user_tags ut JOIN tags t ON t.tag_id = ut.tag_id "
+        "WHERE ut.user_id = %s AND t.tag_name ILIKE %s)",
+        [pattern, pattern, value, user_id, pattern],
+    )
+
+
+def _match_condition(user_id, query):
+    """Condition and parameters matching the user's files that satisfy `query`."""
+    condition, params = search_query.compile_condition(
+        search_query.parse(query), lambda predicate: _predicate_sql(user_id, predicate)
+    )
+    return f"f.user_id = %s AND {condition}", [user_id] + params
+
+
+# Row shape every listing returns: (file_id, file_name, file_type,
+# telegram_file_category, upload_date, tags as a ", "-joined string)
+_FILE_ROW_COLUMNS = "f.file_id, f.file_name, f.file_type, f.telegram_file_category, f.upload_date, array_to_string(f.tags, ', ') AS tags"
+
+def _keyset(after=None, before=None):
+    """
+    Keyset pagination over the display order (upload_date DESC, file_id DESC).
+    `after` / `before` are (upload_date, file_id) of the last / first row of
+    the page the user is on. Returns the row condition, its parameters and
+    the direction to walk the index in; the caller always re-sorts the page
+    newest-first.
+    """
+    if after is not None:
+        return "(f.upload_date, f.file_id) < (%s, %s)", list(after), "DESC"
+    if before is not None:
+        return "(f.upload_date, f.file_id) > (%s, %s)", list(before), "ASC"
+    return "TRUE", [], "DESC"
+
+
+def _link_tags(cur, file_id, tag_names):
+    """
+    Creates any missing tags and links them to the file in file_tags.
+    Returns the {tag_name: tag_id} dict of the linked tags.
+    """
+    tag_ids = _upsert_tags(cur, tag_names)
+    if tag_ids:
+        psycopg2.extras.execute_values(
+            cur,
             """
-            INSERT INTO files (user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO file_tags (file_id, tag_id) VALUES %s
+            ON CONFLICT (file_id, tag_id) DO NOTHING
             """,
-            (
-                user_id,
-                file_id,
-                file_name,
-                file_extension,
-                file_type,
-                telegram_file_category,
-                caption,
+            [(file_id, tag_id) for tag_id in tag_ids.values()]
+        )
+    return tag_ids
+
+
+def _adjust_user_tags(cur, user_id, deltas):
+    """
+    Applies {tag_id: change in file count} to the user's user_tags rows,
+    creating rows that reach a positive count and dropping rows that reach
+    zero. Returns the change in the user's number of distinct tags, which
+    the caller passes on to `activity` once its transaction has committed.
+    """
+    increments = [(user_id, tag_id, delta) for tag_id, delta in deltas.items() if delta > 0]
+    decrements = [(user_id, tag_id, -delta) for tag_id, delta in deltas.items() if delta < 0]
+    change = 0
+    if increments:
+        # xmax is 0 only on freshly inserted rows, so this counts the tags
+        # that are new to the user
+        rows = psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO user_tags (user_id, tag_id, file_count) VALUES %s
+            ON CONFLICT (user_id, tag_id) DO UPDATE SET file_count = user_tags.file_count + EXCLUDED.file_count
+            RETURNING (xmax = 0)
+            """,
+            increments,
+            fetch=True,
+        )
+        change += sum(1 for (inserted,) in rows if inserted)
+    if decrements:
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            UPDATE user_tags ut SET file_count = ut.file_count - v.delta
+            FROM (VALUES %s) AS v(user_id, tag_id, delta)
+            WHERE ut.user_id = v.user_id AND ut.tag_id = v.tag_id
+            """,
+            decrements,
+        )
+        cur.execute(
+            "DELETE FROM user_tags WHERE user_id = %s AND tag_id = ANY(%s) AND file_count <= 0",
+            (user_id, [tag_id for _, tag_id, _ in decrements]),
+        )
+        change -= cur.rowcount
+    return change
+
+
+def _insert_files(cur, user_id, uploads):
+    """
+    Inserts one user's uploads, each a (file_id, file_name, file_extension,
+    file_type, telegram_file_category, caption, tags, file_unique_id) tuple,
+    with one statement per table however many files and tags there are, and
+    updates the user's per-tag counts.
+
+    An upload whose file_unique_id the user already has, or that repeats
+    one earlier in the batch, is merged into that file instead: its new
+    tags are appended and everything else is kept. Otherwise, one whose
+    file_id the user already has (a file saved before file_unique_id was
+    recorded) is merged into that file, which gets the file_unique_id now.
+
+    Returns the number of new files, the change in the user's number of
+    distinct tags and the {tag_name: change in file count} for tag_index.
+    """
+    rows = []
+    by_unique_id = {}
+    for file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id in uploads:
+        tags = list(dict.fromkeys(tags))
+        earlier = by_unique_id.get(file_unique_id) if file_unique_id else None
+        if earlier is not None:
+            # ON CONFLICT can't touch one row twice in a statement, so repeats merge here
+            earlier[7].extend(tag for tag in tags if tag not in earlier[7])
+            continue
+        row = (user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id)
+        rows.append(row)
+        if file_unique_id:
+            by_unique_id[file_unique_id] = row
+
+    # Same file_id: the upsert below would hit the primary key instead, so
+    # these merge first; a file_unique_id another file has is left to it
+    resent = psycopg2.extras.execute_values(
+        cur,
+        """
+        UPDATE files f
+        SET tags = f.tags || ARRAY(
+                SELECT added.tag FROM unnest(v.tags) WITH ORDINALITY AS added(tag, position)
+                WHERE added.tag <> ALL(f.tags)
+                ORDER BY added.position
             ),
+            file_unique_id = coalesce(f.file_unique_id, v.file_unique_id)
+        FROM (VALUES %s) AS v(user_id, file_id, tags, file_unique_id)
+        WHERE f.user_id = v.user_id AND f.file_id = v.file_id
+          AND NOT EXISTS (
+              SELECT 1 FROM files other
+              WHERE other.user_id = v.user_id AND other.file_unique_id = v.file_unique_id AND other.file_id <> v.file_id
+          )
+        RETURNING f.file_id
+        """,
+        [(user_id, row[1], row[7], row[8]) for row in rows],
+        template="(%s, %s, %s::text[], %s)",
+        page_size=len(rows),
+        fetch=True,
+    )
+    resent_ids = {file_id for (file_id,) in resent}
+
+    # RETURNING gives the stored file_id, which for a duplicate is the existing
+    # file's; xmax is 0 only on freshly inserted rows
+    new_rows = [row for row in rows if row[1] not in resent_ids]
+    stored = psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO files (user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id)
+        VALUES %s
+        ON CONFLICT (user_id, file_unique_id) WHERE file_unique_id IS NOT NULL DO UPDATE
+        SET tags = files.tags || ARRAY(
+            SELECT added.tag FROM unnest(EXCLUDED.tags) WITH ORDINALITY AS added(tag, position)
+            WHERE added.tag <> ALL(files.tags)
+            ORDER BY added.position
         )
-        
-        tag_data = []
-        file_tag_data = []
-        for tag_name in tags:
-            cur.execute(
-                """
-                INSERT INTO tags (tag_name) VALUES (%s)
-                ON CONFLICT (tag_name) DO NOTHING
-                RETURNING tag_id
-                """,
-                (tag_name,)
-            )
-            tag_id = cur.fetchone()
-            if tag_id:
-                tag_id = tag_id[0]
-            else:
-                cur.execute("SELECT tag_id FROM tags WHERE tag_name = %s", (tag_name,))
-                tag_id = cur.fetchone()[0]
-            file_tag_data.append((file_id, tag_id))
+        RETURNING file_id, file_unique_id, (xmax = 0)
+        """,
+        new_rows,
+        page_size=len(new_rows),
+        fetch=True,
+    ) if new_rows else []
+    stored_ids = {file_unique_id: file_id for file_id, file_unique_id, _ in stored if file_unique_id}
+    inserted = sum(1 for _, _, is_new in stored if is_new)
 
-        if file_tag_data:
-            psycopg2.extras.execute_values(
-                cur,
-                """
-                INSERT INTO file_tags (file_id, tag_id) VALUES %s
-                ON CONFLICT (file_id, tag_id) DO NOTHING
-                """,
-                file_tag_data
-            )
+    links = []  # (file_id, tag_name)
+    for row in rows:
+        file_id = stored_ids.get(row[8], row[1])
+        links.extend((file_id, tag_name) for tag_name in row[7])
+    tag_ids = _upsert_tags(cur, [tag_name for _, tag_name in links])
+    deltas = Counter()
+    if links:
+        # Only links the files didn't have yet come back, so merged
+        # duplicates count just their new tags
+        linked = psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO file_tags (file_id, tag_id) VALUES %s
+            ON CONFLICT (file_id, tag_id) DO NOTHING
+            RETURNING tag_id
+            """,
+            [(file_id, tag_ids[tag_name]) for file_id, tag_name in links],
+            page_size=len(links),
+            fetch=True,
+        )
+        deltas.update(tag_id for (tag_id,) in linked)
+    tag_names = {tag_id: tag_name for tag_name, tag_id in tag_ids.items()}
+    tag_change = _adjust_user_tags(cur, user_id, deltas)
+    return inserted, tag_change, {tag_names[tag_id]: delta for tag_id, delta in deltas.items()}
 
+
+def add_file(user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags):
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor()
+        _, tag_change, tag_deltas = _insert_files(cur, user_id, [(file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, None)])
         conn.commit()
+        search_cache.invalidate_user(user_id)
+        tag_index.index.apply(user_id, tag_deltas)
+        activity.record(user_id, tags=tag_change, touch=False)
     except Exception:
         if conn:
             try:
@@ -111,39 +429,157 @@ def add_file(user_id, file_id, file_name, file_extension, file_type, telegram_fi
             put_db_connection(conn)
 
 
-def find_files(user_id, query, limit=None, offset=0):
-    conn = None
+def save_upload(user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id=None):
+    """
+    Stores an uploaded file together with its tags and updates the user's
+    tag counts in one transaction. If the user already has a file with this
+    file_unique_id, the new tags are merged into it instead.
+    Returns 1 if the upload was such a duplicate, 0 if it was stored as a
+    new file, and None if it wasn't committed.
+    """
+    return save_uploads(user_id, [(file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id)])
+
+
+def save_uploads(user_id, uploads):
+    """
+    Batch form of save_upload: stores several (file_id, file_name,
+    file_extension, file_type, telegram_file_category, caption, tags,
+    file_unique_id) uploads of one user in a single transaction.
+    Returns the number of them that were duplicates merged into existing
+    files, or None if none were committed.
+    """
+    if not uploads:
+        return 0
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("find_files: DB unavailable")
-            return []
         cur = conn.cursor()
-        search_term = f"%{query}%"
-        sql_query = """
-            SELECT DISTINCT f.file_id, f.file_name, f.file_type, f.telegram_file_category, f.upload_date, STRING_AGG(t.tag_name, ', ') AS tags
-            FROM files f
-            LEFT JOIN file_tags ft ON f.file_id = ft.file_id
-            LEFT JOIN tags t ON ft.tag_id = t.tag_id
-            WHERE f.user_id = %s AND (
-                f.file_name ILIKE %s OR 
-                f.file_extension ILIKE %s OR 
-                t.tag_name ILIKE %s
-            )
-            GROUP BY f.file_id, f.file_name, f.file_type, f.telegram_file_category, f.upload_date
-            ORDER BY f.upload_date DESC
-            """
-        params = [user_id, search_term, search_term, search_term]
+        inserted, tag_change, tag_deltas = _insert_files(cur, user_id, uploads)
+        conn.commit()
+        search_cache.invalidate_user(user_id)
+        tag_index.index.apply(user_id, tag_deltas)
+        activity.record(user_id, uploads=inserted, tags=tag_change)
+        return len(uploads) - inserted
+    except Exception:
+        if conn:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        logger.exception("Error saving uploads")
+        return None
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            put_db_connection(conn)
 
-        if limit is not None:
-            sql_query += " LIMIT %s OFFSET %s"
-            params.append(limit)
-            params.append(offset)
 
-        cur.execute(sql_query, tuple(params))
-        files = cur.fetchall()
-        return files
+# Cached in place of the keys of a query matching more than
+# SEARCH_CACHE_MAX_RESULTS files, whose pages are read with keyset SQL
+_TOO_MANY_RESULTS = object()
+
+
+def _find_file_keys(cur, user_id, query, limit=None):
+    """
+    Ascending (upload_date, file_id) keys of the files matching `query`;
+    with `limit`, only the newest `limit` of them.
+    """
+    condition, params = _match_condition(user_id, query)
+    page_clause = ""
+    if limit is not None:
+        page_clause = "LIMIT %s"
+        params.append(limit)
+    cur.execute(
+        f"""
+        SELECT f.upload_date, f.file_id
+        FROM files f
+        WHERE {condition}
+        ORDER BY f.upload_date DESC, f.file_id DESC
+        {page_clause}
+        """,
+        params,
+    )
+    return [tuple(row) for row in reversed(cur.fetchall())]
+
+
+def _find_files_page(cur, user_id, query, limit, offset=0, after=None, before=None):
+    """One page of find_files straight from the indexes, so its cost doesn't grow with the result set."""
+    condition, params = _match_condition(user_id, query)
+    keyset, keyset_params, order = _keyset(after, before)
+    cur.execute(
+        f"""
+        SELECT {_FILE_ROW_COLUMNS}
+        FROM files f
+        WHERE {condition} AND {keyset}
+        ORDER BY f.upload_date {order}, f.file_id {order}
+        LIMIT %s OFFSET %s
+        """,
+        params + keyset_params + [limit, offset],
+    )
+    files = cur.fetchall()
+    if order == "ASC":
+        files.reverse()
+    return files
+
+
+def _page_keys(keys, limit, offset=0, after=None, before=None):
+    """
+    Slices one page, newest first, out of ascending (upload_date, file_id) keys.
+    `after` / `before` have the same meaning as in get_recent_files.
+    """
+    if after is not None:
+        end = bisect.bisect_left(keys, tuple(after))
+        return keys[max(0, end - limit):end][::-1]
+    if before is not None:
+        start = bisect.bisect_right(keys, tuple(before))
+        return keys[start:start + limit][::-1]
+    end = max(0, len(keys) - offset)
+    return keys[max(0, end - limit):end][::-1]
+
+
+def _get_files_by_ids(cur, user_id, file_ids):
+    cur.execute(
+        f"""
+        SELECT {_FILE_ROW_COLUMNS}
+        FROM files f
+        WHERE f.user_id = %s AND f.file_id = ANY(%s)
+        ORDER BY f.upload_date DESC, f.file_id DESC
+        """,
+        (user_id, list(file_ids)),
+    )
+    return cur.fetchall()
+
+
+def find_files(user_id, query, limit=None, offset=0, after=None, before=None):
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor()
+        keys = search_cache.get(user_id, query)
+        if keys is None:
+            generation = search_cache.generation(user_id)
+            # For a page, probe one key past the cap: result sets that fit
+            # are cached and paged in memory, larger ones paged in SQL
+            keys = _find_file_keys(cur, user_id, query, None if limit is None else SEARCH_CACHE_MAX_RESULTS + 1)
+            if len(keys) <= SEARCH_CACHE_MAX_RESULTS:
+                search_cache.put(user_id, query, keys, generation)
+            else:
+                search_cache.put(user_id, query, _TOO_MANY_RESULTS, generation)
+                if limit is not None:
+                    keys = _TOO_MANY_RESULTS
+        if keys is _TOO_MANY_RESULTS:
+            if limit is not None:
+                return _find_files_page(cur, user_id, query, limit, offset, after, before)
+            keys = _find_file_keys(cur, user_id, query)
+
+        if limit is not None:
+            keys = _page_keys(keys, limit, offset, after, before)
+        else:
+            keys = keys[::-1]
+        if not keys:
+            return []
+        return _get_files_by_ids(cur, user_id, [file_id for _, file_id in keys])
     except Exception:
         logger.exception("Error finding files")
         return []
@@ -154,27 +590,54 @@ def find_files(user_id, query, limit=None, offset=0):
             put_db_connection(conn)
 
 
+def find_file_details(user_id, query, limit):
+    """
+    The newest `limit` files matching `query`, as find_files rows extended by
+    (file_extension, caption), for callers that narrow results down
+    themselves (inline search). Bypasses the search cache.
+    """
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor()
+        condition, params = _match_condition(user_id, query)
+        cur.execute(
+            f"""
+            SELECT {_FILE_ROW_COLUMNS}, f.file_extension, f.caption
+            FROM files f
+            WHERE {condition}
+            ORDER BY f.upload_date DESC, f.file_id DESC
+            LIMIT %s
+            """,
+            params + [limit],
+        )
+        return cur.fetchall()
+    except Exception:
+        logger.exception("Error finding file details")
+        return []
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            put_db_connection(conn)
+
+
 def get_all_tags(user_id):
-    conn = None
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("get_all_tags: DB unavailable")
-            return []
         cur = conn.cursor()
         cur.execute(
             """
-            SELECT DISTINCT t.tag_name
-            FROM tags t
-            JOIN file_tags ft ON t.tag_id = ft.tag_id
-            JOIN files f ON ft.file_id = f.file_id
-            WHERE f.user_id = %s
+            SELECT t.tag_name
+            FROM user_tags ut
+            JOIN tags t ON t.tag_id = ut.tag_id
+            WHERE ut.user_id = %s
+            ORDER BY t.tag_name
             """,
             (user_id,)
         )
-        tags_list = [row[0] for row in cur.fetchall()]
-        return sorted(list(set(tags_list)))
+        return [row[0] for row in cur.fetchall()]
     except Exception:
         logger.exception("Error getting all tags")
         return []
@@ -185,96 +648,108 @@ def get_all_tags(user_id):
             put_db_connection(conn)
 
 
+def get_tag_counts(user_id):
+    """
+    The user's (tag_name, file count) pairs, which tag_index is built from.
+    Returns None if they couldn't be read, so a failure isn't mistaken for
+    a user without tags.
+    """
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT t.tag_name, ut.file_count
+            FROM user_tags ut
+            JOIN tags t ON t.tag_id = ut.tag_id
+            WHERE ut.user_id = %s
+            """,
+            (user_id,)
+        )
+        return [tuple(row) for row in cur.fetchall()]
+    except Exception:
+        logger.exception("Error getting tag counts")
+        return None
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            put_db_connection(conn)
+
+
 def update_file_metadata(user_id, file_id, new_file_name=None, tags_to_modify=None, tag_operation=None):
-    conn = None
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("update_file_metadata: DB unavailable")
-            return 0
         cur = conn.cursor()
-        update_fields = []
-        params = []
-
-        if new_file_name is not None:
-            update_fields.append("file_name = %s")
-            params.append(new_file_name)
-        
-        if tags_to_modify is not None and tag_operation is not None:
-            cur.execute(
-                """
-                SELECT t.tag_name
-                FROM tags t
-                JOIN file_tags ft ON t.tag_id = ft.tag_id
-                WHERE ft.file_id = %s
-                """,
-                (file_id,)
-            )
-            current_tags = set([row[0] for row in cur.fetchall()])
+        change_tags = tags_to_modify is not None and tag_operation is not None
+        if new_file_name is None and not change_tags:
+            return 0
+        if change_tags and tag_operation not in ("set", "add", "remove"):
+            return 0
+
+        cur.execute(
+            "SELECT tags FROM files WHERE user_id = %s AND file_id = %s FOR UPDATE",
+            (user_id, file_id)
+        )
+        row = cur.fetchone()
+        if row is None:
+            return 0
+        current_tags = row[0]
+        updated_tags = current_tags
+        tag_change = 0
+        tag_deltas = {}
 
-            updated_tags = set()
+        if change_tags:
+            # Keep the existing order and append new tags, so listings stay stable
+            modify = list(dict.fromkeys(tags_to_modify))
             if tag_operation == "set":
-                updated_tags = set(tags_to_modify)
+                updated_tags = modify
             elif tag_operation == "add":
-                updated_tags = current_tags.union(set(tags_to_modify))
-            elif tag_operation == "remove":
-                updated_tags = current_tags.difference(set(tags_to_modify))
+                updated_tags = current_tags + [tag for tag in modify if tag not in current_tags]
             else:
-                return 0
+                updated_tags = [tag for tag in current_tags if tag not in modify]
 
-            tags_to_remove = current_tags.difference(updated_tags)
+            deltas = {}
+            tags_to_remove = set(current_tags).difference(updated_tags)
             if tags_to_remove:
-                cur.execute("SELECT tag_id FROM tags WHERE tag_name IN %s", (tuple(tags_to_remove),))
-                tag_ids_to_remove = [row[0] for row in cur.fetchall()]
-                if tag_ids_to_remove:
-                    psycopg2.extras.execute_values(
-                        cur,
-                        "DELETE FROM file_tags WHERE file_id = %s AND tag_id = %s",
-                        [(file_id, tag_id) for tag_id in tag_ids_to_remove]
-                    )
-
-            tags_to_add = updated_tags.difference(current_tags)
-            if tags_to_add:
-                psycopg2.extras.execute_values(
-                    cur,
-                    "INSERT INTO tags (tag_name) VALUES %s ON CONFLICT (tag_name) DO NOTHING RETURNING tag_id, tag_name",
-                    [(tag_name,) for tag_name in tags_to_add]
+                cur.execute(
+                    """
+                    DELETE FROM file_tags ft
+                    USING tags t
+                    WHERE ft.tag_id = t.tag_id AND ft.file_id = %s AND t.tag_name = ANY(%s)
+                    RETURNING ft.tag_id, t.tag_name
+                    """,
+                    (file_id, list(tags_to_remove))
                 )
-                cur.execute("SELECT tag_id, tag_name FROM tags WHERE tag_name IN %s", (tuple(tags_to_add),))
-                tag_id_map = {row[1]: row[0] for row in cur.fetchall()}
-
-                file_tag_data = []
-                for tag_name in tags_to_add:
-                    if tag_name in tag_id_map:
-                        file_tag_data.append((file_id, tag_id_map[tag_name]))
-                
-                if file_tag_data:
-                    psycopg2.extras.execute_values(
-                        cur,
-                        """
-                        INSERT INTO file_tags (file_id, tag_id) VALUES %s
-                        ON CONFLICT (file_id, tag_id) DO NOTHING
-                        """,
-                        file_tag_data
-                    )
-
-        if not update_fields and (tags_to_modify is None or tag_operation is None):
-            return 0
+                for tag_id, tag_name in cur.fetchall():
+                    deltas[tag_id] = -1
+                    tag_deltas[tag_name] = -1
 
-        if update_fields:
-            sql = f"UPDATE files SET {', '.join(update_fields)} WHERE user_id = %s AND file_id = %s"
-            params.append(user_id)
-            params.append(file_id)
-            cur.execute(sql, tuple(params))
-            rows_updated = cur.rowcount
-        else:
-            rows_updated = 0
+            tags_to_add = [tag for tag in updated_tags if tag not in current_tags]
+            if tags_to_add:
+                for tag_name, tag_id in _link_tags(cur, file_id, tags_to_add).items():
+                    deltas[tag_id] = deltas.get(tag_id, 0) + 1
+                    tag_deltas[tag_name] = tag_deltas.get(tag_name, 0) + 1
 
-        new_tag_count = _get_user_unique_tag_count(user_id)
-        cur.execute("UPDATE users SET tag_count = %s WHERE user_id = %s", (new_tag_count, user_id))
+            tag_change = _adjust_user_tags(cur, user_id, deltas)
+
+        # files.tags mirrors file_tags; the search_vector trigger picks up both columns
+        cur.execute(
+            """
+            UPDATE files SET file_name = COALESCE(%s, file_name), tags = %s
+            WHERE user_id = %s AND file_id = %s
+            """,
+            (new_file_name, updated_tags, user_id, file_id)
+        )
+        rows_updated = cur.rowcount
 
         conn.commit()
+        search_cache.invalidate_user(user_id)
+        tag_index.index.apply(user_id, tag_deltas)
+        if tag_change:
+            activity.record(user_id, tags=tag_change, touch=False)
         return rows_updated
     except Exception:
         if conn:
@@ -291,28 +766,25 @@ def update_file_metadata(user_id, file_id, new_file_name=None, tags_to_modify=No
             put_db_connection(conn)
 
 
-def get_recent_files(user_id, limit=10, offset=0):
-    conn = None
+def get_recent_files(user_id, limit=10, offset=0, after=None, before=None):
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("get_recent_files: DB unavailable")
-            return []
         cur = conn.cursor()
+        condition, params, order = _keyset(after, before)
         cur.execute(
-            """
-            SELECT DISTINCT f.file_id, f.file_name, f.file_type, f.telegram_file_category, f.upload_date, STRING_AGG(t.tag_name, ', ') AS tags
+            f"""
+            SELECT {_FILE_ROW_COLUMNS}
             FROM files f
-            LEFT JOIN file_tags ft ON f.file_id = ft.file_id
-            LEFT JOIN tags t ON ft.tag_id = t.tag_id
-            WHERE f.user_id = %s
-            GROUP BY f.file_id, f.file_name, f.file_type, f.telegram_file_category, f.upload_date
-            ORDER BY f.upload_date DESC LIMIT %s OFFSET %s
+            WHERE f.user_id = %s AND {condition}
+            ORDER BY f.upload_date {order}, f.file_id {order}
+            LIMIT %s OFFSET %s
             """,
-            (user_id, limit, offset),
+            [user_id] + params + [limit, offset],
         )
         files = cur.fetchall()
+        if order == "ASC":
+            files.reverse()
         return files
     except Exception:
         logger.exception("Error getting recent files")
@@ -325,45 +797,42 @@ def get_recent_files(user_id, limit=10, offset=0):
 
 
 def delete_files(user_id, query):
-    conn = None
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("delete_files: DB unavailable")
-            return 0
         cur = conn.cursor()
-        search_term = f"%{query}%"
-        cur.execute(
-            """
-            SELECT DISTINCT f.file_id
-            FROM files f
-            LEFT JOIN file_tags ft ON f.file_id = ft.file_id
-            LEFT JOIN tags t ON ft.tag_id = t.tag_id
-            WHERE f.user_id = %s AND (
-                f.file_name ILIKE %s OR 
-                f.file_extension ILIKE %s OR 
-                t.tag_name ILIKE %s
-            )
-            """,
-            (user_id, search_term, search_term, search_term),
-        )
+        condition, params = _match_condition(user_id, query)
+        cur.execute(f"SELECT f.file_id FROM files f WHERE {condition}", params)
         file_ids_to_delete = [row[0] for row in cur.fetchall()]
 
         rows_deleted = 0
+        tag_change = 0
+        tag_deltas = Counter()
         if file_ids_to_delete:
-            cur.execute("DELETE FROM file_tags WHERE file_id IN %s", (tuple(file_ids_to_delete),))
-            
-            cur.execute("DELETE FROM files WHERE user_id = %s AND file_id IN %s", (user_id, tuple(file_ids_to_delete)))
+            cur.execute(
+                """
+                DELETE FROM file_tags ft
+                USING tags t
+                WHERE ft.tag_id = t.tag_id AND ft.file_id = ANY(%s)
+                RETURNING ft.tag_id, t.tag_name
+                """,
+                (file_ids_to_delete,)
+            )
+            deltas = {}
+            for tag_id, tag_name in cur.fetchall():
+                deltas[tag_id] = deltas.get(tag_id, 0) - 1
+                tag_deltas[tag_name] -= 1
+
+            cur.execute("DELETE FROM files WHERE user_id = %s AND file_id = ANY(%s)", (user_id, file_ids_to_delete))
             rows_deleted = cur.rowcount
 
-        new_file_count = _get_user_file_count(user_id)
-        cur.execute("UPDATE users SET upload_count = %s WHERE user_id = %s", (new_file_count, user_id))
-        
-        new_tag_count = _get_user_unique_tag_count(user_id)
-        cur.execute("UPDATE users SET tag_count = %s WHERE user_id = %s", (new_tag_count, user_id))
+            tag_change = _adjust_user_tags(cur, user_id, deltas)
 
         conn.commit()
+        search_cache.invalidate_user(user_id)
+        tag_index.index.apply(user_id, tag_deltas)
+        if rows_deleted:
+            activity.record(user_id, uploads=-rows_deleted, tags=tag_change, touch=False)
         return rows_deleted
     except Exception:
         if conn:
@@ -380,20 +849,35 @@ def delete_files(user_id, query):
             put_db_connection(conn)
 
 
-def get_user(user_id):
-    conn = None
+def get_files_without_unique_id(limit, after=None):
+    """
+    Up to `limit` (upload_date, file_id, user_id) rows of files saved before
+    file_unique_id was recorded, oldest first, starting after the
+    (upload_date, file_id) key `after`. Returns None if they couldn't be
+    read. Used by backfill_unique_ids.py.
+    """
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("get_user: DB unavailable")
-            return None
         cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-        user = cur.fetchone()
-        return user
+        params = {"limit": limit}
+        condition = "TRUE"
+        if after is not None:
+            params["after_date"], params["after_id"] = after
+            condition = "(upload_date, file_id) > (%(after_date)s, %(after_id)s)"
+        cur.execute(
+            f"""
+            SELECT upload_date, file_id, user_id
+            FROM files
+            WHERE file_unique_id IS NULL AND {condition}
+            ORDER BY upload_date, file_id
+            LIMIT %(limit)s
+            """,
+            params,
+        )
+        return [tuple(row) for row in cur.fetchall()]
     except Exception:
-        logger.exception("Error getting user")
+        logger.exception("Error getting files without file_unique_id")
         return None
     finally:
         if cur:
@@ -402,31 +886,103 @@ def get_user(user_id):
             put_db_connection(conn)
 
 
-def add_user(user_id, username):
-    conn = None
+def _collapse_duplicate(cur, user_id, keep_file_id, keep_tags, duplicate_file_id):
+    """
+    Merges file `duplicate_file_id` into `keep_file_id`: its tags are
+    appended, the earlier upload date is kept, and it is deleted. Returns
+    the change in the user's number of distinct tags and the per-name tag
+    deltas.
+    """
+    cur.execute(
+        "SELECT tags, upload_date FROM files WHERE user_id = %s AND file_id = %s FOR UPDATE",
+        (user_id, duplicate_file_id)
+    )
+    row = cur.fetchone()
+    if row is None:
+        return 0, {}
+    duplicate_tags, upload_date = row
+    added = [tag for tag in dict.fromkeys(duplicate_tags) if tag not in keep_tags]
+
+    deltas = {}
+    tag_deltas = {}
+    cur.execute(
+        """
+        DELETE FROM file_tags ft
+        USING tags t
+        WHERE ft.tag_id = t.tag_id AND ft.file_id = %s
+        RETURNING ft.tag_id, t.tag_name
+        """,
+        (duplicate_file_id,)
+    )
+    for tag_id, tag_name in cur.fetchall():
+        deltas[tag_id] = -1
+        tag_deltas[tag_name] = -1
+    cur.execute("DELETE FROM files WHERE user_id = %s AND file_id = %s", (user_id, duplicate_file_id))
+
+    if added:
+        for tag_name, tag_id in _link_tags(cur, keep_file_id, added).items():
+            deltas[tag_id] = deltas.get(tag_id, 0) + 1
+            tag_deltas[tag_name] = tag_deltas.get(tag_name, 0) + 1
+    cur.execute(
+        """
+        UPDATE files SET tags = tags || %s::text[], upload_date = LEAST(upload_date, %s)
+        WHERE user_id = %s AND file_id = %s
+        """,
+        (added, upload_date, user_id, keep_file_id)
+    )
+    return _adjust_user_tags(cur, user_id, deltas), tag_deltas
+
+
+def assign_file_unique_ids(assignments):
+    """
+    Records the file_unique_id of files saved before it was, given as
+    (user_id, file_id, file_unique_id) triples, in one transaction. A file
+    whose file_unique_id the user already has on another file is collapsed
+    into that one (see _collapse_duplicate), so earlier triples win.
+    Returns the number of files collapsed, or None if nothing was committed.
+    """
+    if not assignments:
+        return 0
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("add_user skipped: DB unavailable")
-            return
         cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO users (user_id, username) VALUES (%s, %s)
-            ON CONFLICT (user_id) DO NOTHING
-            """,
-            (user_id, username),
-        )
+        collapsed = Counter()  # user_id -> files removed
+        tag_changes = Counter()  # user_id -> change in distinct tags
+        tag_deltas = {}  # user_id -> {tag_name: change in file count}
+        for user_id, file_id, file_unique_id in assignments:
+            cur.execute(
+                "SELECT file_id, tags FROM files WHERE user_id = %s AND file_unique_id = %s FOR UPDATE",
+                (user_id, file_unique_id)
+            )
+            keeper = cur.fetchone()
+            if keeper is None:
+                cur.execute(
+                    "UPDATE files SET file_unique_id = %s WHERE user_id = %s AND file_id = %s AND file_unique_id IS NULL",
+                    (file_unique_id, user_id, file_id)
+                )
+                continue
+            if keeper[0] == file_id:
+                continue
+            change, deltas = _collapse_duplicate(cur, user_id, keeper[0], keeper[1], file_id)
+            collapsed[user_id] += 1
+            tag_changes[user_id] += change
+            tag_deltas.setdefault(user_id, Counter()).update(deltas)
+
         conn.commit()
+        for user_id, count in collapsed.items():
+            search_cache.invalidate_user(user_id)
+            tag_index.index.apply(user_id, tag_deltas[user_id])
+            activity.record(user_id, uploads=-count, tags=tag_changes[user_id], touch=False)
+        return sum(collapsed.values())
     except Exception:
         if conn:
             try:
                 conn.rollback()
             except Exception:
                 pass
-        logger.exception("Error adding user")
-        # swallow
+        logger.exception("Error assigning file_unique_ids")
+        return None
     finally:
         if cur:
             cur.close()
@@ -434,27 +990,17 @@ def add_user(user_id, username):
             put_db_connection(conn)
 
 
-def update_user_subscription(user_id, plan_name):
-    conn = None
+def get_user(user_id):
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("update_user_subscription skipped: DB unavailable")
-            return
         cur = conn.cursor()
-        cur.execute(
-            "UPDATE users SET subscription_plan = %s WHERE user_id = %s", (plan_name, user_id)
-        )
-        conn.commit()
+        cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+        user = cur.fetchone()
+        return user
     except Exception:
-        if conn:
-            try:
-                conn.rollback()
-            except Exception:
-                pass
-        logger.exception("Error updating user subscription")
-        # swallow
+        logger.exception("Error getting user")
+        return None
     finally:
         if cur:
             cur.close()
@@ -462,18 +1008,17 @@ def update_user_subscription(user_id, plan_name):
             put_db_connection(conn)
 
 
-def record_upload(user_id):
-    conn = None
+def add_user(user_id, username):
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("record_upload skipped: DB unavailable")
-            return
         cur = conn.cursor()
         cur.execute(
-            "UPDATE users SET upload_count = upload_count + 1, last_active = NOW() WHERE user_id = %s",
-            (user_id,),
+            """
+            INSERT INTO users (user_id, username) VALUES (%s, %s)
+            ON CONFLICT (user_id) DO NOTHING
+            """,
+            (user_id, username),
         )
         conn.commit()
     except Exception:
@@ -482,7 +1027,7 @@ def record_upload(user_id):
                 conn.rollback()
             except Exception:
                 pass
-        logger.exception("Error recording upload")
+        logger.exception("Error adding user")
         # swallow
     finally:
         if cur:
@@ -491,18 +1036,13 @@ def record_upload(user_id):
             put_db_connection(conn)
 
 
-def record_tag_usage(user_id, num_tags):
-    conn = None
+def update_user_subscription(user_id, plan_name):
+    conn = _require_connection()
     cur = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("record_tag_usage skipped: DB unavailable")
-            return
         cur = conn.cursor()
         cur.execute(
-            "UPDATE users SET tag_count = tag_count + %s, last_active = NOW() WHERE user_id = %s",
-            (num_tags, user_id),
+            "UPDATE users SET subscription_plan = %s WHERE user_id = %s", (plan_name, user_id)
         )
         conn.commit()
     except Exception:
@@ -511,7 +1051,7 @@ def record_tag_usage(user_id, num_tags):
                 conn.rollback()
             except Exception:
                 pass
-        logger.exception("Error recording tag usage")
+        logger.exception("Error updating user subscription")
         # swallow
     finally:
         if cur:
@@ -519,51 +1059,52 @@ def record_tag_usage(user_id, num_tags):
         if conn:
             put_db_connection(conn)
 
-def _get_user_file_count(user_id):
-    conn = get_db_connection()
-    if conn is None:
-        logger.error("_get_user_file_count: DB unavailable")
-        return 0
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT COUNT(*) FROM files WHERE user_id = %s", (user_id,))
-        count = cur.fetchone()[0]
-        return count
-    except Exception:
-        logger.exception("Error getting user file count")
-        return 0
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        put_db_connection(conn)
 
-def _get_user_unique_tag_count(user_id):
-    conn = get_db_connection()
-    if conn is None:
-        logger.error("_get_user_unique_tag_count: DB unavailable")
-        return 0
-    cur = conn.cursor()
+def record_upload(user_id):
+    """Counts one upload and marks the user active; written by the next activity flush."""
+    activity.record(user_id, uploads=1)
+
+
+def record_tag_usage(user_id, num_tags):
+    """Adds `num_tags` to the user's tag count and marks them active; written by the next activity flush."""
+    activity.record(user_id, tags=num_tags)
+
+
+def _apply_user_activity(rows):
+    """
+    Writes buffered (user_id, upload delta, tag delta, last_active) rows in
+    one statement. Raises on failure so the buffer keeps the rows.
+    """
+    conn = _require_connection()
+    cur = None
     try:
-        cur.execute(
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(
+            cur,
             """
-            SELECT COUNT(DISTINCT t.tag_id)
-            FROM tags t
-            JOIN file_tags ft ON t.tag_id = ft.tag_id
-            JOIN files f ON ft.file_id = f.file_id
-            WHERE f.user_id = %s
+            UPDATE users u SET
+                upload_count = u.upload_count + v.uploads,
+                tag_count = u.tag_count + v.tags,
+                last_active = GREATEST(u.last_active, v.last_active)
+            FROM (VALUES %s) AS v(user_id, uploads, tags, last_active)
+            WHERE u.user_id = v.user_id
             """,
-            (user_id,)
+            rows,
+            template="(%s::bigint, %s::integer, %s::integer, %s::timestamptz)",
+            page_size=len(rows),
         )
-        count = cur.fetchone()[0]
-        return count
+        conn.commit()
     except Exception:
-        logger.exception("Error getting user unique tag count")
-        return 0
-    finally:
         try:
-            cur.close()
+            conn.rollback()
         except Exception:
             pass
+        raise
+    finally:
+        if cur:
+            cur.close()
         put_db_connection(conn)
+
+
+# Users' upload/tag counters and last_active, written behind (see activity.py)
+activity = ActivityBuffer(_apply_user_activity)
@@ -0,0 +1,99 @@
+import asyncio
+
+import async_database as db
+import search_query
+from cache import UserCache
+from config import INLINE_CACHE_SIZE, INLINE_CACHE_TTL, INLINE_MAX_RESULTS, INLINE_DEBOUNCE_SECONDS
+
+# Inline queries arrive on every keystroke, so lookups go through three
+# tiers, cheapest first:
+#   1. the answer cache, (user_id, query) -> (rows, complete);
+#   2. narrowing: a query that only extends a cached one made of plain
+#      terms ("rep" -> "repo", "rep" -> "rep pdf") matches a subset of its
+#      rows, so those are filtered in memory;
+#   3. the database (find_file_details), once the user stops typing.
+# Rows are find_files rows extended by (file_extension, caption). `complete`
+# is False when the query matched more than INLINE_MAX_RESULTS files, in
+# which case it can't be narrowed from.
+
+_answers = UserCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+_latest = {}  # user_id -> token of the user's newest inline query still debouncing
+
+
+def _plain_terms(text):
+    """Lower-cased terms if the query is only ANDed bare terms, else None."""
+    try:
+        node = search_query.parse(text)
+    except search_query.QueryError:
+        return None
+    if node is None:
+        return []
+    nodes = node.operands if isinstance(node, search_query.And) else (node,)
+    if all(isinstance(n, search_query.Predicate) and n.field == "term" for n in nodes):
+        return [n.value.lower() for n in nodes]
+    return None
+
+
+def _matches(row, terms):
+    file_name, tags, file_extension, caption = row[1], row[5], row[6], row[7]
+    haystack = "\n".join(value or "" for value in (file_name, file_extension, tags, caption)).lower()
+    return all(term in haystack for term in terms)
+
+
+def _narrow(user_id, text):
+    """Rows for `text` filtered from the longest cached query it extends, or None."""
+    terms = _plain_terms(text)
+    if terms is None:
+        return None
+    for end in range(len(text) - 1, 0, -1):
+        cached = _answers.get(user_id, text[:end])
+        if cached is None:
+            continue
+        rows, complete = cached
+        old_terms = _plain_terms(text[:end])
+        if not complete or old_terms is None:
+            continue
+        # Every file matching the new terms matches the old ones if each old
+        # term is contained in a new one
+        if all(any(old in new for new in terms) for old in old_terms):
+            return [row for row in rows if _matches(row, terms)]
+    return None
+
+
+def is_cached(user_id, text):
+    return _answers.get(user_id, text) is not None
+
+
+async def lookup(user_id, text):
+    """The files matching `text`, newest first, at most INLINE_MAX_RESULTS of them."""
+    cached = _answers.get(user_id, text)
+    if cached is not None:
+        return cached[0]
+    generation = _answers.generation(user_id)
+    rows = _narrow(user_id, text)
+    complete = True
+    if rows is None:
+        rows = await db.find_file_details(user_id, text, INLINE_MAX_RESULTS + 1)
+        complete = len(rows) <= INLINE_MAX_RESULTS
+        rows = rows[:INLINE_MAX_RESULTS]
+    _answers.put(user_id, text, (rows, complete), generation)
+    return rows
+
+
+async def debounce(user_id):
+    """
+    Waits INLINE_DEBOUNCE_SECONDS. Returns False if a newer inline query from
+    the same user arrived meanwhile; that one will be answered instead.
+    """
+    token = object()
+    _latest[user_id] = token
+    await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
+    if _latest.get(user_id) is not token:
+        return False
+    del _latest[user_id]
+    return True
+
+
+def invalidate(user_id):
+    """Drops a user's cached answers; call after any change to their files."""
+    _answers.invalidate_user(user_id)
@@ -0,0 +1,186 @@
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+from config import SLOW_HANDLER_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Per-handler call records. `resilient` opens a record around every handler
+# call; while it runs, async_database adds the time spent waiting on the
+# database and the send scheduler the time spent on Bot API requests, both
+# found through a context variable, so neither needs to know which handler
+# it is working for. Finished records go to the installed sinks.
+
+_current = contextvars.ContextVar("handler_call", default=None)
+
+
+class CallRecord:
+    """Timings and outcome of one handler call. Times are in seconds."""
+
+    __slots__ = (
+        "handler", "user_id", "started_at", "wall_time", "db_time", "db_calls",
+        "api_time", "api_calls", "ok", "error", "parent",
+    )
+
+    def __init__(self, handler, user_id=None, parent=None):
+        self.handler = handler
+        self.user_id = user_id
+        self.started_at = time.time()
+        self.wall_time = 0.0
+        self.db_time = 0.0
+        self.db_calls = 0
+        self.api_time = 0.0
+        self.api_calls = 0
+        self.ok = True
+        self.error = None  # exception class name when the handler failed
+        self.parent = parent  # record of the handler that called this one, if any
+
+    def fail(self, exc):
+        self.ok = False
+        self.error = type(exc).__name__
+
+    def as_dict(self):
+        return {
+            "handler": self.handler,
+            "user_id": self.user_id,
+            "started_at": self.started_at,
+            "wall_time": self.wall_time,
+            "db_time": self.db_time,
+            "db_calls": self.db_calls,
+            "api_time": self.api_time,
+            "api_calls": self.api_calls,
+            "ok": self.ok,
+            "error": self.error,
+        }
+
+
+def _user_id(args):
+    # Handlers are called as (update, context); the album flush as (application, key)
+    update = args[0] if args else None
+    user = getattr(update, "effective_user", None)
+    return user.id if user is not None else None
+
+
+@contextlib.contextmanager
+def record_call(handler, args=()):
+    """Records the call of `handler` made inside the block; yields its CallRecord."""
+    record = CallRecord(handler, _user_id(args), parent=_current.get())
+    token = _current.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as exc:
+        record.fail(exc)
+        raise
+    finally:
+        record.wall_time = time.perf_counter() - start
+        _current.reset(token)
+        for sink in _sinks:
+            try:
+                sink.record(record)
+            except Exception:
+                # A broken sink must never break a handler
+                logger.exception("Instrumentation sink %r failed", sink)
+
+
+def add_db_time(seconds):
+    """Charges a database call to the running handler (and the handlers that called it)."""
+    record = _current.get()
+    while record is not None:
+        record.db_time += seconds
+        record.db_calls += 1
+        record = record.parent
+
+
+def add_api_time(seconds):
+    """Charges a Bot API request to the running handler (and the handlers that called it)."""
+    record = _current.get()
+    while record is not None:
+        record.api_time += seconds
+        record.api_calls += 1
+        record = record.parent
+
+
+class RingBufferSink:
+    """
+    Keeps the last `size` call records, the last `slow_size` calls slower
+    than `slow_threshold` seconds, and running per-handler totals.
+    """
+
+    def __init__(self, size=1000, slow_size=100, slow_threshold=SLOW_HANDLER_SECONDS):
+        self.slow_threshold = slow_threshold
+        self.records = deque(maxlen=size)
+        self.slow = deque(maxlen=slow_size)
+        self._totals = {}  # handler -> [calls, failures, wall, db, api, max wall]
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        with self._lock:
+            self.records.append(record)
+            if record.wall_time >= self.slow_threshold:
+                self.slow.append(record)
+            totals = self._totals.get(record.handler)
+            if totals is None:
+                totals = self._totals[record.handler] = [0, 0, 0.0, 0.0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += 0 if record.ok else 1
+            totals[2] += record.wall_time
+            totals[3] += record.db_time
+            totals[4] += record.api_time
+            totals[5] = max(totals[5], record.wall_time)
+
+    def summary(self):
+        """Per-handler totals: calls, failures and mean/max wall time plus mean DB and Bot API time."""
+        with self._lock:
+            result = {}
+            for handler, (calls, failures, wall, db_time, api_time, max_wall) in self._totals.items():
+                result[handler] = {
+                    "calls": calls,
+                    "failures": failures,
+                    "mean_wall_time": wall / calls,
+                    "max_wall_time": max_wall,
+                    "mean_db_time": db_time / calls,
+                    "mean_api_time": api_time / calls,
+                }
+            return result
+
+    def slow_samples(self):
+        with self._lock:
+            return [record.as_dict() for record in self.slow]
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+            self.slow.clear()
+            self._totals.clear()
+
+
+class MetricsSink:
+    """Exports call records as Prometheus metrics (see metrics.py and /metrics)."""
+
+    def record(self, record):
+        metrics.HANDLER_SECONDS.observe(record.wall_time, handler=record.handler)
+        metrics.HANDLER_DB_SECONDS.observe(record.db_time, handler=record.handler)
+        metrics.HANDLER_API_SECONDS.observe(record.api_time, handler=record.handler)
+        metrics.HANDLER_CALLS.inc(handler=record.handler, outcome="ok" if record.ok else "error")
+
+
+# The in-memory ring buffer is always installed; other sinks are opt-in.
+ring_buffer = RingBufferSink()
+_sinks = [ring_buffer]
+
+
+def add_sink(sink):
+    """Installs a sink: any object with a record(CallRecord) method."""
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
@@ -0,0 +1,209 @@
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+
+# Minimal Prometheus instruments rendered in the text exposition format
+# (https://prometheus.io/docs/instrumenting/exposition_formats/), enough for
+# the bot's /metrics endpoint without another dependency. All instruments
+# are thread-safe: DB timings are recorded on the worker threads.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Mirrors a count that is kept (and only ever increased) elsewhere."""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, (("le", _format_value(float(bound))),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    """All registered metrics in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how late a sleep of `interval` seconds wakes up.
+    A loop blocked by synchronous work (or starved by too many tasks) shows
+    up here long before handlers start timing out.
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="loop_lag_monitor")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - start - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+
+
+# Instruments recorded by the bot
+HANDLER_SECONDS = Histogram(
+    "backupthing_handler_duration_seconds", "Time spent in each update handler.", ["handler"]
+)
+HANDLER_DB_SECONDS = Histogram(
+    "backupthing_handler_db_seconds", "Time each handler call spent waiting on the database.", ["handler"]
+)
+HANDLER_API_SECONDS = Histogram(
+    "backupthing_handler_api_seconds", "Time each handler call spent on Bot API requests, queueing included.", ["handler"]
+)
+HANDLER_CALLS = Counter(
+    "backupthing_handler_calls_total", "Handler calls by outcome (ok, error).", ["handler", "outcome"]
+)
+DB_QUERY_SECONDS = Histogram(
+    "backupthing_db_query_duration_seconds", "Time spent in each database function, per call.", ["function"]
+)
+
+# Sampled when /metrics is scraped
+DB_POOL_CONNECTIONS = Gauge(
+    "backupthing_db_pool_connections", "Database pool connections by state (in_use, idle, max).", ["state"]
+)
+UPDATES_WAITING = Gauge(
+    "backupthing_updates_waiting", "Updates received but not yet started: behind the same user's earlier updates or waiting for a free slot."
+)
+UPDATES_IN_PROGRESS = Gauge(
+    "backupthing_updates_in_progress", "Updates currently being processed."
+)
+USERS_BUSY = Gauge(
+    "backupthing_users_busy", "Users with an update (or album save) being processed or waiting for their turn."
+)
+SEND_QUEUE_DEPTH = Gauge(
+    "backupthing_send_queue_depth", "Outbound Bot API requests waiting in the send scheduler, by priority.", ["priority"]
+)
+SEND_REQUESTS = Counter(
+    "backupthing_send_requests_total", "Outbound Bot API requests by outcome (sent, retried, failed).", ["outcome"]
+)
+ACTIVITY_PENDING_USERS = Gauge(
+    "backupthing_activity_pending_users", "Users whose upload/tag counters are buffered, waiting for the next flush."
+)
+ACTIVITY_FLUSHES = Counter(
+    "backupthing_activity_flushes_total", "Batched writes of users' activity counters by outcome (ok, failed).", ["outcome"]
+)
+EVENT_LOOP_LAG = Gauge(
+    "backupthing_event_loop_lag_seconds", "How late the last event loop lag probe woke up."
+)
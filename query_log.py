@@ -0,0 +1,224 @@
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+
+from psycopg2 import extensions, sql
+
+from config import SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN, SLOW_QUERY_LOG_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Longest SQL text kept per slow query
+_MAX_SQL_LENGTH = 4000
+
+
+def _shape(value):
+    """Describes a query parameter without revealing it: type plus size for containers and strings."""
+    if value is None:
+        return "None"
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return f"{type(value).__name__}[0]"
+        return f"{type(value).__name__}[{len(value)}] of {_shape(value[0])}"
+    return type(value).__name__
+
+
+def _params_shape(params):
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _shape(value) for key, value in params.items()}
+    return [_shape(value) for value in params]
+
+
+# Comments and quoted literals/identifiers, blanked out before looking at a statement's keywords
+_NOT_KEYWORDS = re.compile(r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"", re.DOTALL)
+# Statements that only read start with one of these...
+_READ_START = re.compile(r"[\s(]*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+# ...and contain none of these: data-modifying CTEs, SELECT ... INTO, row
+# locks (FOR UPDATE/SHARE) and sequence calls
+_WRITE_WORDS = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|INTO|SHARE|NEXTVAL|SETVAL)\b", re.IGNORECASE)
+
+
+def _is_read_only(query_text):
+    """Whether a statement only reads, so running it again for its plan has no effect."""
+    text = _NOT_KEYWORDS.sub(" ", query_text)
+    return bool(_READ_START.match(text)) and not _WRITE_WORDS.search(text)
+
+
+def _caller():
+    """The database function (module.name) that issued the statement, skipping psycopg2 helpers."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module != __name__ and not module.startswith("psycopg2"):
+            return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+class SlowQueryLog:
+    """Bounded, thread-safe store of the most recent slow statements."""
+
+    def __init__(self, size):
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+
+    def recent(self, limit=None):
+        """Newest first."""
+        with self._lock:
+            entries = list(reversed(self._entries))
+        return entries[:limit] if limit is not None else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+slow_queries = SlowQueryLog(SLOW_QUERY_LOG_SIZE)
+
+
+def _record(query_text, vars, elapsed_ms, explain=None):
+    """Logs a slow statement and keeps it in `slow_queries`; `explain()`, if given, returns its plan."""
+    entry = {
+        "at": time.time(),
+        "duration_ms": round(elapsed_ms, 1),
+        "function": _caller(),
+        "sql": query_text[:_MAX_SQL_LENGTH],
+        "params": _params_shape(vars),
+        "plan": None,
+    }
+    logger.warning(
+        "Slow query (%.0f ms) in %s: %s params=%s",
+        elapsed_ms, entry["function"], " ".join(entry["sql"].split())[:500], entry["params"],
+    )
+    # Only statements that just read: EXPLAIN ANALYZE executes the statement again
+    if explain is not None and SLOW_QUERY_EXPLAIN and _is_read_only(query_text):
+        entry["plan"] = explain()
+    slow_queries.add(entry)
+
+
+class TimedCursor(extensions.cursor):
+    """
+    Cursor that times every statement. Statements slower than SLOW_QUERY_MS
+    are logged with the shapes (not the values) of their parameters and kept
+    in `slow_queries`; with SLOW_QUERY_EXPLAIN, statements that only read
+    (SELECT, or WITH ... SELECT without data-modifying CTEs) also get their
+    EXPLAIN (ANALYZE, BUFFERS) plan captured. The pool hands these out for
+    every connection (see database.init_db), so all query functions are
+    covered without changes.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            result = super().execute(query, vars)
+            succeeded = True
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if 0 < SLOW_QUERY_MS <= elapsed_ms:
+                self._record_slow(query, vars, elapsed_ms, explain=succeeded)
+
+    def _record_slow(self, query, vars, elapsed_ms, explain):
+        try:
+            if isinstance(query, sql.Composable):
+                query = query.as_string(self)
+            text = query.decode() if isinstance(query, bytes) else query
+            if isinstance(query, bytes) and vars is None and "VALUES " in text:
+                # execute_values inlines its rows into the statement; keep user data out of the log
+                text = text[:text.index("VALUES ") + 7] + f"... ({len(query)} bytes of inlined rows)"
+            _record(text, vars, elapsed_ms, (lambda: self._explain(query, vars)) if explain else None)
+        except Exception:
+            # Never let the slow-query log break the query it is reporting on
+            logger.exception("Failed to record slow query")
+
+    def _explain(self, query, vars):
+        """
+        Runs the statement again under EXPLAIN (ANALYZE, BUFFERS) inside a
+        savepoint, so a failure leaves the caller's transaction usable. A
+        separate plain cursor is used so the rows this one holds stay
+        fetchable.
+        """
+        if self.connection.status != extensions.STATUS_IN_TRANSACTION:
+            return None
+        prefix = b"EXPLAIN (ANALYZE, BUFFERS) " if isinstance(query, bytes) else "EXPLAIN (ANALYZE, BUFFERS) "
+        cur = self.connection.cursor(cursor_factory=extensions.cursor)
+        try:
+            cur.execute("SAVEPOINT slow_query_explain")
+            try:
+                cur.execute(prefix + query, vars)
+                return "\n".join(row[0] for row in cur.fetchall())
+            finally:
+                cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                cur.execute("RELEASE SAVEPOINT slow_query_explain")
+        except Exception:
+            logger.exception("EXPLAIN of slow query failed")
+            return None
+        finally:
+            cur.close()
+
+
+class TimedSqliteCursor(sqlite3.Cursor):
+    """
+    TimedCursor for the SQLite backend (see sqlite_storage.py). Statements
+    are timed in execute(), which for a SELECT runs until its first row is
+    ready: all of the work for sorted, grouped or aggregated results, but
+    not the rows a plain scan streams to later fetches. Plans are captured
+    with EXPLAIN QUERY PLAN, which does not run the statement.
+    """
+
+    def execute(self, query, parameters=()):
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            result = super().execute(query, parameters)
+            succeeded = True
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if 0 < SLOW_QUERY_MS <= elapsed_ms:
+                self._record_slow(query, parameters, elapsed_ms, explain=succeeded)
+
+    def executemany(self, query, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, seq_of_parameters)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if 0 < SLOW_QUERY_MS <= elapsed_ms:
+                self._record_slow(query, None, elapsed_ms, explain=False)
+
+    def _record_slow(self, query, parameters, elapsed_ms, explain):
+        try:
+            _record(query, parameters, elapsed_ms, (lambda: self._explain(query, parameters)) if explain else None)
+        except Exception:
+            logger.exception("Failed to record slow query")
+
+    def _explain(self, query, parameters):
+        # A plain cursor of the same connection, so this one's rows stay fetchable
+        try:
+            rows = self.connection.execute("EXPLAIN QUERY PLAN " + query, parameters).fetchall()
+        except Exception:
+            logger.exception("EXPLAIN of slow query failed")
+            return None
+        depth = {0: 0}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, 0) + 1
+            lines.append("  " * (depth[node_id] - 1) + detail)
+        return "\n".join(lines)
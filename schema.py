@@ -0,0 +1,283 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Key for pg_advisory_xact_lock, so two bot instances starting at the same
+# time don't apply the same migration twice.
+_MIGRATION_LOCK_KEY = 0x42544D47
+
+
+def _cascade_foreign_key(table, column, ref_table, ref_column):
+    """
+    Statement that makes `table.column` reference `ref_table.ref_column` with
+    ON DELETE CASCADE, replacing any existing non-cascading foreign key
+    between the two tables (hand-made schemas may have one).
+    """
+    return f"""
+        DO $$
+        DECLARE c record;
+        BEGIN
+            FOR c IN
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = '{table}'::regclass AND contype = 'f'
+                  AND confrelid = '{ref_table}'::regclass AND confdeltype <> 'c'
+            LOOP
+                EXECUTE format('ALTER TABLE {table} DROP CONSTRAINT %I', c.conname);
+            END LOOP;
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint
+                WHERE conrelid = '{table}'::regclass AND contype = 'f'
+                  AND confrelid = '{ref_table}'::regclass
+            ) THEN
+                ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey
+                    FOREIGN KEY ({column}) REFERENCES {ref_table} ({ref_column}) ON DELETE CASCADE;
+            END IF;
+        END
+        $$
+    """
+
+
+# Each migration is (version, description, statements). Pending migrations
+# are applied in list order, in one transaction, and recorded in
+# schema_migrations. Never edit a migration once it has shipped; append a
+# new one instead. Statements must be safe to run against a database that
+# already has the objects they create (IF NOT EXISTS), since deployments
+# predating this module were set up by hand.
+MIGRATIONS = [
+    (
+        1,
+        "Base tables",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                subscription_plan TEXT,
+                upload_count INTEGER NOT NULL DEFAULT 0,
+                tag_count INTEGER NOT NULL DEFAULT 0,
+                last_active TIMESTAMPTZ
+            )
+            """,
+            # No foreign key to users: files can arrive from users who never ran /start
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                file_id TEXT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                file_name TEXT NOT NULL,
+                file_extension TEXT,
+                file_type TEXT,
+                telegram_file_category TEXT,
+                caption TEXT,
+                upload_date TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS tags (
+                tag_id SERIAL PRIMARY KEY,
+                tag_name TEXT NOT NULL UNIQUE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS file_tags (
+                file_id TEXT NOT NULL REFERENCES files (file_id) ON DELETE CASCADE,
+                tag_id INTEGER NOT NULL REFERENCES tags (tag_id) ON DELETE CASCADE,
+                PRIMARY KEY (file_id, tag_id)
+            )
+            """,
+        ],
+    ),
+    (
+        2,
+        "Trigram and full-text search over file names, extensions, tags and captions",
+        [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            # Lets user_id share a GIN index with the trigram/tsvector columns
+            "CREATE EXTENSION IF NOT EXISTS btree_gin",
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS search_vector tsvector",
+            """
+            UPDATE files f SET search_vector = to_tsvector(
+                'simple',
+                coalesce(f.file_name, '') || ' ' ||
+                coalesce((
+                    SELECT string_agg(t.tag_name, ' ')
+                    FROM file_tags ft JOIN tags t ON t.tag_id = ft.tag_id
+                    WHERE ft.file_id = f.file_id
+                ), '') || ' ' ||
+                coalesce(f.caption, '')
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS files_user_name_trgm_idx ON files USING gin (user_id, file_name gin_trgm_ops)",
+            "CREATE INDEX IF NOT EXISTS files_user_ext_trgm_idx ON files USING gin (user_id, file_extension gin_trgm_ops)",
+            "CREATE INDEX IF NOT EXISTS files_user_search_idx ON files USING gin (user_id, search_vector)",
+            "CREATE INDEX IF NOT EXISTS tags_name_trgm_idx ON tags USING gin (tag_name gin_trgm_ops)",
+        ],
+    ),
+    (
+        3,
+        "Keyset pagination index for recent files",
+        [
+            "CREATE INDEX IF NOT EXISTS files_user_recent_idx ON files (user_id, upload_date DESC, file_id DESC)",
+        ],
+    ),
+    (
+        4,
+        "Denormalized tag array on files; search_vector maintained by trigger",
+        [
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS tags TEXT[] NOT NULL DEFAULT '{}'",
+            """
+            CREATE OR REPLACE FUNCTION files_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := to_tsvector(
+                    'simple',
+                    coalesce(NEW.file_name, '') || ' ' ||
+                    array_to_string(NEW.tags, ' ') || ' ' ||
+                    coalesce(NEW.caption, '')
+                );
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS files_search_vector_trigger ON files",
+            """
+            CREATE TRIGGER files_search_vector_trigger
+            BEFORE INSERT OR UPDATE OF file_name, tags, caption ON files
+            FOR EACH ROW EXECUTE FUNCTION files_search_vector_update()
+            """,
+            # Also rebuilds search_vector through the trigger
+            """
+            UPDATE files f SET tags = coalesce((
+                SELECT array_agg(t.tag_name ORDER BY t.tag_name)
+                FROM file_tags ft JOIN tags t ON t.tag_id = ft.tag_id
+                WHERE ft.file_id = f.file_id
+            ), '{}')
+            """,
+            "CREATE INDEX IF NOT EXISTS files_user_tags_idx ON files USING gin (user_id, tags)",
+        ],
+    ),
+    (
+        5,
+        "Per-user tag reference counts",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS user_tags (
+                user_id BIGINT NOT NULL,
+                tag_id INTEGER NOT NULL,
+                file_count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, tag_id)
+            )
+            """,
+            """
+            INSERT INTO user_tags (user_id, tag_id, file_count)
+            SELECT f.user_id, ft.tag_id, COUNT(*)
+            FROM file_tags ft JOIN files f ON f.file_id = ft.file_id
+            GROUP BY f.user_id, ft.tag_id
+            ON CONFLICT (user_id, tag_id) DO UPDATE SET file_count = EXCLUDED.file_count
+            """,
+            """
+            UPDATE users u SET tag_count = coalesce((
+                SELECT COUNT(*) FROM user_tags ut WHERE ut.user_id = u.user_id
+            ), 0)
+            """,
+        ],
+    ),
+    (
+        6,
+        "Composite indexes and cascading foreign keys for the hot paths",
+        [
+            # Reverse lookup for tag -> files (the primary key covers file -> tags)
+            "CREATE INDEX IF NOT EXISTS file_tags_tag_file_idx ON file_tags (tag_id, file_id)",
+            # Orphans would block the foreign keys below
+            "DELETE FROM file_tags ft WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.file_id = ft.file_id)",
+            "DELETE FROM file_tags ft WHERE NOT EXISTS (SELECT 1 FROM tags t WHERE t.tag_id = ft.tag_id)",
+            "DELETE FROM user_tags ut WHERE NOT EXISTS (SELECT 1 FROM tags t WHERE t.tag_id = ut.tag_id)",
+            _cascade_foreign_key("file_tags", "file_id", "files", "file_id"),
+            _cascade_foreign_key("file_tags", "tag_id", "tags", "tag_id"),
+            _cascade_foreign_key("user_tags", "tag_id", "tags", "tag_id"),
+        ],
+    ),
+    (
+        7,
+        "Equality index for ext: searches",
+        [
+            "CREATE INDEX IF NOT EXISTS files_user_ext_idx ON files (user_id, lower(file_extension))",
+        ],
+    ),
+    (
+        8,
+        "Per-user deduplication of uploads on file_unique_id",
+        [
+            # NULL for files saved before this migration until backfill_unique_ids.py fills it in
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS file_unique_id TEXT",
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS files_user_unique_id_idx
+            ON files (user_id, file_unique_id) WHERE file_unique_id IS NOT NULL
+            """,
+            # Lets the backfill walk the remaining files in batches; empties as it goes
+            """
+            CREATE INDEX IF NOT EXISTS files_missing_unique_id_idx
+            ON files (upload_date, file_id) WHERE file_unique_id IS NULL
+            """,
+        ],
+    ),
+    (
+        9,
+        "Case-insensitive #tag searches",
+        [
+            """
+            CREATE OR REPLACE FUNCTION lower_tags(tags TEXT[]) RETURNS TEXT[]
+            LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+            AS $$ SELECT coalesce(array_agg(lower(tag)), '{}') FROM unnest(tags) AS t(tag) $$
+            """,
+            "CREATE INDEX IF NOT EXISTS files_user_lower_tags_idx ON files USING gin (user_id, lower_tags(tags))",
+            # Only served the case-sensitive tag search this replaces
+            "DROP INDEX IF EXISTS files_user_tags_idx",
+        ],
+    ),
+    (
+        10,
+        "Drop the trigram index over all users' tag names",
+        [
+            # Bare-term searches look tag names up among the user's own
+            # tags (user_tags), so nothing filters the whole tags table
+            "DROP INDEX IF EXISTS tags_name_trgm_idx",
+        ],
+    ),
+]
+
+
+def migrate(conn):
+    """
+    Applies every pending migration on the given connection.
+    Commits on success; rolls back and re-raises on failure.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+            """
+        )
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_KEY,))
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cur.fetchall()}
+
+        for version, description, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying schema migration %s: %s", version, description)
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description),
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
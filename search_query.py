@@ -0,0 +1,196 @@
+import re
+from typing import NamedTuple
+
+# Search query language, compiled into SQL by each storage backend.
+#
+#   report            bare term: substring of the name, extension, a tag or the caption
+#   "annual report"   quoted term, matched as one phrase
+#   #vacation         has this tag, in any case (also tag:vacation)
+#   ext:pdf           extension is exactly pdf
+#   type:photo        Telegram category: photo, video, audio or document
+#   name:draft        substring of the file name only
+#   a b, a AND b      both
+#   a OR b            either; AND binds tighter than OR
+#   NOT a, -a, -(a b) not
+#   ( ... )           grouping
+#
+# Operators are only recognised in upper case, so ordinary words like "or"
+# stay search terms.
+
+FIELDS = ("term", "tag", "ext", "type", "name")
+
+# Accepted spellings of type: values
+_TYPE_ALIASES = {
+    "photo": "photo", "photos": "photo", "image": "photo", "picture": "photo",
+    "video": "video", "videos": "video", "movie": "video",
+    "audio": "audio", "music": "audio", "song": "audio",
+    "document": "document", "documents": "document", "doc": "document", "file": "document",
+}
+
+# One word: plain characters, quoted phrases (an unclosed quote runs to
+# the end) and, after the first character, parentheses, so names like
+# "scan(1).pdf" stay one term. A "(" or ")" anywhere else is an operator.
+_WORD = re.compile(r'(?:"[^"]*"?|[^\s"()]+)(?:"[^"]*"?|[^\s"()]+|\([^\s"()]*\)?)*')
+
+
+class QueryError(ValueError):
+    """Raised by parse() for a query it can't make sense of; the message is shown to the user."""
+
+
+class Predicate(NamedTuple):
+    field: str  # one of FIELDS
+    value: str
+
+
+class Not(NamedTuple):
+    operand: object
+
+
+class And(NamedTuple):
+    operands: tuple
+
+
+class Or(NamedTuple):
+    operands: tuple
+
+
+def _unquote(text):
+    if text.startswith('"'):
+        text = text[1:]
+        if text.endswith('"'):
+            text = text[:-1]
+    return text
+
+
+def _predicate(word):
+    if word.startswith("#") and len(word) > 1:
+        return Predicate("tag", _unquote(word.lstrip("#")))
+    key, sep, value = word.partition(":")
+    key = key.lower()
+    value = _unquote(value)
+    if sep and value and key in ("tag", "ext", "type", "name"):
+        if key == "tag":
+            return Predicate("tag", value.lstrip("#"))
+        if key == "ext":
+            return Predicate("ext", value.lstrip(".").lower())
+        if key == "type":
+            return Predicate("type", _TYPE_ALIASES.get(value.lower(), value.lower()))
+        return Predicate("name", value)
+    return Predicate("term", _unquote(word))
+
+
+def _tokenize(text):
+    """Yields "(", ")", "AND", "OR", "NOT" and Predicate tokens."""
+    position = 0
+    while position < len(text):
+        char = text[position]
+        if char.isspace():
+            position += 1
+            continue
+        if char in "()":
+            yield char
+            position += 1
+            continue
+        if text.startswith("-(", position):
+            # -( ... ) negates a group
+            yield "NOT"
+            position += 1
+            continue
+        match = _WORD.match(text, position)
+        raw = match.group()
+        position = match.end()
+        if raw in ("AND", "OR", "NOT"):
+            yield raw
+        elif raw.startswith("-") and len(raw) > 1:
+            yield "NOT"
+            yield _predicate(raw[1:])
+        else:
+            yield _predicate(raw)
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == "OR":
+            self.take()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else Or(tuple(operands))
+
+    def parse_and(self):
+        operands = [self.parse_unary()]
+        while self.peek() not in (None, ")", "OR"):
+            if self.peek() == "AND":
+                self.take()
+            operands.append(self.parse_unary())
+        return operands[0] if len(operands) == 1 else And(tuple(operands))
+
+    def parse_unary(self):
+        token = self.take()
+        if token == "NOT":
+            return Not(self.parse_unary())
+        if token == "(":
+            if self.peek() == ")":
+                raise QueryError("there is nothing between '(' and ')'")
+            node = self.parse_or()
+            if self.take() != ")":
+                raise QueryError("a '(' is never closed")
+            return node
+        if isinstance(token, Predicate):
+            return token
+        if token is None:
+            raise QueryError("the query ends with an operator")
+        if token == ")":
+            raise QueryError("there is a ')' without a matching '('")
+        raise QueryError(f"{token} needs a term on both sides")
+
+
+def parse(text):
+    """
+    Parses a search query into a tree of Predicate, Not, And and Or nodes.
+    Returns None for an empty query, which matches every file.
+    """
+    tokens = list(_tokenize(text or ""))
+    if not tokens:
+        return None
+    parser = _Parser(tokens)
+    node = parser.parse_or()
+    if parser.peek() is not None:
+        raise QueryError("there is a ')' without a matching '('")
+    return node
+
+
+def compile_condition(node, leaf):
+    """
+    Renders a parsed query as an SQL condition. `leaf(predicate)` returns the
+    (sql, params) of one predicate in the backend's dialect; the result is
+    (sql, params) with the params in placeholder order. NOT treats a NULL
+    column as not matching, so "-ext:pdf" keeps files without an extension.
+    """
+    if node is None:
+        return "TRUE", []
+    if isinstance(node, Predicate):
+        sql, params = leaf(node)
+        return f"({sql})", list(params)
+    if isinstance(node, Not):
+        sql, params = compile_condition(node.operand, leaf)
+        return f"NOT coalesce({sql}, FALSE)", params
+    parts = [compile_condition(operand, leaf) for operand in node.operands]
+    joiner = " AND " if isinstance(node, And) else " OR "
+    return "(" + joiner.join(sql for sql, _ in parts) + ")", [param for _, params in parts for param in params]
+
+
+def like_pattern(text):
+    """%text% for LIKE/ILIKE with the wildcard characters in `text` escaped (escape character: backslash)."""
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
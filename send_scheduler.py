@@ -0,0 +1,265 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Request priorities; lower values are sent first.
+INTERACTIVE = 0  # direct replies to something the user just did
+BULK = 1  # result pages, album summaries and other multi-message output
+
+# Bot API limits, from https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30  # messages per second across all chats
+PRIVATE_CHAT_RATE = 1  # messages per second in one private chat (short bursts are tolerated)
+GROUP_CHAT_RATE = 20 / 60  # messages per second in one group
+CHAT_BURST = 3
+
+# Answering a callback or inline query doesn't count towards the message
+# limits and the user is waiting on it, so these skip the buckets (but still
+# respect a flood-control pause).
+_UNTHROTTLED_ENDPOINTS = frozenset({
+    "answerCallbackQuery",
+    "answerInlineQuery",
+    "getMe",
+    "getFile",
+    "setWebhook",
+    "deleteWebhook",
+    "getWebhookInfo",
+})
+
+_priority = contextvars.ContextVar("send_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def send_priority(priority):
+    """Sends every Bot API request made inside the block with `priority`."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class SendScheduler(BaseRateLimiter):
+    """
+    Central outbound queue for every Bot API request the bot makes.
+
+    Requests wait in a priority queue until both the global bucket and the
+    target chat's bucket have a token, so the bot sends at the Bot API
+    ceiling instead of running into flood control. INTERACTIVE requests
+    overtake queued BULK ones; within a priority the queue is FIFO. When
+    Telegram still answers 429, the chat (or, for requests without a chat,
+    the whole queue) is paused for `retry_after` and the request is retried
+    up to `max_retries` times before the error is passed to the caller.
+
+    The priority of a request is its `rate_limit_args` if given, else the
+    one set with `send_priority()`, else INTERACTIVE.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, private_chat_rate=PRIVATE_CHAT_RATE,
+                 group_chat_rate=GROUP_CHAT_RATE, chat_burst=CHAT_BURST, max_retries=3):
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._queue = []  # heap of (priority, sequence, chat_id, future)
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._last_prune = time.monotonic()
+
+        # Counters for monitoring, see stats()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+
+    async def initialize(self) -> None:
+        # Called once by the Application and again by the Updater, which share the bot
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="send_scheduler")
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+        while self._queue:
+            future = heapq.heappop(self._queue)[3]
+            if not future.done():
+                future.set_exception(RuntimeError("Send scheduler was shut down"))
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else _priority.get()
+        chat_id = data.get("chat_id") if endpoint not in _UNTHROTTLED_ENDPOINTS else None
+        start = time.monotonic()
+        try:
+            return await self._send(callback, args, kwargs, endpoint, priority, chat_id)
+        finally:
+            # Charged to the handler that made the request, throttling included
+            instrumentation.add_api_time(time.monotonic() - start)
+
+    async def _send(self, callback, args, kwargs, endpoint, priority, chat_id):
+        attempt = 0
+        while True:
+            if endpoint in _UNTHROTTLED_ENDPOINTS:
+                paused_for = self._global.paused_until - time.monotonic()
+                if paused_for > 0:
+                    await asyncio.sleep(paused_for)
+            else:
+                await self._acquire(priority, chat_id)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as exc:
+                retry_after = exc.retry_after
+                seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.pause(seconds)
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    logger.warning("Giving up on %s to chat %s after %s flood-control retries", endpoint, chat_id, attempt)
+                    raise
+                attempt += 1
+                self.retried += 1
+                logger.info("Flood control on %s to chat %s; retrying in %.1fs", endpoint, chat_id, seconds)
+
+    def stats(self):
+        """Queue depth and delivery counters, for health and metrics endpoints."""
+        depth_by_priority = {}
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                depth_by_priority[priority] = depth_by_priority.get(priority, 0) + 1
+        return {
+            "queue_depth": sum(depth_by_priority.values()),
+            "queue_depth_by_priority": depth_by_priority,
+            "max_queue_depth": self.max_queue_depth,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "tracked_chats": len(self._chats),
+        }
+
+    async def _acquire(self, priority, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), chat_id, future))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        self._wakeup.set()
+        await future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative
+            rate = self.group_chat_rate if isinstance(chat_id, int) and chat_id < 0 else self.private_chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await self._sleep(global_wait)
+                continue
+
+            # Release the first queued request whose chat has a token, setting
+            # aside the ones whose chat is still throttled.
+            deferred = []
+            next_ready = None
+            while self._queue:
+                entry = heapq.heappop(self._queue)
+                future = entry[3]
+                if future.done():  # caller was cancelled
+                    continue
+                chat_id = entry[2]
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+                chat_wait = bucket.wait_time(now) if bucket is not None else 0.0
+                if chat_wait > 0:
+                    deferred.append(entry)
+                    next_ready = chat_wait if next_ready is None else min(next_ready, chat_wait)
+                    continue
+                self._global.take(now)
+                if bucket is not None:
+                    bucket.take(now)
+                future.set_result(None)
+                next_ready = 0.0
+                break
+            for entry in deferred:
+                heapq.heappush(self._queue, entry)
+
+            self._prune_idle_chats(now)
+            if next_ready:
+                await self._sleep(next_ready)
+            else:
+                # Let the released request run before picking the next one
+                await asyncio.sleep(0)
+
+    async def _sleep(self, seconds):
+        """Sleeps for `seconds`, waking early if a new request is queued."""
+        self._wakeup.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+
+    def _prune_idle_chats(self, now):
+        # Buckets of chats that have been quiet long enough to be full again
+        # carry no state worth keeping.
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.is_idle(now)]:
+            del self._chats[chat_id]
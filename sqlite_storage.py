@@ -0,0 +1,1069 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+from activity import ActivityBuffer
+from config import DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX
+from query_log import TimedSqliteCursor
+import search_query
+import tag_index
+from storage import StorageUnavailable
+
+# Embedded storage backend: the database.py query functions on a local
+# SQLite file in WAL mode, selected with a sqlite: DATABASE_URL (see
+# storage.py). Readers never block the single writer and vice versa; write
+# transactions take the write lock up front (BEGIN IMMEDIATE) so concurrent
+# writers queue on the busy timeout instead of failing on lock upgrade.
+# Search goes through an FTS5 trigram index, which answers substring
+# matches on names, extensions, tags and captions, and equality indexes for
+# #tag and ext: predicates.
+
+db_pool = None
+logger = logging.getLogger(__name__)
+
+# Seconds a writer waits for the write lock before giving up
+BUSY_TIMEOUT = 10
+
+# Stored as UTC text that sorts in time order; the declared column type
+# routes values through the adapter and converter below.
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def _adapt_timestamp(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime(_TIMESTAMP_FORMAT)
+
+
+def _convert_timestamp(raw):
+    return datetime.strptime(raw.decode(), _TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+
+sqlite3.register_adapter(datetime, _adapt_timestamp)
+sqlite3.register_converter("TIMESTAMPTZ", _convert_timestamp)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+# Each migration is (version, description, statements), applied in order and
+# recorded in PRAGMA user_version. Append new ones; never edit a shipped one.
+MIGRATIONS = [
+    (
+        1,
+        "Base tables, tag reference counts and FTS5 search",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                subscription_plan TEXT,
+                upload_count INTEGER NOT NULL DEFAULT 0,
+                tag_count INTEGER NOT NULL DEFAULT 0,
+                last_active TIMESTAMPTZ
+            )
+            """,
+            # `id` gives the FTS index a rowid that VACUUM can't renumber;
+            # `tags` is a JSON array in display order, mirroring file_tags.
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                file_id TEXT NOT NULL UNIQUE,
+                user_id INTEGER NOT NULL,
+                file_name TEXT NOT NULL,
+                file_extension TEXT,
+                file_type TEXT,
+                telegram_file_category TEXT,
+                caption TEXT,
+                upload_date TIMESTAMPTZ NOT NULL,
+                tags TEXT NOT NULL DEFAULT '[]'
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS files_user_recent_idx ON files (user_id, upload_date DESC, file_id DESC)",
+            """
+            CREATE TABLE IF NOT EXISTS tags (
+                tag_id INTEGER PRIMARY KEY,
+                tag_name TEXT NOT NULL UNIQUE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS file_tags (
+                file_id TEXT NOT NULL REFERENCES files (file_id) ON DELETE CASCADE,
+                tag_id INTEGER NOT NULL REFERENCES tags (tag_id) ON DELETE CASCADE,
+                PRIMARY KEY (file_id, tag_id)
+            ) WITHOUT ROWID
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS user_tags (
+                user_id INTEGER NOT NULL,
+                tag_id INTEGER NOT NULL REFERENCES tags (tag_id) ON DELETE CASCADE,
+                file_count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, tag_id)
+            ) WITHOUT ROWID
+            """,
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5 (
+                file_name, file_extension, tags, caption,
+                content = 'files', content_rowid = 'id', tokenize = 'trigram'
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+                INSERT INTO files_fts (rowid, file_name, file_extension, tags, caption)
+                VALUES (new.id, new.file_name, new.file_extension, new.tags, new.caption);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+                INSERT INTO files_fts (files_fts, rowid, file_name, file_extension, tags, caption)
+                VALUES ('delete', old.id, old.file_name, old.file_extension, old.tags, old.caption);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE OF file_name, file_extension, tags, caption ON files BEGIN
+                INSERT INTO files_fts (files_fts, rowid, file_name, file_extension, tags, caption)
+                VALUES ('delete', old.id, old.file_name, old.file_extension, old.tags, old.caption);
+                INSERT INTO files_fts (rowid, file_name, file_extension, tags, caption)
+                VALUES (new.id, new.file_name, new.file_extension, new.tags, new.caption);
+            END
+            """,
+        ],
+    ),
+    (
+        2,
+        "Equality indexes for #tag and ext: searches",
+        [
+            "CREATE INDEX IF NOT EXISTS file_tags_tag_file_idx ON file_tags (tag_id, file_id)",
+            "CREATE INDEX IF NOT EXISTS files_user_ext_idx ON files (user_id, lower(file_extension))",
+        ],
+    ),
+    (
+        3,
+        "Per-user deduplication of uploads on file_unique_id",
+        [
+            "ALTER TABLE files ADD COLUMN file_unique_id TEXT",
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS files_user_unique_id_idx
+            ON files (user_id, file_unique_id) WHERE file_unique_id IS NOT NULL
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS files_missing_unique_id_idx
+            ON files (upload_date, file_id) WHERE file_unique_id IS NULL
+            """,
+        ],
+    ),
+    (
+        4,
+        "Case-insensitive #tag searches",
+        [
+            "CREATE INDEX IF NOT EXISTS tags_lower_name_idx ON tags (lower(tag_name))",
+        ],
+    ),
+]
+
+
+def _database_path(url):
+    """sqlite:///abs/path.db -> /abs/path.db, sqlite:relative.db -> relative.db"""
+    path = url[len("sqlite:"):]
+    if path.startswith("//"):
+        path = path[2:]
+    return path
+
+
+def _connect(path):
+    # Autocommit mode: reads run without a transaction, writes open one
+    # explicitly with BEGIN IMMEDIATE and end it with commit()/rollback().
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,
+        check_same_thread=False,  # connections move between the DB worker threads
+        detect_types=sqlite3.PARSE_DECLTYPES,
+    )
+    conn.execute("PRAGMA journal_mode = WAL")
+    # WAL makes NORMAL durable against application crashes; only an OS
+    # crash can lose the last commits.
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+class _ConnectionPool:
+    """
+    Thread-safe pool of SQLite connections with the getconn/putconn/closeall
+    interface of psycopg2's pools. Opens connections on demand, up to maxconn.
+    """
+
+    def __init__(self, minconn, maxconn, path):
+        self.maxconn = maxconn
+        self._path = path
+        self._idle = queue.LifoQueue()
+        self._in_use = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+        for _ in range(minconn):
+            self._idle.put(_connect(path))
+            self._opened += 1
+
+    def getconn(self):
+        with self._lock:
+            if self._idle.empty() and self._opened < self.maxconn:
+                self._opened += 1
+                opening = True
+            else:
+                opening = False
+            self._in_use += 1
+        try:
+            return _connect(self._path) if opening else self._idle.get(timeout=BUSY_TIMEOUT)
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                if opening:
+                    self._opened -= 1
+            raise
+
+    def putconn(self, conn, close=False):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+            if close:
+                self._opened -= 1
+        if close:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    def closeall(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+        with self._lock:
+            self._opened = self._in_use
+
+    def stats(self):
+        with self._lock:
+            return self._in_use, self._idle.qsize(), self.maxconn
+
+
+def init_db():
+    global db_pool
+    if db_pool is None:
+        try:
+            path = _database_path(DATABASE_URL)
+            if path and path != ":memory:" and os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # One connection more than the DB workers, for the activity flusher
+            db_pool = _ConnectionPool(DB_POOL_MIN, DB_POOL_MAX + 1, path)
+            logger.info("SQLite database %s opened.", path)
+        except Exception:
+            logger.exception("Error opening SQLite database")
+            db_pool = None
+            return
+        _migrate()
+        activity.start()
+
+
+def _migrate():
+    conn = get_db_connection()
+    if conn is None:
+        logger.error("Schema migration skipped: DB unavailable")
+        return
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, description, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info("Applying schema migration %s: %s", target, description)
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {int(target)}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        logger.exception("Error applying schema migrations")
+    finally:
+        put_db_connection(conn)
+
+
+def close_db():
+    global db_pool
+    if db_pool is not None:
+        # Last chance to write the buffered counters
+        activity.close()
+        try:
+            db_pool.closeall()
+            logger.info("SQLite database closed.")
+        except Exception:
+            logger.exception("Error closing SQLite database")
+        db_pool = None
+
+
+def get_db_connection():
+    global db_pool
+    if db_pool is None:
+        init_db()
+        if db_pool is None:
+            return None
+    try:
+        return db_pool.getconn()
+    except Exception:
+        logger.exception("Failed to get DB connection from pool")
+        return None
+
+
+def put_db_connection(conn, close=False):
+    if db_pool is not None and conn is not None:
+        try:
+            db_pool.putconn(conn, close=close)
+        except Exception:
+            logger.exception("Failed to return DB connection to pool")
+
+
+def _require_connection():
+    conn = get_db_connection()
+    if conn is None:
+        raise StorageUnavailable("SQLite database unavailable")
+    return conn
+
+
+def ping():
+    """True if the database answers a trivial query; see database.ping."""
+    conn = None
+    ok = False
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            return False
+        conn.execute("SELECT 1").fetchone()
+        ok = True
+    except Exception:
+        logger.exception("Database ping failed")
+    finally:
+        if conn:
+            put_db_connection(conn, close=not ok)
+    return ok
+
+
+def pool_stats():
+    """(in_use, idle, max) connection counts of the pool, or None if it isn't open."""
+    current = db_pool
+    if current is None:
+        return None
+    return current.stats()
+
+
+def activity_stats():
+    """(users with counters pending, flushes, failed flushes) of the activity buffer."""
+    return activity.pending_users(), activity.flushes, activity.failed_flushes
+
+
+def _upsert_tags(cur, tag_names):
+    """Resolves tag names to ids, creating the missing ones. Returns a {tag_name: tag_id} dict."""
+    names = list(dict.fromkeys(tag_names))
+    if not names:
+        return {}
+    cur.executemany("INSERT OR IGNORE INTO tags (tag_name) VALUES (?)", [(name,) for name in names])
+    cur.execute(
+        "SELECT tag_id, tag_name FROM tags WHERE tag_name IN (SELECT value FROM json_each(?))",
+        (json.dumps(names),),
+    )
+    return {tag_name: tag_id for tag_id, tag_name in cur.fetchall()}
+
+
+def _adjust_user_tags(cur, user_id, deltas):
+    """
+    Applies {tag_id: change in file count} to the user's user_tags rows, like
+    database._adjust_user_tags. Returns the change in the user's number of
+    distinct tags, for the caller to pass on to `activity` after commit.
+    """
+    increments = {tag_id: delta for tag_id, delta in deltas.items() if delta > 0}
+    decrements = {tag_id: -delta for tag_id, delta in deltas.items() if delta < 0}
+    change = 0
+    if increments:
+        cur.execute(
+            "SELECT COUNT(*) FROM user_tags WHERE user_id = ? AND tag_id IN (SELECT value FROM json_each(?))",
+            (user_id, json.dumps(list(increments))),
+        )
+        change += len(increments) - cur.fetchone()[0]
+        cur.executemany(
+            """
+            INSERT INTO user_tags (user_id, tag_id, file_count) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, tag_id) DO UPDATE SET file_count = file_count + excluded.file_count
+            """,
+            [(user_id, tag_id, delta) for tag_id, delta in increments.items()],
+        )
+    if decrements:
+        cur.executemany(
+            "UPDATE user_tags SET file_count = file_count - ? WHERE user_id = ? AND tag_id = ?",
+            [(delta, user_id, tag_id) for tag_id, delta in decrements.items()],
+        )
+        cur.execute(
+            "DELETE FROM user_tags WHERE user_id = ? AND tag_id IN (SELECT value FROM json_each(?)) AND file_count <= 0",
+            (user_id, json.dumps(list(decrements))),
+        )
+        change -= cur.rowcount
+    return change
+
+
+def _link_tags(cur, file_id, tag_names):
+    tag_ids = _upsert_tags(cur, tag_names)
+    cur.executemany(
+        "INSERT OR IGNORE INTO file_tags (file_id, tag_id) VALUES (?, ?)",
+        [(file_id, tag_id) for tag_id in tag_ids.values()],
+    )
+    return tag_ids
+
+
+def _insert_files(cur, user_id, uploads):
+    """
+    Inserts one user's uploads (see database._insert_files), merging the
+    ones whose file_unique_id or file_id the user already has into the
+    existing files. The existing files are read first rather than upserted:
+    BEGIN IMMEDIATE holds the database's write lock, so nothing can insert
+    in between. Returns the number of new files, the change in the user's
+    distinct tags and the per-name tag deltas.
+    """
+    upload_date = _now()
+    unique_ids = [upload[7] for upload in uploads if upload[7]]
+    existing = {}  # file_unique_id -> (file_id, tags, whether inserted by this batch)
+    existing_ids = {}  # file_id -> the same, for files saved before file_unique_id was recorded
+    cur.execute(
+        """
+        SELECT file_unique_id, file_id, tags FROM files
+        WHERE user_id = ? AND (file_unique_id IN (SELECT value FROM json_each(?)) OR file_id IN (SELECT value FROM json_each(?)))
+        """,
+        (user_id, json.dumps(unique_ids), json.dumps([upload[0] for upload in uploads])),
+    )
+    for file_unique_id, file_id, tags in cur.fetchall():
+        existing_ids[file_id] = (file_id, json.loads(tags), False)
+        if file_unique_id:
+            existing[file_unique_id] = existing_ids[file_id]
+
+    rows = []
+    merged = {}  # file_id -> [tags, file_unique_id to record] of existing files that changed
+    links = []  # (file_id, tag_name) not linked yet
+    for file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id in uploads:
+        tags = list(dict.fromkeys(tags))
+        target = existing.get(file_unique_id) if file_unique_id else None
+        recorded_id = None
+        if target is None and file_id in existing_ids:
+            # Saved before uploads were deduplicated: merge by file_id and
+            # record the file_unique_id now (no other file has it, see above)
+            target = existing_ids[file_id]
+            if file_unique_id and file_unique_id not in existing:
+                existing[file_unique_id] = target
+                recorded_id = file_unique_id
+        if target is not None:
+            target_id, target_tags, is_new = target
+            added = [tag for tag in tags if tag not in target_tags]
+            target_tags.extend(added)
+            links.extend((target_id, tag_name) for tag_name in added)
+            if (added or recorded_id) and not is_new:
+                entry = merged.setdefault(target_id, [target_tags, None])
+                entry[1] = entry[1] or recorded_id
+            continue
+        rows.append((user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, upload_date, tags, file_unique_id))
+        links.extend((file_id, tag_name) for tag_name in tags)
+        if file_unique_id:
+            existing[file_unique_id] = (file_id, tags, True)
+
+    # Tags are serialized only now, after repeats later in the batch have been merged in
+    cur.executemany(
+        """
+        INSERT INTO files (user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, upload_date, tags, file_unique_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [row[:8] + (json.dumps(row[8]), row[9]) for row in rows],
+    )
+    cur.executemany(
+        "UPDATE files SET tags = ?, file_unique_id = coalesce(file_unique_id, ?) WHERE user_id = ? AND file_id = ?",
+        [(json.dumps(tags), file_unique_id, user_id, file_id) for file_id, (tags, file_unique_id) in merged.items()],
+    )
+    tag_ids = _upsert_tags(cur, [tag_name for _, tag_name in links])
+    cur.executemany(
+        "INSERT OR IGNORE INTO file_tags (file_id, tag_id) VALUES (?, ?)",
+        [(file_id, tag_ids[tag_name]) for file_id, tag_name in links],
+    )
+    tag_change = _adjust_user_tags(cur, user_id, Counter(tag_ids[tag_name] for _, tag_name in links))
+    return len(rows), tag_change, Counter(tag_name for _, tag_name in links)
+
+
+def _fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+_LIKE_ESCAPE = "ESCAPE '\\'"
+
+
+def _predicate_sql(predicate):
+    """
+    SQL for one search predicate (see search_query.py and
+    database._predicate_sql). Tags and extensions are case-insensitive
+    equality lookups on indexes (SQLite's lower() only folds ASCII). Names
+    and bare terms of three or more characters go through the FTS5 trigram
+    index (names through its file_name column only); shorter ones, which
+    trigrams can't index, through LIKE over the user's rows.
+    """
+    field, value = predicate
+    if field == "tag":
+        # Tags saved before captions had their '#' stripped may still carry one
+        return (
+            "f.file_id IN (SELECT ft.file_id FROM tags t JOIN file_tags ft ON ft.tag_id = t.tag_id "
+            "WHERE lower(t.tag_name) IN (lower(?), lower(?)))",
+            [value, "#" + value],
+        )
+    if field == "ext":
+        return "lower(f.file_extension) = ?", [value]
+    if field == "type":
+        return "f.telegram_file_category = ?", [value]
+    if len(value) >= 3:
+        phrase = _fts_phrase(value)
+        if field == "name":
+            phrase = "file_name : " + phrase
+        return "f.id IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)", [phrase]
+    pattern = search_query.like_pattern(value)
+    if field == "name":
+        return f"f.file_name LIKE ? {_LIKE_ESCAPE}", [pattern]
+    return (
+        f"f.file_name LIKE ? {_LIKE_ESCAPE} OR f.file_extension LIKE ? {_LIKE_ESCAPE} "
+        f"OR f.tags LIKE ? {_LIKE_ESCAPE} OR f.caption LIKE ? {_LIKE_ESCAPE}",
+        [pattern] * 4,
+    )
+
+
+def _match_condition(user_id, query):
+    """Condition and parameters matching the user's files that satisfy `query`."""
+    condition, params = search_query.compile_condition(search_query.parse(query), _predicate_sql)
+    return f"f.user_id = ? AND {condition}", [user_id] + params
+
+
+# Same row shape as database._FILE_ROW_COLUMNS once _file_row has joined the tags
+_FILE_ROW_COLUMNS = "f.file_id, f.file_name, f.file_type, f.telegram_file_category, f.upload_date, f.tags"
+
+
+def _file_row(row):
+    return row[:5] + (", ".join(json.loads(row[5])),) + row[6:]
+
+
+def _keyset(after=None, before=None):
+    """SQL keyset condition, its parameters and the scan direction; see database._keyset."""
+    if after is not None:
+        return "(f.upload_date, f.file_id) < (?, ?)", list(after), "DESC"
+    if before is not None:
+        return "(f.upload_date, f.file_id) > (?, ?)", list(before), "ASC"
+    return "1", [], "DESC"
+
+
+def _list_files(cur, condition, params, limit=None, offset=0, after=None, before=None, columns=_FILE_ROW_COLUMNS):
+    keyset, keyset_params, order = _keyset(after, before)
+    sql = f"""
+        SELECT {columns}
+        FROM files f
+        WHERE {condition} AND {keyset}
+        ORDER BY f.upload_date {order}, f.file_id {order}
+    """
+    params = params + keyset_params
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+    cur.execute(sql, params)
+    files = [_file_row(row) for row in cur.fetchall()]
+    if order == "ASC":
+        files.reverse()
+    return files
+
+
+def add_file(user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags):
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute("BEGIN IMMEDIATE")
+        _, tag_change, tag_deltas = _insert_files(cur, user_id, [(file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, None)])
+        conn.commit()
+        tag_index.index.apply(user_id, tag_deltas)
+        activity.record(user_id, tags=tag_change, touch=False)
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        logger.exception("Error adding file")
+        # swallow
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def save_upload(user_id, file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id=None):
+    """See database.save_upload. Returns 1 for a duplicate, 0 for a new file, None if nothing was committed."""
+    return save_uploads(user_id, [(file_id, file_name, file_extension, file_type, telegram_file_category, caption, tags, file_unique_id)])
+
+
+def save_uploads(user_id, uploads):
+    """See database.save_uploads. Returns the number of duplicates merged, or None if nothing was committed."""
+    if not uploads:
+        return 0
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute("BEGIN IMMEDIATE")
+        inserted, tag_change, tag_deltas = _insert_files(cur, user_id, uploads)
+        conn.commit()
+        tag_index.index.apply(user_id, tag_deltas)
+        activity.record(user_id, uploads=inserted, tags=tag_change)
+        return len(uploads) - inserted
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        logger.exception("Error saving uploads")
+        return None
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def find_files(user_id, query, limit=None, offset=0, after=None, before=None):
+    # No result cache as in database.find_files: the index lookup and the
+    # keyset page are both local reads.
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        condition, params = _match_condition(user_id, query)
+        return _list_files(cur, condition, params, limit, offset, after, before)
+    except Exception:
+        logger.exception("Error finding files")
+        return []
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def find_file_details(user_id, query, limit):
+    """See database.find_file_details."""
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        condition, params = _match_condition(user_id, query)
+        return _list_files(cur, condition, params, limit, columns=_FILE_ROW_COLUMNS + ", f.file_extension, f.caption")
+    except Exception:
+        logger.exception("Error finding file details")
+        return []
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def get_all_tags(user_id):
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute(
+            """
+            SELECT t.tag_name
+            FROM user_tags ut
+            JOIN tags t ON t.tag_id = ut.tag_id
+            WHERE ut.user_id = ?
+            ORDER BY t.tag_name
+            """,
+            (user_id,),
+        )
+        return [row[0] for row in cur.fetchall()]
+    except Exception:
+        logger.exception("Error getting all tags")
+        return []
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def get_tag_counts(user_id):
+    """See database.get_tag_counts. Returns None if the tags couldn't be read."""
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute(
+            """
+            SELECT t.tag_name, ut.file_count
+            FROM user_tags ut
+            JOIN tags t ON t.tag_id = ut.tag_id
+            WHERE ut.user_id = ?
+            """,
+            (user_id,),
+        )
+        return cur.fetchall()
+    except Exception:
+        logger.exception("Error getting tag counts")
+        return None
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def update_file_metadata(user_id, file_id, new_file_name=None, tags_to_modify=None, tag_operation=None):
+    change_tags = tags_to_modify is not None and tag_operation is not None
+    if new_file_name is None and not change_tags:
+        return 0
+    if change_tags and tag_operation not in ("set", "add", "remove"):
+        return 0
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT tags FROM files WHERE user_id = ? AND file_id = ?", (user_id, file_id))
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback()
+            return 0
+        current_tags = json.loads(row[0])
+        updated_tags = current_tags
+        tag_change = 0
+        tag_deltas = {}
+
+        if change_tags:
+            # Keep the existing order and append new tags, so listings stay stable
+            modify = list(dict.fromkeys(tags_to_modify))
+            if tag_operation == "set":
+                updated_tags = modify
+            elif tag_operation == "add":
+                updated_tags = current_tags + [tag for tag in modify if tag not in current_tags]
+            else:
+                updated_tags = [tag for tag in current_tags if tag not in modify]
+
+            deltas = {}
+            tags_to_remove = set(current_tags).difference(updated_tags)
+            if tags_to_remove:
+                cur.execute(
+                    """
+                    SELECT ft.tag_id, t.tag_name FROM file_tags ft JOIN tags t ON t.tag_id = ft.tag_id
+                    WHERE ft.file_id = ? AND t.tag_name IN (SELECT value FROM json_each(?))
+                    """,
+                    (file_id, json.dumps(list(tags_to_remove))),
+                )
+                removed = cur.fetchall()
+                cur.executemany("DELETE FROM file_tags WHERE file_id = ? AND tag_id = ?", [(file_id, tag_id) for tag_id, _ in removed])
+                for tag_id, tag_name in removed:
+                    deltas[tag_id] = -1
+                    tag_deltas[tag_name] = -1
+
+            tags_to_add = [tag for tag in updated_tags if tag not in current_tags]
+            if tags_to_add:
+                for tag_name, tag_id in _link_tags(cur, file_id, tags_to_add).items():
+                    deltas[tag_id] = deltas.get(tag_id, 0) + 1
+                    tag_deltas[tag_name] = tag_deltas.get(tag_name, 0) + 1
+
+            tag_change = _adjust_user_tags(cur, user_id, deltas)
+
+        # files.tags mirrors file_tags; the FTS triggers pick up both columns
+        cur.execute(
+            "UPDATE files SET file_name = COALESCE(?, file_name), tags = ? WHERE user_id = ? AND file_id = ?",
+            (new_file_name, json.dumps(updated_tags), user_id, file_id),
+        )
+        rows_updated = cur.rowcount
+        conn.commit()
+        tag_index.index.apply(user_id, tag_deltas)
+        if tag_change:
+            activity.record(user_id, tags=tag_change, touch=False)
+        return rows_updated
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        logger.exception("Error updating file metadata")
+        return 0
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def get_recent_files(user_id, limit=10, offset=0, after=None, before=None):
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        return _list_files(cur, "f.user_id = ?", [user_id], limit, offset, after, before)
+    except Exception:
+        logger.exception("Error getting recent files")
+        return []
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def delete_files(user_id, query):
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute("BEGIN IMMEDIATE")
+        condition, params = _match_condition(user_id, query)
+        cur.execute(f"SELECT f.file_id FROM files f WHERE {condition}", params)
+        file_ids_to_delete = json.dumps([row[0] for row in cur.fetchall()])
+
+        cur.execute(
+            """
+            SELECT ft.tag_id, t.tag_name, COUNT(*) FROM file_tags ft JOIN tags t ON t.tag_id = ft.tag_id
+            WHERE ft.file_id IN (SELECT value FROM json_each(?))
+            GROUP BY ft.tag_id
+            """,
+            (file_ids_to_delete,),
+        )
+        removed = cur.fetchall()
+        deltas = {tag_id: -count for tag_id, _, count in removed}
+        tag_deltas = {tag_name: -count for _, tag_name, count in removed}
+        # file_tags rows go with their files (ON DELETE CASCADE)
+        cur.execute(
+            "DELETE FROM files WHERE user_id = ? AND file_id IN (SELECT value FROM json_each(?))",
+            (user_id, file_ids_to_delete),
+        )
+        rows_deleted = cur.rowcount
+        tag_change = _adjust_user_tags(cur, user_id, deltas)
+        conn.commit()
+        tag_index.index.apply(user_id, tag_deltas)
+        if rows_deleted:
+            activity.record(user_id, uploads=-rows_deleted, tags=tag_change, touch=False)
+        return rows_deleted
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        logger.exception("Error deleting files")
+        return 0
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def get_files_without_unique_id(limit, after=None):
+    """See database.get_files_without_unique_id."""
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        condition, params = "1", []
+        if after is not None:
+            condition, params = "(upload_date, file_id) > (?, ?)", list(after)
+        cur.execute(
+            f"""
+            SELECT upload_date, file_id, user_id
+            FROM files
+            WHERE file_unique_id IS NULL AND {condition}
+            ORDER BY upload_date, file_id
+            LIMIT ?
+            """,
+            params + [limit],
+        )
+        return cur.fetchall()
+    except Exception:
+        logger.exception("Error getting files without file_unique_id")
+        return None
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def _collapse_duplicate(cur, user_id, keep_file_id, keep_tags, duplicate_file_id):
+    """See database._collapse_duplicate."""
+    cur.execute("SELECT tags, upload_date FROM files WHERE user_id = ? AND file_id = ?", (user_id, duplicate_file_id))
+    row = cur.fetchone()
+    if row is None:
+        return 0, {}
+    duplicate_tags, upload_date = json.loads(row[0]), row[1]
+    added = [tag for tag in dict.fromkeys(duplicate_tags) if tag not in keep_tags]
+
+    cur.execute(
+        "SELECT ft.tag_id, t.tag_name FROM file_tags ft JOIN tags t ON t.tag_id = ft.tag_id WHERE ft.file_id = ?",
+        (duplicate_file_id,),
+    )
+    removed = cur.fetchall()
+    deltas = {tag_id: -1 for tag_id, _ in removed}
+    tag_deltas = {tag_name: -1 for _, tag_name in removed}
+    # file_tags rows go with the file (ON DELETE CASCADE)
+    cur.execute("DELETE FROM files WHERE user_id = ? AND file_id = ?", (user_id, duplicate_file_id))
+
+    if added:
+        for tag_name, tag_id in _link_tags(cur, keep_file_id, added).items():
+            deltas[tag_id] = deltas.get(tag_id, 0) + 1
+            tag_deltas[tag_name] = tag_deltas.get(tag_name, 0) + 1
+    cur.execute(
+        "UPDATE files SET tags = ?, upload_date = min(upload_date, ?) WHERE user_id = ? AND file_id = ?",
+        (json.dumps(keep_tags + added), upload_date, user_id, keep_file_id),
+    )
+    return _adjust_user_tags(cur, user_id, deltas), tag_deltas
+
+
+def assign_file_unique_ids(assignments):
+    """See database.assign_file_unique_ids. Returns the number of files collapsed, or None."""
+    if not assignments:
+        return 0
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute("BEGIN IMMEDIATE")
+        collapsed = Counter()  # user_id -> files removed
+        tag_changes = Counter()  # user_id -> change in distinct tags
+        tag_deltas = {}  # user_id -> {tag_name: change in file count}
+        for user_id, file_id, file_unique_id in assignments:
+            cur.execute(
+                "SELECT file_id, tags FROM files WHERE user_id = ? AND file_unique_id = ?",
+                (user_id, file_unique_id),
+            )
+            keeper = cur.fetchone()
+            if keeper is None:
+                cur.execute(
+                    "UPDATE files SET file_unique_id = ? WHERE user_id = ? AND file_id = ? AND file_unique_id IS NULL",
+                    (file_unique_id, user_id, file_id),
+                )
+                continue
+            if keeper[0] == file_id:
+                continue
+            change, deltas = _collapse_duplicate(cur, user_id, keeper[0], json.loads(keeper[1]), file_id)
+            collapsed[user_id] += 1
+            tag_changes[user_id] += change
+            tag_deltas.setdefault(user_id, Counter()).update(deltas)
+        conn.commit()
+        for user_id, count in collapsed.items():
+            tag_index.index.apply(user_id, tag_deltas[user_id])
+            activity.record(user_id, uploads=-count, tags=tag_changes[user_id], touch=False)
+        return sum(collapsed.values())
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        logger.exception("Error assigning file_unique_ids")
+        return None
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def get_user(user_id):
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        return cur.fetchone()
+    except Exception:
+        logger.exception("Error getting user")
+        return None
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def _write_user(description, sql, params):
+    """Runs one write statement on users in its own transaction, swallowing errors."""
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute(sql, params)
+    except Exception:
+        logger.exception("Error %s", description)
+        # swallow
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+def add_user(user_id, username):
+    _write_user(
+        "adding user",
+        "INSERT INTO users (user_id, username) VALUES (?, ?) ON CONFLICT (user_id) DO NOTHING",
+        (user_id, username),
+    )
+
+
+def update_user_subscription(user_id, plan_name):
+    _write_user(
+        "updating user subscription",
+        "UPDATE users SET subscription_plan = ? WHERE user_id = ?",
+        (plan_name, user_id),
+    )
+
+
+def record_upload(user_id):
+    """See database.record_upload."""
+    activity.record(user_id, uploads=1)
+
+
+def record_tag_usage(user_id, num_tags):
+    """See database.record_tag_usage."""
+    activity.record(user_id, tags=num_tags)
+
+
+# Rows per UPDATE ... FROM (VALUES ...): four parameters each, well under
+# SQLite's limit on bound parameters
+_ACTIVITY_BATCH = 500
+
+
+def _apply_user_activity(rows):
+    """See database._apply_user_activity. All batches commit together."""
+    conn = _require_connection()
+    cur = None
+    try:
+        cur = conn.cursor(TimedSqliteCursor)
+        cur.execute("BEGIN IMMEDIATE")
+        for start in range(0, len(rows), _ACTIVITY_BATCH):
+            batch = rows[start:start + _ACTIVITY_BATCH]
+            # VALUES columns are named column1..column4 in SQLite
+            cur.execute(
+                f"""
+                UPDATE users SET
+                    upload_count = users.upload_count + v.column2,
+                    tag_count = users.tag_count + v.column3,
+                    last_active = coalesce(max(users.last_active, v.column4), v.column4, users.last_active)
+                FROM (VALUES {", ".join(["(?, ?, ?, ?)"] * len(batch))}) AS v
+                WHERE users.user_id = v.column1
+                """,
+                [value for row in batch for value in row],
+            )
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        if cur:
+            cur.close()
+        put_db_connection(conn)
+
+
+# Users' upload/tag counters and last_active, written behind (see activity.py)
+activity = ActivityBuffer(_apply_user_activity)
@@ -0,0 +1,78 @@
+import importlib
+import logging
+
+from config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+# The query functions live in a storage backend: a module providing every
+# function in INTERFACE, with the signatures and return shapes of
+# database.py. Two backends exist:
+#   database        Postgres, for any postgres:// or postgresql:// URL
+#   sqlite_storage  embedded SQLite (WAL) with FTS5 search, for sqlite: URLs
+# async_database wraps whichever one DATABASE_URL selects.
+
+INTERFACE = (
+    # lifecycle and health
+    "init_db",
+    "close_db",
+    "get_db_connection",
+    "put_db_connection",
+    "ping",
+    "pool_stats",
+    "activity_stats",
+    # files
+    "add_file",
+    "save_upload",
+    "save_uploads",
+    "find_files",
+    "find_file_details",
+    "get_all_tags",
+    "get_tag_counts",
+    "update_file_metadata",
+    "get_recent_files",
+    "delete_files",
+    "get_files_without_unique_id",
+    "assign_file_unique_ids",
+    # users
+    "get_user",
+    "add_user",
+    "update_user_subscription",
+    "record_upload",
+    "record_tag_usage",
+)
+
+
+class StorageUnavailable(Exception):
+    """
+    Raised by the query functions when the backend has no usable connection
+    (e.g. the pool could not be created), so callers can tell "the database
+    is down" apart from "nothing matched".
+    """
+
+
+def backend_module_name(url=DATABASE_URL):
+    if url.startswith("sqlite:"):
+        return "sqlite_storage"
+    return "database"
+
+
+_backend = None
+
+
+def get_backend(url=None):
+    """
+    The backend module for `url` (default: DATABASE_URL). The default one is
+    imported once and cached; it is checked to implement INTERFACE.
+    """
+    global _backend
+    if url is None and _backend is not None:
+        return _backend
+    module = importlib.import_module(backend_module_name(url if url is not None else DATABASE_URL))
+    missing = [name for name in INTERFACE if not callable(getattr(module, name, None))]
+    if missing:
+        raise TypeError(f"Storage backend {module.__name__} lacks {', '.join(missing)}")
+    if url is None:
+        _backend = module
+        logger.info("Using storage backend %s", module.__name__)
+    return module
@@ -0,0 +1,161 @@
+import bisect
+import heapq
+import threading
+from collections import OrderedDict
+
+from config import TAG_INDEX_MAX_TAGS
+
+# In-memory prefix index over each user's tags and their file counts, for
+# tag autocomplete (inline mode) and /tags listings without a database
+# round trip. A user's tags are loaded from user_tags the first time they
+# are needed (bot._complete_tags); after that the storage backends keep
+# them current by calling `index.apply` once each write has committed.
+
+# Sorts after any character a tag name can continue with, for prefix ranges
+_PREFIX_END = "\U0010ffff"
+
+
+class UserTags:
+    """
+    One user's tags as a sorted array of (case-folded name, name) keys, so
+    a prefix is a contiguous range found with bisect, plus each name's
+    file count. Prefixes match case-insensitively.
+    """
+
+    def __init__(self, counts=()):
+        self.counts = {name: count for name, count in counts if count > 0}
+        self.keys = sorted((name.casefold(), name) for name in self.counts)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def apply(self, deltas):
+        """Adds {tag_name: change in file count}; tags reaching zero are dropped."""
+        for name, delta in deltas.items():
+            old = self.counts.get(name, 0)
+            new = old + delta
+            key = (name.casefold(), name)
+            if new > 0:
+                self.counts[name] = new
+                if old <= 0:
+                    bisect.insort(self.keys, key)
+            elif old > 0:
+                del self.counts[name]
+                position = bisect.bisect_left(self.keys, key)
+                if position < len(self.keys) and self.keys[position] == key:
+                    del self.keys[position]
+
+    def complete(self, prefix, limit, offset=0, by_count=False):
+        """
+        ([(name, file count), ...], total) for the tags starting with
+        `prefix`: one page of `limit` from `offset`, alphabetically, or with
+        `by_count` the `limit` most used ones.
+        """
+        prefix = prefix.casefold()
+        start = bisect.bisect_left(self.keys, (prefix,))
+        end = bisect.bisect_left(self.keys, (prefix + _PREFIX_END,))
+        if by_count:
+            names = heapq.nlargest(limit, (name for _, name in self.keys[start:end]), key=self.counts.__getitem__)
+        else:
+            names = [name for _, name in self.keys[start + offset:min(end, start + offset + limit)]]
+        return [(name, self.counts[name]) for name in names], end - start
+
+
+class TagIndex:
+    """
+    Thread-safe holder of UserTags, bounded to `max_tags` tags across all
+    users: the least recently used users are evicted first, and a user with
+    more tags than that is never kept.
+
+    Like UserCache, a load that raced with a write must not be stored: take
+    `generation(user_id)` before loading and pass it to `put`. Loaded users
+    carry their own generation; the rest share `_floor`, which a write to
+    any of them moves past every generation handed out so far.
+    """
+
+    def __init__(self, max_tags):
+        self.max_tags = max_tags
+        self._users = OrderedDict()  # user_id -> UserTags, least recently used first
+        self._size = 0  # tags held across all users
+        self._generations = {}  # user_id -> generation, for loaded users
+        self._writes = 0  # writes applied so far, across all users
+        self._floor = 0  # generation of users that aren't loaded
+        self._lock = threading.Lock()
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, self._floor)
+
+    def put(self, user_id, counts, generation):
+        """Stores a user's (tag_name, file count) pairs unless a write happened since `generation`."""
+        user_tags = UserTags(counts)
+        with self._lock:
+            if generation != self._generations.get(user_id, self._floor):
+                return
+            self._remove(user_id)
+            if len(user_tags) > self.max_tags:
+                return
+            self._users[user_id] = user_tags
+            self._generations[user_id] = generation
+            self._size += len(user_tags)
+            self._evict()
+
+    def apply(self, user_id, deltas):
+        """Applies {tag_name: change in file count} from a committed write."""
+        if not deltas:
+            return
+        with self._lock:
+            self._writes += 1
+            user_tags = self._users.get(user_id)
+            if user_tags is None:
+                self._floor = self._writes
+                return
+            self._size -= len(user_tags)
+            user_tags.apply(deltas)
+            self._size += len(user_tags)
+            self._generations[user_id] = self._writes
+            if len(user_tags) > self.max_tags:
+                self._remove(user_id)
+                self._floor = self._writes
+            self._evict()
+
+    def complete(self, user_id, prefix, limit, offset=0, by_count=False):
+        """UserTags.complete for a loaded user, or None if the user isn't loaded."""
+        with self._lock:
+            user_tags = self._users.get(user_id)
+            if user_tags is None:
+                return None
+            self._users.move_to_end(user_id)
+            return user_tags.complete(prefix, limit, offset, by_count)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._writes += 1
+            self._remove(user_id)
+            self._floor = self._writes
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._size = 0
+            self._generations.clear()
+            self._writes += 1
+            self._floor = self._writes
+
+    def __len__(self):
+        return self._size
+
+    def _remove(self, user_id):
+        user_tags = self._users.pop(user_id, None)
+        if user_tags is not None:
+            self._size -= len(user_tags)
+        self._generations.pop(user_id, None)
+
+    def _evict(self):
+        while self._size > self.max_tags and self._users:
+            user_id, user_tags = self._users.popitem(last=False)
+            self._size -= len(user_tags)
+            self._generations.pop(user_id, None)
+
+
+index = TagIndex(TAG_INDEX_MAX_TAGS)
@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+from activity import ActivityBuffer
+
+
+class Sink:
+    """An `apply` that keeps each batch, failing the first `failures` calls."""
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+        self.applied = threading.Event()
+
+    def __call__(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is down")
+        self.batches.append(rows)
+        self.applied.set()
+
+    def totals(self):
+        """{user_id: (uploads, tags)} over every batch written."""
+        totals = {}
+        for rows in self.batches:
+            for user_id, uploads, tags, _ in rows:
+                old = totals.get(user_id, (0, 0))
+                totals[user_id] = (old[0] + uploads, old[1] + tags)
+        return totals
+
+
+@pytest.fixture
+def buffer():
+    buffers = []
+
+    def make(sink, **kwargs):
+        buffers.append(ActivityBuffer(sink, **kwargs))
+        return buffers[-1]
+
+    yield make
+    for made in buffers:
+        made.close()
+
+
+def test_flush_sums_deltas_per_user_in_user_order(buffer):
+    sink = Sink()
+    activity = buffer(sink, interval=60, max_events=100)
+    activity.record(2, uploads=1)
+    activity.record(1, tags=3, touch=False)
+    activity.record(2, uploads=1, tags=-1)
+    before = activity._pending[2][2]
+
+    assert activity.pending_users() == 2
+    assert activity.flush() == 2
+    (rows,) = sink.batches
+    assert [row[:3] for row in rows] == [(1, 0, 3), (2, 2, -1)]
+    assert rows[0][3] is None
+    assert rows[1][3] >= before
+    assert activity.pending_users() == 0
+    assert activity.flush() == 0
+    assert (activity.flushes, activity.flushed_rows) == (1, 2)
+
+
+def test_users_whose_deltas_cancel_out_are_not_written(buffer):
+    sink = Sink()
+    activity = buffer(sink, interval=60, max_events=100)
+    activity.record(1, uploads=1, touch=False)
+    activity.record(1, uploads=-1, touch=False)
+    assert activity.flush() == 0
+    assert sink.batches == []
+
+
+def test_flushes_once_max_events_pile_up(buffer):
+    sink = Sink()
+    activity = buffer(sink, interval=60, max_events=3)
+    activity.start()
+    activity.record(1)
+    activity.record(2)
+    assert not sink.applied.wait(0.1)
+    activity.record(1)
+    assert sink.applied.wait(2)
+    assert sink.totals() == {1: (0, 0), 2: (0, 0)}
+
+
+def test_flushes_every_interval(buffer):
+    sink = Sink()
+    activity = buffer(sink, interval=0.05, max_events=1000)
+    activity.start()
+    activity.record(1, uploads=1)
+    assert sink.applied.wait(2)
+    assert sink.totals() == {1: (1, 0)}
+
+
+def test_close_stops_the_thread_and_flushes_what_is_left(buffer):
+    sink = Sink()
+    activity = buffer(sink, interval=60, max_events=1000)
+    activity.start()
+    thread = activity._thread
+    activity.record(1, uploads=2)
+    activity.close()
+    assert not thread.is_alive()
+    assert sink.totals() == {1: (2, 0)}
+
+
+def test_close_without_start_still_flushes(buffer):
+    sink = Sink()
+    activity = buffer(sink, interval=60, max_events=1000)
+    activity.record(1, tags=1)
+    activity.close()
+    assert sink.totals() == {1: (0, 1)}
+
+
+def test_failed_flush_is_merged_back_and_retried(buffer):
+    sink = Sink(failures=1)
+    activity = buffer(sink, interval=60, max_events=1000)
+    activity.record(1, uploads=1, touch=False)
+    activity.record(2, tags=1)
+
+    assert activity.flush() == 0
+    assert activity.failed_flushes == 1
+    assert activity.pending_users() == 2
+
+    # Deltas recorded after the failure add to the ones merged back
+    activity.record(1, uploads=1)
+    assert activity.flush() == 2
+    assert sink.totals() == {1: (2, 0), 2: (0, 1)}
+    assert all(row[3] is not None for row in sink.batches[0])
+
+
+def test_records_made_during_a_failed_flush_add_to_the_merged_back_rows(buffer):
+    sink = Sink()
+    batches = []
+
+    def apply(rows):
+        batches.append(rows)
+        if len(batches) == 1:
+            activity.record(1, uploads=1)
+            raise RuntimeError("database is down")
+        sink(rows)
+
+    activity = buffer(apply, interval=60, max_events=1000)
+    activity.record(1, uploads=1, touch=False)
+    assert activity.flush() == 0
+    assert activity.flush() == 1
+    assert sink.totals() == {1: (2, 0)}
+    # The touch recorded during the failed batch survives the merge
+    assert sink.batches[0][0][3] is not None
@@ -0,0 +1,54 @@
+from cache import UserCache
+
+
+def test_put_after_invalidation_is_ignored():
+    cache = UserCache(max_entries=10, ttl=60)
+    generation = cache.generation(1)
+    cache.invalidate_user(1)
+    cache.put(1, "q", "stale", generation)
+    assert cache.get(1, "q") is None
+
+
+def test_put_after_invalidation_of_cached_user_is_ignored():
+    cache = UserCache(max_entries=10, ttl=60)
+    cache.put(1, "a", "old")
+    generation = cache.generation(1)
+    cache.invalidate_user(1)
+    cache.put(1, "q", "stale", generation)
+    assert cache.get(1, "q") is None
+    assert cache.get(1, "a") is None
+
+
+def test_put_without_intervening_write_is_kept():
+    cache = UserCache(max_entries=10, ttl=60)
+    generation = cache.generation(1)
+    cache.put(2, "q", "other user")
+    cache.put(1, "q", "fresh", generation)
+    assert cache.get(1, "q") == "fresh"
+
+
+def test_eviction_drops_the_users_generation():
+    cache = UserCache(max_entries=2, ttl=60)
+    for user_id in range(100):
+        cache.invalidate_user(user_id)
+        cache.put(user_id, "q", user_id, cache.generation(user_id))
+    assert len(cache) == 2
+    assert set(cache._generations) == {98, 99}
+    assert cache.get(99, "q") == 99
+
+
+def test_stale_put_after_eviction_and_invalidation_is_ignored():
+    cache = UserCache(max_entries=1, ttl=60)
+    cache.put(1, "a", "old")
+    generation = cache.generation(1)
+    cache.put(2, "a", "evicts user 1")
+    cache.invalidate_user(1)
+    cache.put(1, "q", "stale", generation)
+    assert cache.get(1, "q") is None
+
+
+def test_expired_entries_are_missing():
+    cache = UserCache(max_entries=10, ttl=-1)
+    cache.put(1, "q", "value")
+    assert cache.get(1, "q") is None
+    assert cache._generations == {}
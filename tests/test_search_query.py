@@ -0,0 +1,96 @@
+import pytest
+
+from search_query import And, Not, Or, Predicate, QueryError, compile_condition, like_pattern, parse
+
+
+def term(value):
+    return Predicate("term", value)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("", None),
+    ("   ", None),
+    ("report", term("report")),
+    ("or", term("or")),  # operators are upper case only
+    ('"annual report"', term("annual report")),
+    ('"unclosed phrase', term("unclosed phrase")),
+    ("#vacation", Predicate("tag", "vacation")),
+    ("tag:#work", Predicate("tag", "work")),
+    ('#"my tag"', Predicate("tag", "my tag")),
+    ("ext:.PDF", Predicate("ext", "pdf")),
+    ("type:Music", Predicate("type", "audio")),
+    ("type:sticker", Predicate("type", "sticker")),
+    ('name:"annual report"', Predicate("name", "annual report")),
+    ("size:big", term("size:big")),
+    ("scan(1).pdf", term("scan(1).pdf")),
+    ("report(1", term("report(1")),
+])
+def test_parse_single_predicates(text, expected):
+    assert parse(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("a b", And((term("a"), term("b")))),
+    ("a AND b", And((term("a"), term("b")))),
+    ("a OR b c", Or((term("a"), And((term("b"), term("c")))))),
+    ("(a OR b) c", And((Or((term("a"), term("b"))), term("c")))),
+    ("NOT a", Not(term("a"))),
+    ("NOT NOT a", Not(Not(term("a")))),
+    ("-a b", And((Not(term("a")), term("b")))),
+    ("-#draft", Not(Predicate("tag", "draft"))),
+    ('-"x y"', Not(term("x y"))),
+    ("-(a OR b) c", And((Not(Or((term("a"), term("b")))), term("c")))),
+    ("a -", And((term("a"), term("-")))),
+])
+def test_parse_operators(text, expected):
+    assert parse(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('(invoice OR "annual report")', Or((term("invoice"), term("annual report")))),
+    ('(("a"))', term("a")),
+    ('((a OR b) (c OR "d e"))', And((Or((term("a"), term("b"))), Or((term("c"), term("d e")))))),
+    ("(a OR foo(bar))", Or((term("a"), term("foo(bar)")))),
+])
+def test_parse_nesting_and_quotes(text, expected):
+    assert parse(text) == expected
+
+
+@pytest.mark.parametrize("text, message", [
+    ("(a", "never closed"),
+    ('("a" OR b', "never closed"),
+    ("a)", "without a matching"),
+    ('#"my tag")', "without a matching"),
+    ("()", "nothing between"),
+    ("a OR", "ends with an operator"),
+    ("NOT", "ends with an operator"),
+    ("AND a", "AND needs a term"),
+    ("a OR OR b", "OR needs a term"),
+])
+def test_parse_errors(text, message):
+    with pytest.raises(QueryError, match=message):
+        parse(text)
+
+
+def _leaf(predicate):
+    return f"{predicate.field} = ?", [predicate.value]
+
+
+def test_compile_empty_query_matches_everything():
+    assert compile_condition(None, _leaf) == ("TRUE", [])
+
+
+def test_compile_keeps_params_in_placeholder_order():
+    sql, params = compile_condition(parse("a OR (#b -ext:pdf)"), _leaf)
+    assert sql == "((term = ?) OR ((tag = ?) AND NOT coalesce((ext = ?), FALSE)))"
+    assert params == ["a", "b", "pdf"]
+
+
+def test_compile_multi_param_leaf():
+    sql, params = compile_condition(parse("x y"), lambda p: ("a = ? OR b = ?", [p.value, p.value.upper()]))
+    assert sql == "((a = ? OR b = ?) AND (a = ? OR b = ?))"
+    assert params == ["x", "X", "y", "Y"]
+
+
+def test_like_pattern_escapes_wildcards():
+    assert like_pattern("50%_off\\") == "%50\\%\\_off\\\\%"
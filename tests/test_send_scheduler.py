@@ -0,0 +1,209 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import pytest
+from telegram.error import RetryAfter
+
+from send_scheduler import BULK, INTERACTIVE, SendScheduler, send_priority
+
+# The scheduler reads RetryAfter.retry_after in either of its forms
+pytestmark = pytest.mark.filterwarnings("ignore::telegram.warnings.PTBDeprecationWarning")
+
+
+def run(test):
+    """Turns `test(scheduler, sent)` into a call that runs it against a started SendScheduler(**kwargs)."""
+    def runner(**kwargs):
+        async def main():
+            scheduler = SendScheduler(**kwargs)
+            await scheduler.initialize()
+            try:
+                return await test(scheduler, [])
+            finally:
+                await scheduler.shutdown()
+        return asyncio.run(main())
+    return runner
+
+
+def send(scheduler, sent, name, chat_id=1, priority=None, endpoint="sendMessage", failures=()):
+    """Queues a request that appends `name` to `sent`, raising each of `failures` first."""
+    failures = list(failures)
+
+    async def callback():
+        if failures:
+            raise failures.pop(0)
+        sent.append(name)
+        return name
+
+    return scheduler.process_request(callback, (), {}, endpoint, {"chat_id": chat_id}, priority)
+
+
+def retry_after(milliseconds):
+    return RetryAfter(timedelta(milliseconds=milliseconds))
+
+
+def test_interactive_requests_overtake_queued_bulk_ones():
+    @run
+    async def test(scheduler, sent):
+        await asyncio.gather(
+            send(scheduler, sent, "bulk 1", priority=BULK),
+            send(scheduler, sent, "bulk 2", priority=BULK),
+            send(scheduler, sent, "reply 1", priority=INTERACTIVE),
+            send(scheduler, sent, "bulk 3", priority=BULK),
+            send(scheduler, sent, "reply 2"),
+        )
+        return sent
+
+    assert test(private_chat_rate=50, chat_burst=1) == ["reply 1", "reply 2", "bulk 1", "bulk 2", "bulk 3"]
+
+
+def test_send_priority_context_applies_without_rate_limit_args():
+    @run
+    async def test(scheduler, sent):
+        with send_priority(BULK):
+            bulk = [asyncio.ensure_future(send(scheduler, sent, f"bulk {i}")) for i in range(2)]
+        await asyncio.gather(*bulk, send(scheduler, sent, "reply"))
+        return sent
+
+    assert test(private_chat_rate=50, chat_burst=1) == ["reply", "bulk 0", "bulk 1"]
+
+
+def test_chat_rate_is_enforced_after_the_burst():
+    @run
+    async def test(scheduler, sent):
+        start = time.monotonic()
+        await asyncio.gather(*(send(scheduler, sent, i) for i in range(4)))
+        return time.monotonic() - start
+
+    # Two go out at once, the other two one 1/20 s apart
+    elapsed = test(private_chat_rate=20, chat_burst=2)
+    assert 0.09 <= elapsed < 0.5
+
+
+def test_group_chats_use_the_group_rate():
+    @run
+    async def test(scheduler, sent):
+        start = time.monotonic()
+        await asyncio.gather(*(send(scheduler, sent, i, chat_id=-100) for i in range(3)))
+        return time.monotonic() - start
+
+    assert test(private_chat_rate=1000, group_chat_rate=20, chat_burst=1) >= 0.09
+
+
+def test_throttled_chat_does_not_hold_up_other_chats():
+    @run
+    async def test(scheduler, sent):
+        slow = [asyncio.ensure_future(send(scheduler, sent, f"slow {i}", chat_id=1)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        start = time.monotonic()
+        await send(scheduler, sent, "other", chat_id=2)
+        elapsed = time.monotonic() - start
+        for task in slow:
+            task.cancel()
+        return elapsed, sent
+
+    elapsed, sent = test(private_chat_rate=1, chat_burst=1)
+    assert elapsed < 0.1
+    assert sent == ["slow 0", "other"]
+
+
+def test_global_rate_caps_all_chats():
+    @run
+    async def test(scheduler, sent):
+        start = time.monotonic()
+        await asyncio.gather(*(send(scheduler, sent, i, chat_id=i) for i in range(4)))
+        return time.monotonic() - start
+
+    # A global bucket of 2 per second holds 2 tokens: the last two wait half a second each
+    assert test(global_rate=2) >= 0.9
+
+
+def test_unthrottled_endpoints_skip_the_queue():
+    @run
+    async def test(scheduler, sent):
+        queued = [asyncio.ensure_future(send(scheduler, sent, i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        await send(scheduler, sent, "answer", endpoint="answerCallbackQuery")
+        for task in queued:
+            task.cancel()
+        return sent
+
+    assert test(private_chat_rate=1, chat_burst=1) == [0, "answer"]
+
+
+def test_retry_after_pauses_the_chat_and_retries():
+    @run
+    async def test(scheduler, sent):
+        start = time.monotonic()
+        first = asyncio.ensure_future(send(scheduler, sent, "first", failures=[retry_after(150)]))
+        await asyncio.sleep(0.05)
+        await send(scheduler, sent, "second")
+        elapsed = time.monotonic() - start
+        await first
+        return elapsed, sent, scheduler.stats()
+
+    elapsed, sent, stats = test()
+    # The second request to the paused chat waits out the pause too
+    assert elapsed >= 0.14
+    assert sorted(sent) == ["first", "second"]
+    assert (stats["sent"], stats["retried"], stats["failed"]) == (2, 1, 0)
+
+
+def test_retry_after_without_chat_pauses_everything():
+    @run
+    async def test(scheduler, sent):
+        start = time.monotonic()
+        await send(scheduler, sent, "no chat", chat_id=None, failures=[retry_after(100)])
+        await send(scheduler, sent, "answer", endpoint="answerInlineQuery")
+        return time.monotonic() - start
+
+    assert test() >= 0.09
+
+
+def test_gives_up_after_max_retries():
+    @run
+    async def test(scheduler, sent):
+        with pytest.raises(RetryAfter):
+            await send(scheduler, sent, "never", failures=[retry_after(10)] * 3)
+        return sent, scheduler.stats()
+
+    sent, stats = test(max_retries=2)
+    assert sent == []
+    assert (stats["sent"], stats["retried"], stats["failed"]) == (0, 2, 1)
+
+
+def test_stats_count_queued_requests_by_priority():
+    @run
+    async def test(scheduler, sent):
+        tasks = [
+            asyncio.ensure_future(send(scheduler, sent, "first")),
+            asyncio.ensure_future(send(scheduler, sent, "reply")),
+            asyncio.ensure_future(send(scheduler, sent, "bulk 1", priority=BULK)),
+            asyncio.ensure_future(send(scheduler, sent, "bulk 2", priority=BULK)),
+        ]
+        await asyncio.sleep(0.01)
+        stats = scheduler.stats()
+        for task in tasks:
+            task.cancel()
+        return stats
+
+    stats = test(private_chat_rate=1, chat_burst=1)
+    assert stats["queue_depth"] == 3
+    assert stats["queue_depth_by_priority"] == {INTERACTIVE: 1, BULK: 2}
+    assert stats["max_queue_depth"] >= 3
+
+
+def test_shutdown_fails_queued_requests():
+    async def main():
+        scheduler = SendScheduler(private_chat_rate=1, chat_burst=1)
+        await scheduler.initialize()
+        sent = []
+        await send(scheduler, sent, "first")
+        queued = asyncio.ensure_future(send(scheduler, sent, "queued"))
+        await asyncio.sleep(0.01)
+        await scheduler.shutdown()
+        with pytest.raises(RuntimeError, match="shut down"):
+            await queued
+        return sent
+
+    assert asyncio.run(main()) == ["first"]
@@ -0,0 +1,118 @@
+from tag_index import TagIndex, UserTags
+
+
+def loaded(index, user_id, counts):
+    index.put(user_id, counts, index.generation(user_id))
+
+
+def test_prefix_matches_case_insensitively_in_order():
+    tags = UserTags([("Work", 3), ("workout", 1), ("weekend", 2), ("WORKSHOP", 5), ("x", 1)])
+    assert tags.complete("work", 10) == ([("Work", 3), ("workout", 1), ("WORKSHOP", 5)], 3)
+    assert tags.complete("WE", 10) == ([("weekend", 2)], 1)
+    assert tags.complete("", 10)[1] == 5
+    assert tags.complete("zzz", 10) == ([], 0)
+
+
+def test_prefix_pages_with_offset_and_by_count():
+    tags = UserTags([(f"t{i}", i) for i in range(1, 8)])
+    assert tags.complete("t", 3, offset=2) == ([("t3", 3), ("t4", 4), ("t5", 5)], 7)
+    assert tags.complete("t", 3, offset=6) == ([("t7", 7)], 7)
+    assert tags.complete("t", 2, by_count=True) == ([("t7", 7), ("t6", 6)], 7)
+
+
+def test_apply_adds_and_drops_tags():
+    tags = UserTags([("a", 1), ("b", 2)])
+    tags.apply({"a": -1, "b": -1, "c": 2, "d": 0, "e": -1})
+    assert tags.counts == {"b": 1, "c": 2}
+    assert tags.complete("", 10) == ([("b", 1), ("c", 2)], 2)
+    assert len(UserTags([("a", 0), ("b", -2)])) == 0
+
+
+def test_index_serves_loaded_users_only():
+    index = TagIndex(max_tags=100)
+    loaded(index, 1, [("cats", 2)])
+    assert index.complete(1, "c", 10) == ([("cats", 2)], 1)
+    assert index.complete(2, "c", 10) is None
+    index.apply(1, {"cars": 1, "cats": -2})
+    assert index.complete(1, "ca", 10) == ([("cars", 1)], 1)
+    assert len(index) == 1
+
+
+def test_least_recently_used_users_are_evicted_by_total_tags():
+    index = TagIndex(max_tags=5)
+    loaded(index, 1, [("a", 1), ("b", 1)])
+    loaded(index, 2, [("c", 1), ("d", 1)])
+    index.complete(1, "", 10)  # user 1 is now the most recently used
+    loaded(index, 3, [("e", 1), ("f", 1)])
+    assert index.complete(2, "", 10) is None
+    assert index.complete(1, "", 10) is not None
+    assert index.complete(3, "", 10) is not None
+    assert len(index) == 4
+    assert set(index._generations) <= {1, 3}
+
+
+def test_growth_past_the_limit_evicts_others_then_the_user():
+    index = TagIndex(max_tags=3)
+    loaded(index, 1, [("a", 1)])
+    loaded(index, 2, [("b", 1)])
+    index.apply(2, {"c": 1})
+    index.apply(2, {"d": 1})
+    assert index.complete(1, "", 10) is None
+    assert index.complete(2, "", 10)[1] == 3
+    index.apply(2, {"e": 1})
+    assert index.complete(2, "", 10) is None
+    assert len(index) == 0
+
+
+def test_users_with_more_tags_than_the_limit_are_not_kept():
+    index = TagIndex(max_tags=2)
+    loaded(index, 1, [("a", 1)])
+    loaded(index, 2, [("a", 1), ("b", 1), ("c", 1)])
+    assert index.complete(2, "", 10) is None
+    assert index.complete(1, "", 10) is not None
+
+
+def test_load_that_raced_with_a_write_is_dropped():
+    index = TagIndex(max_tags=100)
+    generation = index.generation(1)
+    index.apply(1, {"new": 1})
+    index.put(1, [("old", 1)], generation)
+    assert index.complete(1, "", 10) is None
+
+
+def test_load_that_raced_with_a_write_to_a_loaded_user_is_dropped():
+    index = TagIndex(max_tags=100)
+    loaded(index, 1, [("a", 1)])
+    generation = index.generation(1)
+    index.apply(1, {"b": 1})
+    index.put(1, [("a", 1)], generation)
+    assert index.complete(1, "", 10) == ([("a", 1), ("b", 1)], 2)
+
+
+def test_load_that_raced_with_eviction_and_a_write_is_dropped():
+    index = TagIndex(max_tags=1)
+    loaded(index, 1, [("a", 1)])
+    generation = index.generation(1)
+    loaded(index, 2, [("b", 1)])  # evicts user 1
+    index.apply(1, {"c": 1})
+    index.put(1, [("a", 1)], generation)
+    assert index.complete(1, "", 10) is None
+
+
+def test_invalidate_drops_the_user_and_pending_loads():
+    index = TagIndex(max_tags=100)
+    loaded(index, 1, [("a", 1)])
+    generation = index.generation(1)
+    index.invalidate_user(1)
+    assert index.complete(1, "", 10) is None
+    index.put(1, [("a", 1)], generation)
+    assert index.complete(1, "", 10) is None
+    assert index._generations == {}
+
+
+def test_generations_are_kept_for_loaded_users_only():
+    index = TagIndex(max_tags=10)
+    for user_id in range(100):
+        index.apply(user_id, {"tag": 1})
+        loaded(index, user_id, [("tag", 1), ("other", 1)])
+    assert len(index._generations) == len(index._users) == 5
@@ -0,0 +1,186 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from update_processor import PerUserUpdateProcessor
+
+
+def update(user_id=None, inline_query=None):
+    user = SimpleNamespace(id=user_id) if user_id is not None else None
+    return SimpleNamespace(effective_user=user, inline_query=inline_query)
+
+
+class Recorder:
+    """Handler stand-ins that log when they start and finish."""
+
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    async def handle(self, name, seconds=0.0, release=None):
+        self.events.append(("start", name))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if release is not None:
+                await release.wait()
+            await asyncio.sleep(seconds)
+        finally:
+            self.running -= 1
+            self.events.append(("end", name))
+
+
+def test_one_users_updates_run_one_at_a_time_in_order():
+    async def main():
+        processor = PerUserUpdateProcessor(8)
+        recorder = Recorder()
+        # Earlier updates take longer, so any overlap would reorder the log
+        await asyncio.gather(*(
+            processor.process_update(update(1), recorder.handle(i, 0.03 - i * 0.01))
+            for i in range(3)
+        ))
+        return recorder
+
+    recorder = asyncio.run(main())
+    assert recorder.events == [
+        ("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2),
+    ]
+    assert recorder.max_running == 1
+
+
+def test_different_users_run_concurrently():
+    async def main():
+        processor = PerUserUpdateProcessor(8)
+        recorder = Recorder()
+        await asyncio.gather(*(
+            processor.process_update(update(user_id), recorder.handle(user_id, 0.02))
+            for user_id in range(4)
+        ))
+        return recorder
+
+    assert asyncio.run(main()).max_running == 4
+
+
+def test_concurrency_is_capped_across_users():
+    async def main():
+        processor = PerUserUpdateProcessor(2)
+        recorder = Recorder()
+        await asyncio.gather(*(
+            processor.process_update(update(user_id), recorder.handle(user_id, 0.01))
+            for user_id in range(5)
+        ))
+        return recorder
+
+    assert asyncio.run(main()).max_running == 2
+
+
+def test_queued_updates_do_not_hold_slots_other_users_could_use():
+    async def main():
+        processor = PerUserUpdateProcessor(2)
+        recorder = Recorder()
+        release = asyncio.Event()
+        slow = [
+            asyncio.ensure_future(processor.process_update(update(1), recorder.handle(f"a{i}", release=release)))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        # User 1 has one update running and two queued behind it, yet only one slot is taken
+        assert processor.current_concurrent_updates == 1
+        await asyncio.wait_for(processor.process_update(update(2), recorder.handle("b")), timeout=1)
+        release.set()
+        await asyncio.gather(*slow)
+        return recorder
+
+    recorder = asyncio.run(main())
+    assert recorder.events.index(("end", "b")) < recorder.events.index(("end", "a0"))
+
+
+@pytest.mark.parametrize("unserialized", [
+    update(None),
+    update(1, inline_query=object()),
+])
+def test_inline_queries_and_updates_without_a_user_are_not_serialized(unserialized):
+    async def main():
+        processor = PerUserUpdateProcessor(8)
+        recorder = Recorder()
+        await asyncio.gather(*(processor.process_update(unserialized, recorder.handle(i, 0.02)) for i in range(3)))
+        return recorder, processor.busy_users
+
+    recorder, busy_users = asyncio.run(main())
+    assert recorder.max_running == 3
+    assert busy_users == 0
+
+
+def test_busy_users_and_waiting_updates():
+    async def main():
+        processor = PerUserUpdateProcessor(1)
+        recorder = Recorder()
+        release = asyncio.Event()
+        tasks = [
+            asyncio.ensure_future(processor.process_update(update(user_id), recorder.handle(i, release=release)))
+            for i, user_id in enumerate([1, 1, 2])
+        ]
+        await asyncio.sleep(0.01)
+        during = processor.busy_users, processor.waiting_updates
+        release.set()
+        await asyncio.gather(*tasks)
+        return during, (processor.busy_users, processor.waiting_updates)
+
+    during, after = asyncio.run(main())
+    # One running; user 1's second update is behind its lock, user 2's behind the only slot
+    assert during == (2, 2)
+    assert after == (0, 0)
+
+
+def test_cancelled_and_failing_updates_release_the_user():
+    async def main():
+        processor = PerUserUpdateProcessor(8)
+        recorder = Recorder()
+        release = asyncio.Event()
+
+        async def fail():
+            raise ValueError("handler failed")
+
+        running = asyncio.ensure_future(processor.process_update(update(1), recorder.handle("running", release=release)))
+        never_started = recorder.handle("queued")
+        queued = asyncio.ensure_future(processor.process_update(update(1), never_started))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        release.set()
+        await running
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        never_started.close()
+        with pytest.raises(ValueError):
+            await processor.process_update(update(1), fail())
+        await processor.process_update(update(1), recorder.handle("after"))
+        return recorder, processor
+
+    recorder, processor = asyncio.run(main())
+    assert ("start", "queued") not in recorder.events
+    assert recorder.events[-1] == ("end", "after")
+    assert (processor.busy_users, processor.waiting_updates) == (0, 0)
+    assert processor._user_locks == {}
+
+
+def test_user_lock_serializes_with_the_users_updates():
+    async def main():
+        processor = PerUserUpdateProcessor(8)
+        recorder = Recorder()
+
+        async def outside_update():
+            async with processor.user_lock(1):
+                await recorder.handle("album", 0.02)
+
+        await asyncio.gather(
+            processor.process_update(update(1), recorder.handle("upload", 0.02)),
+            outside_update(),
+            processor.process_update(update(1), recorder.handle("edit")),
+        )
+        return recorder
+
+    recorder = asyncio.run(main())
+    assert recorder.max_running == 1
+    assert [name for event, name in recorder.events if event == "start"] == ["upload", "album", "edit"]
@@ -0,0 +1,70 @@
+import asyncio
+import contextlib
+
+from telegram.ext import SimpleUpdateProcessor
+
+
+class PerUserUpdateProcessor(SimpleUpdateProcessor):
+    """
+    Processes updates from different users concurrently (at most
+    `max_concurrent_updates` at a time), but one at a time per user and in
+    the order they arrived, so a user's upload, edit and delete apply in
+    sequence and handlers never race on the same `context.user_data`.
+
+    The per-user lock is taken before a concurrency slot, so updates queued
+    behind a slow one from the same user don't hold slots other users could
+    run in. Updates without a user (channel posts, polls) and inline queries
+    are not serialized.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}  # user_id -> [asyncio.Lock, number of holders and waiters]
+        self._received = 0  # updates inside process_update, waiting or running
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id):
+        """
+        Serializes work for one user with the updates being processed for them.
+        Also used for work that runs outside an update, like saving an album.
+        """
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user_id]
+
+    async def process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        self._received += 1
+        try:
+            # Inline queries only read and arrive on every keystroke; queued
+            # behind an upload they would go stale, and debouncing them (see
+            # inline_search.debounce) needs them to run side by side.
+            if user is None or getattr(update, "inline_query", None) is not None:
+                await super().process_update(update, coroutine)
+                return
+            async with self.user_lock(user.id):
+                await super().process_update(update, coroutine)
+        finally:
+            self._received -= 1
+
+    @property
+    def busy_users(self):
+        """Number of users with an update being processed or waiting."""
+        return len(self._user_locks)
+
+    @property
+    def waiting_updates(self):
+        """
+        Number of updates handed to the processor that haven't started: queued
+        behind the same user's earlier updates or waiting for a free slot.
+        """
+        # Only running updates hold a slot, so the rest are waiting
+        return self._received - self.current_concurrent_updates
@@ -1,28 +1,154 @@
-from flask import Flask
-import threading
-import os
-import time
+import asyncio
+import hmac
+import json
 import logging
 
-app = Flask(__name__)
+from aiohttp import web
+from telegram import Update
 
-@app.route('/ping')
-def ping():
-    return "Pong!", 200
+import async_database as db
+import metrics
 
-def run_web_server():
-    port = int(os.environ.get("PORT", 5000))
-    while True:
+logger = logging.getLogger(__name__)
+
+# aiohttp app keys for the telegram Application whose updates we receive
+# and the event loop lag monitor (see metrics.LoopLagMonitor)
+APPLICATION = web.AppKey("application", object)
+LAG_MONITOR = web.AppKey("lag_monitor", object)
+
+# /readyz fails when the database doesn't answer within DB_PING_TIMEOUT
+# seconds or the event loop is lagging by more than READY_MAX_LOOP_LAG.
+DB_PING_TIMEOUT = 2.0
+READY_MAX_LOOP_LAG = 1.0
+
+
+async def ping(request):
+    return web.Response(text="Pong!")
+
+
+async def healthz(request):
+    """Liveness: the event loop is running and serving requests."""
+    return web.json_response({"status": "ok"})
+
+
+async def readyz(request):
+    """
+    Readiness: a pooled database connection answers a query and the event
+    loop isn't stalled. Responds 503 with the failing checks otherwise.
+    """
+    try:
+        db_ok = await asyncio.wait_for(db.ping(), timeout=DB_PING_TIMEOUT)
+    except asyncio.TimeoutError:
+        db_ok = False
+    lag_monitor = request.app.get(LAG_MONITOR)
+    loop_lag = lag_monitor.lag if lag_monitor is not None else 0.0
+    checks = {
+        "database": "ok" if db_ok else "unavailable",
+        "event_loop": "ok" if loop_lag <= READY_MAX_LOOP_LAG else "lagging",
+        "event_loop_lag_seconds": round(loop_lag, 4),
+    }
+    ready = db_ok and loop_lag <= READY_MAX_LOOP_LAG
+    return web.json_response(checks, status=200 if ready else 503)
+
+
+def _sample_gauges(application, lag_monitor):
+    """Refreshes the metrics that are read from live state rather than recorded."""
+    stats = db.pool_stats()
+    if stats is None:
+        metrics.DB_POOL_CONNECTIONS.clear()
+    else:
+        in_use, idle, maxconn = stats
+        metrics.DB_POOL_CONNECTIONS.set(in_use, state="in_use")
+        metrics.DB_POOL_CONNECTIONS.set(idle, state="idle")
+        metrics.DB_POOL_CONNECTIONS.set(maxconn, state="max")
+
+    metrics.UPDATES_WAITING.set(application.update_processor.waiting_updates)
+    metrics.UPDATES_IN_PROGRESS.set(application.update_processor.current_concurrent_updates)
+    metrics.USERS_BUSY.set(application.update_processor.busy_users)
+
+    pending_users, flushes, failed_flushes = db.activity_stats()
+    metrics.ACTIVITY_PENDING_USERS.set(pending_users)
+    metrics.ACTIVITY_FLUSHES.set_total(flushes, outcome="ok")
+    metrics.ACTIVITY_FLUSHES.set_total(failed_flushes, outcome="failed")
+
+    rate_limiter = application.bot.rate_limiter
+    if rate_limiter is not None and hasattr(rate_limiter, "stats"):
+        send_stats = rate_limiter.stats()
+        metrics.SEND_QUEUE_DEPTH.clear()
+        metrics.SEND_QUEUE_DEPTH.set(send_stats["queue_depth"], priority="all")
+        for priority, depth in send_stats["queue_depth_by_priority"].items():
+            metrics.SEND_QUEUE_DEPTH.set(depth, priority=priority)
+        for outcome in ("sent", "retried", "failed"):
+            metrics.SEND_REQUESTS.set_total(send_stats[outcome], outcome=outcome)
+
+    if lag_monitor is not None:
+        metrics.EVENT_LOOP_LAG.set(lag_monitor.lag)
+
+
+async def metrics_endpoint(request):
+    """Prometheus scrape endpoint."""
+    _sample_gauges(request.app[APPLICATION], request.app.get(LAG_MONITOR))
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+def _webhook_handler(secret_token):
+    async def webhook(request):
+        """
+        Receives an Update pushed by Telegram (or POSTed by hand when testing)
+        and hands it to the Application's update queue.
+        """
+        # compare_digest only takes ASCII str, so compare bytes; aiohttp keeps
+        # undecodable header bytes as surrogates
+        received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("utf-8", "surrogateescape")
+        if not hmac.compare_digest(received, secret_token.encode()):
+            logger.warning("Rejected webhook request with a wrong secret token from %s", request.remote)
+            return web.Response(status=403)
+
+        application = request.app[APPLICATION]
         try:
-            app.run(host='0.0.0.0', port=port)
-        except Exception as exc:
-            logging.exception("Web server crashed; restarting in 2s")
-            time.sleep(2)
-
-def start_web_server_thread():
-    thread = threading.Thread(target=run_web_server)
-    thread.daemon = True
-    thread.start()
-
-if __name__ == '__main__':
-    run_web_server()
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError("webhook payload is not a JSON object")
+            update = Update.de_json(data, application.bot)
+            # Swap the cached objects behind arbitrary callback_data back in,
+            # as the updater does for polled updates
+            application.bot.insert_callback_data(update)
+        except (json.JSONDecodeError, TypeError, ValueError, KeyError, AttributeError):
+            logger.warning("Rejected malformed webhook payload")
+            return web.Response(status=400)
+
+        await application.update_queue.put(update)
+        return web.Response()
+    return webhook
+
+
+def create_app(application, webhook_path=None, secret_token=None, lag_monitor=None):
+    """
+    Builds the HTTP app: /ping, /healthz, /readyz and /metrics always, plus a
+    POST endpoint at `webhook_path` that feeds updates to `application` when
+    running in webhook mode. The webhook requires `secret_token`.
+    """
+    if webhook_path and not secret_token:
+        raise ValueError("The webhook endpoint needs a secret token")
+    app = web.Application()
+    app[APPLICATION] = application
+    if lag_monitor is not None:
+        app[LAG_MONITOR] = lag_monitor
+    app.router.add_get("/ping", ping)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    app.router.add_get("/metrics", metrics_endpoint)
+    if webhook_path:
+        app.router.add_post(webhook_path, _webhook_handler(secret_token))
+    return app
+
+
+async def start_web_server(application, host, port, webhook_path=None, secret_token=None, lag_monitor=None):
+    """Starts serving on `host`:`port` in the running event loop. Returns the runner; call its cleanup() to stop."""
+    runner = web.AppRunner(create_app(application, webhook_path, secret_token, lag_monitor), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host=host, port=port)
+    await site.start()
+    logger.info("Web server listening on %s:%s", host, port)
+    return runner